@@ -0,0 +1,142 @@
+"""
+Микробенчмарк переписывания DASH-манифестов: DashRewriter против прежних
+двух регулярных выражений из proxy_stream.
+
+Прежняя реализация быстрее на коротких манифестах, но пропускает BaseURL,
+SegmentList/SegmentURL и Initialization@sourceURL, поэтому сравнивается
+и число переписанных ссылок.
+
+Запуск из корня проекта:
+    python bench/bench_dash_rewrite.py [--json [файл]]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+from urllib.parse import quote_plus, urljoin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import save_results  # noqa: E402
+from dash_rewriter import DashRewriter  # noqa: E402
+
+MPD_URL = "https://cdn.example.com/live/channel/manifest.mpd"
+
+
+def legacy_rewrite(content: str, clean_url: str, suffix: str = '') -> str:
+    """Прежняя реализация из proxy_stream (ветка DASH), без изменений логики"""
+    base_url = clean_url.rsplit('/', 1)[0] + '/'
+    content = re.sub(r'(initialization|media)="([^"]+)"',
+                     lambda m: f'{m.group(1)}="/proxy?url={quote_plus(urljoin(base_url, m.group(2)))}{suffix}"',
+                     content)
+    content = re.sub(r'(https?://[^"\s]+\.m4s|https?://[^"\s]+\.mp4)',
+                     lambda m: f'/proxy?url={quote_plus(m.group(1))}{suffix}',
+                     content)
+    return content
+
+
+def template_period(index: int, representations: int, timeline: int) -> str:
+    """
+    Период с SegmentTemplate и длинным SegmentTimeline. У нечетных
+    Representation свой BaseURL-каталог: шаблон AdaptationSet для них
+    разрешается от него
+    """
+    lines = [f'  <Period id="p{index}" start="PT{index * 600}S">',
+             f'    <BaseURL>period_{index}/</BaseURL>',
+             '    <AdaptationSet mimeType="video/mp4" segmentAlignment="true">',
+             '      <SegmentTemplate timescale="90000" initialization="$RepresentationID$/init.mp4"'
+             ' media="$RepresentationID$/$Time$.m4s">',
+             '        <SegmentTimeline>']
+    lines += [f'          <S t="{i * 180000}" d="180000"/>' for i in range(timeline)]
+    lines += ['        </SegmentTimeline>', '      </SegmentTemplate>']
+    for r in range(representations):
+        tag = f'      <Representation id="v{r}" bandwidth="{(r + 1) * 800000}" width="1280" height="720"'
+        if r % 2:
+            lines += [tag + '>', f'        <BaseURL>v{r}/</BaseURL>', '      </Representation>']
+        else:
+            lines.append(tag + '/>')
+    lines += ['    </AdaptationSet>', '  </Period>']
+    return '\n'.join(lines)
+
+
+def list_period(index: int, representations: int, segments: int) -> str:
+    """Период с SegmentList: по ссылке на каждый сегмент"""
+    lines = [f'  <Period id="l{index}">', '    <AdaptationSet mimeType="audio/mp4">']
+    for r in range(representations):
+        lines += [f'      <Representation id="a{r}" bandwidth="128000">',
+                  f'        <BaseURL>https://audio.example.com/track_{r}/</BaseURL>',
+                  '        <SegmentList timescale="1000" duration="2000">',
+                  '          <Initialization sourceURL="init.mp4"/>']
+        lines += [f'          <SegmentURL media="seg_{i}.m4s"/>' for i in range(segments)]
+        lines += ['        </SegmentList>', '      </Representation>']
+    lines += ['    </AdaptationSet>', '  </Period>']
+    return '\n'.join(lines)
+
+
+def manifest(periods: int, timeline: int, publish_time: int = 0) -> str:
+    body = []
+    for index in range(periods):
+        body.append(template_period(index, 4, timeline))
+        body.append(list_period(index, 2, timeline // 4))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic" publishTime="2026-01-01T00:{publish_time:05d}Z">\n'
+            '  <BaseURL>https://cdn.example.com/live/channel/</BaseURL>\n'
+            + '\n'.join(body) + '\n</MPD>')
+
+
+def proxied_links(text: str) -> int:
+    return text.count('/proxy?url=')
+
+
+def check_representation_base():
+    """Шаблон AdaptationSet у Representation со своим BaseURL ведет в ее каталог"""
+    body = DashRewriter().rewrite(manifest(1, 4), MPD_URL).body.decode()
+    expected = quote_plus("https://cdn.example.com/live/channel/period_0/v1/$RepresentationID$/").replace("%24", "$")
+    assert expected in body, "шаблон не разрешен от BaseURL Representation"
+    assert "<BaseURL>" not in body
+
+
+def run() -> dict:
+    check_representation_base()
+    results = {"full": {}, "dynamic": {}}
+    cases = [(f"{periods} периодов x{timeline}", manifest(periods, timeline))
+             for periods, timeline in ((1, 30), (4, 120), (16, 400), (32, 1000))]
+
+    print(f"{'манифест':<22}{'КБ':>7}{'прежний, мкс':>15}{'новый, мкс':>13}{'ссылок было':>13}{'стало':>8}")
+    for name, content in cases:
+        number = max(5, 2_000_000 // len(content))
+        legacy = min(timeit.repeat(lambda: legacy_rewrite(content, MPD_URL), number=number, repeat=5)) / number
+        # Каждый раз новый экземпляр, чтобы не сработала отдача готового результата
+        current = min(timeit.repeat(lambda: DashRewriter().rewrite(content, MPD_URL),
+                                    number=number, repeat=5)) / number
+        links = proxied_links(DashRewriter().rewrite(content, MPD_URL).body.decode())
+        print(f"{name:<22}{len(content) / 1024:>7.0f}{legacy * 1e6:>15.1f}{current * 1e6:>13.1f}"
+              f"{proxied_links(legacy_rewrite(content, MPD_URL)):>13}{links:>8}")
+        results["full"][name] = {"kb": round(len(content) / 1024), "legacy_us": round(legacy * 1e6, 2),
+                                 "current_us": round(current * 1e6, 2), "links": links}
+
+    # Динамический манифест: плеер перечитывает его чаще, чем меняется publishTime
+    print()
+    print(f"{'манифест':<22}{'заново, мкс':>15}{'тот же publishTime, мкс':>25}")
+    for name, content in cases:
+        number = max(5, 2_000_000 // len(content))
+        rewriter = DashRewriter()
+        fresh = min(timeit.repeat(lambda: DashRewriter().rewrite(content, MPD_URL),
+                                  number=number, repeat=5)) / number
+        # Тот же publishTime, но другой текст: результат берется готовым
+        changed = content.replace('d="180000"/>', 'd="180000" />', 1)
+        rewriter.rewrite(content, MPD_URL)
+        reused = min(timeit.repeat(lambda: rewriter.rewrite(changed, MPD_URL), number=number, repeat=5)) / number
+        print(f"{name:<22}{fresh * 1e6:>15.1f}{reused * 1e6:>25.1f}")
+        results["dynamic"][name] = {"fresh_us": round(fresh * 1e6, 2), "reused_us": round(reused * 1e6, 2)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--json", nargs="?", const="", help="сохранить результаты (по умолчанию в bench/results/)")
+    args = parser.parse_args()
+    results = run()
+    if args.json is not None:
+        print(f"результаты: {save_results('dash_rewrite', results, output=args.json or None)}")
@@ -0,0 +1,99 @@
+"""
+Микробенчмарк телепрограммы: потоковый разбор сжатого XMLTV (скорость
+и пиковая память разбора) и поиск передач в эфире для пачки каналов.
+
+Запуск из корня проекта:
+    python bench/bench_epg.py [--json [файл]] [--channels 500] [--days 7]
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import save_results  # noqa: E402
+from epg import EPG_CHUNK_SIZE, XmltvParser  # noqa: E402
+
+
+def xmltv_time(ts: int) -> str:
+    return time.strftime('%Y%m%d%H%M%S +0000', time.gmtime(ts))
+
+
+def make_feed(channels: int, days: int, now: int) -> bytes:
+    """Сжатый XMLTV: передачи по 30-90 минут с описаниями, половина дней в прошлом"""
+    rng = random.Random(1)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n']
+    parts += [f'<channel id="ch{index}"><display-name>Канал {index}</display-name></channel>\n'
+              for index in range(channels)]
+    for index in range(channels):
+        start = now - days * 86400 // 2
+        while start < now + days * 86400 // 2:
+            duration = rng.choice((1800, 3600, 5400))
+            parts.append(f'<programme start="{xmltv_time(start)}" stop="{xmltv_time(start + duration)}" '
+                         f'channel="ch{index}"><title lang="ru">Передача {rng.randrange(200)}</title>'
+                         f'<desc lang="ru">{"Описание передачи. " * rng.randrange(5, 30)}</desc></programme>\n')
+            start += duration
+    parts.append('</tv>\n')
+    return gzip.compress(''.join(parts).encode('utf-8'), compresslevel=6)
+
+
+def parse(feed: bytes, now: int, window_past: float = 3 * 3600, window_future: float = 24 * 3600):
+    parser = XmltvParser(now - window_past, now + window_future)
+    for offset in range(0, len(feed), EPG_CHUNK_SIZE):
+        parser.feed(feed[offset:offset + EPG_CHUNK_SIZE])
+    return parser, parser.close()
+
+
+def run(channels: int, days: int) -> dict:
+    now = int(time.time())
+    feed = make_feed(channels, days, now)
+    raw_size = len(gzip.decompress(feed))
+
+    started = time.perf_counter()
+    parser, schedules = parse(feed, now)
+    elapsed = time.perf_counter() - started
+    # Память отдельным проходом: tracemalloc замедляет разбор в разы
+    tracemalloc.start()
+    parse(feed, now)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    kept = sum(len(schedule) for schedule in schedules.values())
+
+    print(f"XMLTV: {len(feed) / 1e6:.1f} МБ сжатый, {raw_size / 1e6:.1f} МБ XML, "
+          f"{parser.total} передач, в окне {kept}")
+    print(f"разбор: {elapsed:.2f} с ({raw_size / 1e6 / elapsed:.0f} МБ/с XML), пик памяти {peak / 1e6:.1f} МБ")
+
+    ids = list(schedules)
+    results = {
+        "compressed_mb": round(len(feed) / 1e6, 2),
+        "xml_mb": round(raw_size / 1e6, 2),
+        "programmes": parser.total,
+        "kept": kept,
+        "parse_s": round(elapsed, 3),
+        "parse_peak_mb": round(peak / 1e6, 2),
+        "lookup": {},
+    }
+    for batch in (1, 50, 500):
+        chosen = ids[:batch]
+        number = max(100, 100_000 // batch)
+        lookup = min(timeit.repeat(lambda: [schedules[tvg_id].now_next(now) for tvg_id in chosen],
+                                   number=number, repeat=5)) / number
+        print(f"now/next для {batch:>4} каналов: {lookup * 1e6:>9.1f} мкс ({lookup / batch * 1e6:.2f} мкс на канал)")
+        results["lookup"][str(batch)] = {"us": round(lookup * 1e6, 2), "per_channel_us": round(lookup / batch * 1e6, 3)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--channels", type=int, default=500)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--json", nargs="?", const="", help="сохранить результаты (по умолчанию в bench/results/)")
+    args = parser.parse_args()
+    results = run(args.channels, args.days)
+    if args.json is not None:
+        print(f"результаты: {save_results('epg', results, {'channels': args.channels, 'days': args.days}, args.json or None)}")
@@ -0,0 +1,166 @@
+"""
+Микробенчмарк переписывания HLS-плейлистов: HlsRewriter против прежнего
+построчного цикла из proxy_stream.
+
+Запуск из корня проекта:
+    python bench/bench_hls_rewrite.py [--json [файл]]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+from urllib.parse import quote_plus, urljoin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import save_results  # noqa: E402
+from hls_rewriter import HlsRewriter  # noqa: E402
+
+BASE_URL = "https://cdn.example.com/live/channel/index.m3u8"
+
+
+def legacy_rewrite(content: str, clean_url: str) -> str:
+    """Прежняя реализация из proxy_stream (ветка HLS), без изменений логики"""
+    base_url = clean_url.rsplit('/', 1)[0] + '/'
+    lines = content.splitlines()
+    processed_lines = []
+    is_master_playlist = any('#EXT-X-STREAM-INF' in line for line in lines)
+    if not is_master_playlist:
+        for line in lines:
+            if line.startswith('#EXT-X-TARGETDURATION:'):
+                try:
+                    current_duration = int(line.split(':')[1].strip())
+                    processed_lines.append(f'#EXT-X-TARGETDURATION:{current_duration * 2}')
+                    continue
+                except (ValueError, IndexError):
+                    processed_lines.append(line)
+                    continue
+            if line.startswith('#EXT-X-PLAYLIST-TYPE:'):
+                processed_lines.append(line)
+                continue
+            if line.startswith('#EXTINF:'):
+                processed_lines.append(line)
+                continue
+            if line.startswith('#') and 'URI=' not in line and 'http' not in line:
+                processed_lines.append(line)
+                continue
+            if 'URI=' in line:
+                line = re.sub(r'URI="([^"]+)"',
+                              lambda m: f'URI="/proxy?url={quote_plus(urljoin(base_url, m.group(1)))}"',
+                              line)
+                processed_lines.append(line)
+                continue
+            if line.startswith('#') and ('http://' in line or 'https://' in line):
+                line = re.sub(r'(https?://[^"\s,]+)',
+                              lambda m: f'/proxy?url={quote_plus(m.group(1))}',
+                              line)
+                processed_lines.append(line)
+                continue
+            if not line.startswith('#') and (line.strip().endswith('.ts') or
+                                           line.strip().endswith('.m3u8') or
+                                           '.ts?' in line or
+                                           '.m3u8?' in line):
+                if line.startswith('http'):
+                    processed_lines.append(f'/proxy?url={quote_plus(line)}')
+                else:
+                    processed_lines.append(f'/proxy?url={quote_plus(urljoin(base_url, line))}')
+                continue
+            processed_lines.append(line)
+        if not any('#EXT-X-PLAYLIST-TYPE:VOD' in line for line in processed_lines) and \
+                not any('#EXT-X-ENDLIST' in line for line in processed_lines):
+            header_end_index = next((i for i, line in enumerate(processed_lines)
+                                     if not line.startswith('#') or line.startswith('#EXTINF')), 0)
+            processed_lines.insert(header_end_index, '#EXT-X-PLAYLIST-TYPE:VOD')
+    else:
+        for line in lines:
+            if line.startswith('#') and 'URI=' not in line and 'http' not in line:
+                processed_lines.append(line)
+                continue
+            if 'URI=' in line:
+                line = re.sub(r'URI="([^"]+)"',
+                              lambda m: f'URI="/proxy?url={quote_plus(urljoin(base_url, m.group(1)))}"',
+                              line)
+                processed_lines.append(line)
+                continue
+            if line.startswith('#') and ('http://' in line or 'https://' in line):
+                line = re.sub(r'(https?://[^"\s,]+)',
+                              lambda m: f'/proxy?url={quote_plus(m.group(1))}',
+                              line)
+                processed_lines.append(line)
+                continue
+            if not line.startswith('#') and line.strip():
+                if line.startswith('http'):
+                    processed_lines.append(f'/proxy?url={quote_plus(line)}')
+                else:
+                    processed_lines.append(f'/proxy?url={quote_plus(urljoin(base_url, line))}')
+                continue
+            processed_lines.append(line)
+    return '\n'.join(processed_lines)
+
+
+def media_playlist(segments: int, first: int = 1000) -> str:
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6', f'#EXT-X-MEDIA-SEQUENCE:{first}',
+             '#EXT-X-KEY:METHOD=AES-128,URI="keys/key.bin",IV=0x1234']
+    for i in range(first, first + segments):
+        lines.append('#EXTINF:6.000,')
+        lines.append(f'segment_{i}.ts?token=abcdef0123456789')
+    return '\n'.join(lines)
+
+
+def master_playlist(variants: int) -> str:
+    lines = ['#EXTM3U',
+             '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="rus",URI="audio/rus.m3u8"']
+    for i in range(variants):
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={(i + 1) * 500000},RESOLUTION=1280x720,AUDIO="aud"')
+        lines.append(f'video_{i}/index.m3u8')
+        lines.append(f'#EXT-X-I-FRAME-STREAM-INF:BANDWIDTH={(i + 1) * 50000},URI="video_{i}/iframe.m3u8"')
+    return '\n'.join(lines)
+
+
+def run() -> dict:
+    results = {"full": {}, "sliding": {}}
+    cases = [("master x4", master_playlist(4))]
+    cases += [(f"media x{n}", media_playlist(n)) for n in (6, 60, 600, 6000)]
+    rewriter = HlsRewriter()
+
+    print(f"{'плейлист':<14}{'строк':>8}{'прежний, мкс':>16}{'новый, мкс':>14}{'ускорение':>12}")
+    for name, content in cases:
+        number = max(10, 20000 // (content.count('\n') + 1))
+        legacy = min(timeit.repeat(lambda: legacy_rewrite(content, BASE_URL), number=number, repeat=5)) / number
+        # Полное переписывание без состояния живого плейлиста
+        current = min(timeit.repeat(lambda: rewriter.rewrite(content, BASE_URL, incremental=False),
+                                    number=number, repeat=5)) / number
+        print(f"{name:<14}{content.count(chr(10)) + 1:>8}{legacy * 1e6:>16.1f}{current * 1e6:>14.1f}"
+              f"{legacy / current:>11.1f}x")
+        results["full"][name] = {"legacy_us": round(legacy * 1e6, 2), "current_us": round(current * 1e6, 2)}
+
+    # Живой плейлист: при каждом обновлении окно сдвигается на один сегмент
+    print()
+    print(f"{'окно':<14}{'полностью, мкс':>16}{'с сдвигом, мкс':>16}{'ускорение':>12}")
+    for segments in (6, 60, 600):
+        number = max(10, 20000 // (segments * 2))
+        windows = [media_playlist(segments, first) for first in range(1000, 1000 + number * 5 + 1)]
+        full = min(timeit.repeat(lambda: rewriter.rewrite(windows[0], BASE_URL, incremental=False),
+                                 number=number, repeat=5)) / number
+        timings = []
+        for run_index in range(5):
+            sliding = HlsRewriter()
+            sliding.rewrite(windows[run_index * number], BASE_URL)
+            started = timeit.default_timer()
+            for content in windows[run_index * number + 1:(run_index + 1) * number + 1]:
+                sliding.rewrite(content, BASE_URL)
+            timings.append((timeit.default_timer() - started) / number)
+        delta = min(timings)
+        print(f"x{segments:<13}{full * 1e6:>16.1f}{delta * 1e6:>16.1f}{full / delta:>11.1f}x")
+        results["sliding"][f"x{segments}"] = {"full_us": round(full * 1e6, 2), "sliding_us": round(delta * 1e6, 2)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--json", nargs="?", const="", help="сохранить результаты (по умолчанию в bench/results/)")
+    args = parser.parse_args()
+    results = run()
+    if args.json is not None:
+        print(f"результаты: {save_results('hls_rewrite', results, output=args.json or None)}")
@@ -0,0 +1,56 @@
+"""
+Микробенчмарк разбора плейлиста каналов на local.m3u: разбор M3U,
+хэш версии, сборка каталога (индексы, поиск, готовые ответы /api/channels)
+и объединение нескольких источников с поиском дубликатов.
+
+Запуск из корня проекта:
+    python bench/bench_playlist_parse.py [--json [файл]] [--playlist путь]
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import ROOT_DIR, save_results  # noqa: E402
+from catalog import merge_playlists, parse_channels, parse_playlist, playlist_version  # noqa: E402
+
+
+def measure(func, number: int = 5, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def run(path: str) -> dict:
+    with open(path, encoding="utf-8", errors="replace") as file:
+        content = file.read()
+    parsed = parse_channels(content)
+    version = playlist_version(content)
+    now = time.time()
+
+    stages = [
+        ("parse_channels", lambda: parse_channels(content)),
+        ("playlist_version", lambda: playlist_version(content)),
+        ("parse_playlist", lambda: parse_playlist(content, now)),
+        # Тот же плейлист из трех источников: все каналы второго и третьего - зеркала
+        ("merge x3", lambda: merge_playlists([parsed, parsed, parsed], version, now)),
+    ]
+    results = {"channels": len(parsed[0]), "kb": round(len(content.encode("utf-8")) / 1024)}
+    print(f"{path}: {results['channels']} каналов, {results['kb']} КБ")
+    print(f"{'этап':<20}{'мс':>10}")
+    for name, func in stages:
+        elapsed = measure(func)
+        results[name] = {"ms": round(elapsed * 1000, 3)}
+        print(f"{name:<20}{elapsed * 1000:>10.2f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--playlist", default=os.path.join(ROOT_DIR, "local.m3u"))
+    parser.add_argument("--json", nargs="?", const="", help="сохранить результаты (по умолчанию в bench/results/)")
+    args = parser.parse_args()
+    results = run(args.playlist)
+    if args.json is not None:
+        print(f"результаты: {save_results('playlist_parse', results, {'playlist': args.playlist}, args.json or None)}")
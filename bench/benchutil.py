@@ -0,0 +1,59 @@
+"""Общее для бенчмарков: перцентили и сохранение результатов в JSON для сравнения запусков"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, Optional, Sequence
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Перцентиль q (0-100) по ближайшему рангу; None для пустой выборки"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                  capture_output=True, text=True, timeout=10).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT_DIR,
+                               capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return f"{revision}-dirty" if revision and dirty else revision or None
+
+
+def default_output(name: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+
+
+def save_results(name: str, results: Dict, config: Optional[Dict] = None, output: Optional[str] = None) -> str:
+    """
+    Сохраняет результаты вместе с ревизией и окружением запуска.
+    output - путь к файлу; по умолчанию bench/results/<name>-<время>.json
+    """
+    path = output or default_output(name)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    document = {
+        "benchmark": name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config or {},
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(document, file, ensure_ascii=False, indent=2)
+    return path
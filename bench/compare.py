@@ -0,0 +1,60 @@
+"""
+Сравнение двух сохраненных запусков бенчмарка (JSON из bench/results/):
+числовые показатели выводятся рядом с изменением в процентах.
+
+Запуск из корня проекта:
+    python bench/compare.py bench/results/load-old.json bench/results/load-new.json
+"""
+import argparse
+import json
+from typing import Dict, Iterator, Tuple
+
+
+def numbers(data, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    """Числовые значения вложенного словаря с путями вида ttfb.segment.p99_ms"""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from numbers(value, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        yield prefix, float(data)
+
+
+def load(path: str) -> Dict:
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    args = parser.parse_args()
+
+    old, new = load(args.old), load(args.new)
+    if old.get("benchmark") != new.get("benchmark"):
+        print(f"внимание: разные бенчмарки ({old.get('benchmark')} и {new.get('benchmark')})")
+    print(f"было:  {old.get('revision')} {old.get('created_at')}")
+    print(f"стало: {new.get('revision')} {new.get('created_at')}")
+    for name in sorted(set(old.get("config", {})) | set(new.get("config", {}))):
+        if old.get("config", {}).get(name) != new.get("config", {}).get(name):
+            print(f"настройка {name}: {old['config'].get(name)} -> {new['config'].get(name)}")
+    print()
+
+    old_values = dict(numbers(old.get("results", {})))
+    new_values = dict(numbers(new.get("results", {})))
+    width = max((len(name) for name in old_values.keys() | new_values.keys()), default=10) + 2
+    print(f"{'показатель':<{width}}{'было':>14}{'стало':>14}{'изменение':>12}")
+    for name in sorted(old_values.keys() | new_values.keys()):
+        before, after = old_values.get(name), new_values.get(name)
+        if before is None or after is None:
+            change = "-"
+        elif before == 0:
+            change = "0%" if after == 0 else "new"
+        else:
+            change = f"{(after - before) / abs(before) * 100:+.1f}%"
+        print(f"{name:<{width}}{'-' if before is None else f'{before:g}':>14}"
+              f"{'-' if after is None else f'{after:g}':>14}{change:>12}")
+
+
+if __name__ == "__main__":
+    main()
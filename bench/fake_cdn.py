@@ -0,0 +1,160 @@
+"""
+Локальный источник для нагрузочных тестов вместо настоящих CDN.
+
+Отдает синтетические живые HLS-каналы: мастер-плейлист с вариантами,
+медиа-плейлисты со сдвигающимся окном и TS-сегменты заданного размера.
+Префиксы пути добавляют поведение проблемных источников и комбинируются:
+
+    /r/<n>/...           цепочка из n редиректов (302)
+    /slow/<мс>/...       задержка перед ответом
+    /fail/<процент>/...  доля ответов 503
+
+Например /r/2/slow/200/live/ch1/master.m3u8. Ссылки в плейлистах
+относительные, поэтому сегменты наследуют префиксы slow и fail
+(редиректы прокси проходит один раз и запоминает конечный адрес).
+
+    /playlist.m3u?channels=N&prefix=/slow/100   плейлист каналов для приложения
+    /_stats                                     счетчики запросов по типам
+    /_reset                                     обнулить счетчики
+
+Запуск: python bench/fake_cdn.py --port 18900 --segment-size 1000000
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from typing import Dict
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response
+from starlette.routing import Route
+
+PLAYLIST_TYPE = "application/vnd.apple.mpegurl"
+
+
+class FakeCdn:
+    def __init__(self, segment_size: int = 500_000, target_duration: int = 2, window: int = 6,
+                 variants: int = 3):
+        self.segment_size = segment_size
+        self.target_duration = target_duration
+        self.window = window
+        self.variants = variants
+        # Один и тот же буфер для всех сегментов: источник не должен быть узким местом
+        self.segment = b"\x47" + bytes(segment_size - 1)
+        self.started = time.time()
+        self.requests: Counter = Counter()
+        self.bytes_sent = 0
+
+    def stats(self) -> Dict:
+        return {
+            "requests": sum(self.requests.values()),
+            "by_kind": dict(self.requests),
+            "bytes_sent": self.bytes_sent,
+        }
+
+    def reset(self):
+        self.requests.clear()
+        self.bytes_sent = 0
+
+    def media_sequence(self) -> int:
+        return int((time.time() - self.started) // self.target_duration)
+
+    def master(self) -> str:
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for variant in range(self.variants):
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={(variant + 1) * 1_000_000},RESOLUTION=1280x720")
+            lines.append(f"v{variant}/index.m3u8")
+        return "\n".join(lines) + "\n"
+
+    def media(self) -> str:
+        first = self.media_sequence()
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{self.target_duration}",
+                 f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        for number in range(first, first + self.window):
+            lines.append(f"#EXTINF:{self.target_duration:.3f},")
+            lines.append(f"seg_{number}.ts")
+        return "\n".join(lines) + "\n"
+
+    def playlist(self, channels: int, prefix: str, base: str) -> str:
+        lines = ["#EXTM3U"]
+        for channel in range(1, channels + 1):
+            lines.append(f'#EXTINF:-1 tvg-id="bench{channel}" group-title="Bench",Bench {channel}')
+            lines.append(f"{base}{prefix}/live/ch{channel}/master.m3u8")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: Request) -> Response:
+        parts = request.url.path.strip("/").split("/")
+        # Префиксы поведения
+        while len(parts) > 2 and parts[0] in ("r", "slow", "fail"):
+            kind, value, rest = parts[0], parts[1], parts[2:]
+            if kind == "r":
+                self.requests["redirect"] += 1
+                hops = int(value) - 1
+                target = ("/r/" + str(hops) if hops > 0 else "") + "/" + "/".join(rest)
+                return RedirectResponse(target + (f"?{request.url.query}" if request.url.query else ""),
+                                        status_code=302)
+            if kind == "slow":
+                await asyncio.sleep(int(value) / 1000)
+            elif random.random() * 100 < float(value):
+                self.requests["failed"] += 1
+                return PlainTextResponse("unavailable", status_code=503)
+            parts = rest
+
+        name = parts[-1]
+        if name == "master.m3u8":
+            return self._send("master", self.master().encode(), PLAYLIST_TYPE)
+        if name == "index.m3u8":
+            return self._send("media", self.media().encode(), PLAYLIST_TYPE)
+        if name.endswith(".ts"):
+            return self._send("segment", self.segment, "video/mp2t")
+        self.requests["not_found"] += 1
+        return PlainTextResponse("not found", status_code=404)
+
+    def _send(self, kind: str, body: bytes, media_type: str) -> Response:
+        self.requests[kind] += 1
+        self.bytes_sent += len(body)
+        return Response(body, media_type=media_type)
+
+
+def create_app(cdn: FakeCdn) -> Starlette:
+    async def playlist(request: Request):
+        channels = int(request.query_params.get("channels", "10"))
+        prefix = request.query_params.get("prefix", "")
+        base = f"{request.url.scheme}://{request.url.netloc}"
+        return PlainTextResponse(cdn.playlist(channels, prefix, base), media_type="audio/x-mpegurl")
+
+    async def stats(request: Request):
+        return JSONResponse(cdn.stats())
+
+    async def reset(request: Request):
+        cdn.reset()
+        return JSONResponse({"status": "ok"})
+
+    return Starlette(routes=[
+        Route("/playlist.m3u", playlist),
+        Route("/_stats", stats),
+        Route("/_reset", reset, methods=["GET", "POST"]),
+        Route("/{path:path}", cdn.handle),
+    ])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Локальный источник HLS для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18900)
+    parser.add_argument("--segment-size", type=int, default=500_000, help="размер TS-сегмента, байт")
+    parser.add_argument("--target-duration", type=int, default=2, help="длительность сегмента, секунд")
+    parser.add_argument("--window", type=int, default=6, help="сегментов в окне живого плейлиста")
+    parser.add_argument("--variants", type=int, default=3, help="вариантов в мастер-плейлисте")
+    args = parser.parse_args()
+
+    cdn = FakeCdn(args.segment_size, args.target_duration, args.window, args.variants)
+    uvicorn.run(create_app(cdn), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
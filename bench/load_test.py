@@ -0,0 +1,308 @@
+"""
+Нагрузочный тест /proxy на локальном источнике (bench/fake_cdn.py).
+
+Запускает источник и приложение (uvicorn main:app) отдельными процессами,
+затем N имитированных HLS-плееров: каждый открывает мастер-плейлист канала
+через /proxy, выбирает вариант и, как настоящий плеер, перечитывает
+медиа-плейлист раз в target duration и загружает новые сегменты.
+
+Отчет: пропускная способность, TTFB (p50/p99) плейлистов и сегментов,
+усиление запросов к источнику (запросов к источнику на запрос зрителя),
+пиковый RSS приложения и задержка его цикла событий (LOOP_LAG_MONITOR).
+Результаты сохраняются в JSON (bench/results/), сравнить два запуска:
+python bench/compare.py old.json new.json
+
+Примеры:
+    python bench/load_test.py --players 50 --channels 5 --duration 30
+    python bench/load_test.py --scenario slow --segment-size 2000000
+    python bench/load_test.py --env RELAY_ENABLED=1 --env UPSTREAM_HTTP2=0
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+from urllib.parse import quote_plus
+
+import httpx
+
+from benchutil import BENCH_DIR, ROOT_DIR, percentile, save_results
+
+# Префиксы источника для сценариев (см. bench/fake_cdn.py)
+SCENARIOS = {
+    "normal": "",
+    "redirect": "/r/3",
+    "slow": "/slow/150",
+    "failing": "/fail/10",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args: List[str], log_path: str, env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    """Вывод процесса пишется в файл: при нагрузке журнал не должен упираться в буфер канала"""
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(args, cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    process.log_path = log_path
+    return process
+
+
+def process_log(process: subprocess.Popen, limit: int = 2000) -> str:
+    try:
+        with open(process.log_path, "rb") as log:
+            return log.read().decode(errors="replace")[-limit:]
+    except OSError:
+        return ""
+
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+async def wait_ready(client: httpx.AsyncClient, url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"процесс завершился: {process_log(process)}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout:.0f}с")
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """Пиковый RSS процесса (VmHWM) по /proc; на других ОС недоступен"""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def histogram_quantile(metrics: str, name: str, q: float) -> Optional[float]:
+    """Квантиль по бакетам гистограммы Prometheus (верхняя граница бакета)"""
+    buckets = []
+    for match in re.finditer(rf'^{name}_bucket\{{[^}}]*le="([^"]+)"[^}}]*\}} (\S+)$', metrics, re.M):
+        buckets.append((float(match.group(1)), float(match.group(2))))
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    total = buckets[-1][1]
+    for bound, count in buckets:
+        if count >= total * q:
+            return bound
+    return None
+
+
+class Recorder:
+    def __init__(self):
+        self.ttfb: Dict[str, List[float]] = {"master": [], "media": [], "segment": []}
+        self.requests = 0
+        self.errors = 0
+        self.statuses: Dict[str, int] = {}
+        self.bytes = 0
+        self.stalls = 0
+
+    def record(self, kind: str, status: int, ttfb: float, size: int):
+        self.requests += 1
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        if status >= 400:
+            self.errors += 1
+            return
+        self.ttfb[kind].append(ttfb)
+        self.bytes += size
+
+
+async def fetch(client: httpx.AsyncClient, recorder: Recorder, kind: str, path: str) -> Optional[bytes]:
+    """Запрос зрителя: TTFB - до первого байта тела"""
+    started = time.perf_counter()
+    try:
+        async with client.stream("GET", path) as response:
+            chunks = []
+            ttfb = None
+            async for chunk in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                chunks.append(chunk)
+            body = b"".join(chunks)
+            recorder.record(kind, response.status_code,
+                            ttfb if ttfb is not None else time.perf_counter() - started, len(body))
+            return body if response.status_code < 400 else None
+    except httpx.HTTPError:
+        recorder.record(kind, 599, 0.0, 0)
+        return None
+
+
+def links(playlist: bytes) -> List[str]:
+    return [line.strip() for line in playlist.decode("utf-8", errors="replace").splitlines()
+            if line.strip() and not line.startswith("#")]
+
+
+async def player(client: httpx.AsyncClient, recorder: Recorder, master_url: str, deadline: float,
+                 target_duration: float, start_delay: float):
+    await asyncio.sleep(start_delay)
+    master = await fetch(client, recorder, "master", "/proxy?url=" + quote_plus(master_url))
+    variants = links(master) if master else []
+    if not variants:
+        return
+    media_path = variants[0]
+    seen = set()
+    while time.monotonic() < deadline:
+        reload_at = time.monotonic() + target_duration
+        playlist = await fetch(client, recorder, "media", media_path)
+        segments = links(playlist) if playlist else []
+        # Как плеер при подключении: начинаем с трех последних сегментов окна
+        fresh = [segment for segment in segments[-3:] if segment not in seen]
+        for segment in fresh:
+            seen.add(segment)
+            if await fetch(client, recorder, "segment", segment) is None:
+                recorder.stalls += 1
+        await asyncio.sleep(max(0.0, reload_at - time.monotonic()))
+
+
+async def run(args) -> Dict:
+    cdn_port, app_port = free_port(), free_port()
+    cdn_url = f"http://127.0.0.1:{cdn_port}"
+    app_url = f"http://127.0.0.1:{app_port}"
+    prefix = SCENARIOS[args.scenario]
+    workdir = tempfile.mkdtemp(prefix="iptv-bench-")
+
+    cdn = start_process([sys.executable, os.path.join(BENCH_DIR, "fake_cdn.py"), "--port", str(cdn_port),
+                         "--segment-size", str(args.segment_size),
+                         "--target-duration", str(args.target_duration)],
+                        os.path.join(workdir, "fake_cdn.log"))
+    env = dict(os.environ,
+               PLAYLIST_SOURCES=f"{cdn_url}/playlist.m3u?channels={args.channels}&prefix={quote_plus(prefix)}",
+               PLAYLIST_SNAPSHOT=os.path.join(workdir, "playlist_snapshot.m3u"),
+               PLAYLIST_LOCAL_FALLBACK="",
+               HEALTH_ENABLED="0",
+               LOOP_LAG_MONITOR="1",
+               LOG_FILE="",
+               LOG_LEVEL="WARNING")
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    app = start_process([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                         "--port", str(app_port), "--log-level", "warning", "--no-access-log"],
+                        os.path.join(workdir, "app.log"), env)
+
+    limits = httpx.Limits(max_connections=args.players * 2, max_keepalive_connections=args.players * 2)
+    try:
+        async with httpx.AsyncClient(timeout=30.0) as control, \
+                httpx.AsyncClient(base_url=app_url, limits=limits, timeout=30.0) as client:
+            await wait_ready(control, f"{cdn_url}/_stats", cdn)
+            await wait_ready(control, f"{app_url}/health", app)
+            await control.post(f"{cdn_url}/_reset")
+
+            recorder = Recorder()
+            started = time.monotonic()
+            deadline = started + args.duration
+            ramp = min(args.target_duration, args.duration / 4)
+            await asyncio.gather(*(
+                player(client, recorder, f"{cdn_url}{prefix}/live/ch{index % args.channels + 1}/master.m3u8",
+                       deadline, args.target_duration, random.uniform(0, ramp))
+                for index in range(args.players)))
+            elapsed = time.monotonic() - started
+
+            upstream = (await control.get(f"{cdn_url}/_stats")).json()
+            metrics = (await control.get(f"{app_url}/metrics")).text
+            app_stats = (await control.get(f"{app_url}/stats")).json()
+            rss = peak_rss_mb(app.pid)
+    finally:
+        stop_process(app)
+        stop_process(cdn)
+
+    def summary(values: List[float]) -> Dict:
+        return {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2) if values else None,
+            "p99_ms": round(percentile(values, 99) * 1000, 2) if values else None,
+        }
+
+    lag_p99 = histogram_quantile(metrics, "iptv_event_loop_lag_seconds", 0.99)
+    lag_max = app_stats.get("logging", {}).get("loop_lag_max")
+    # Редиректы и ошибки источника - тоже запросы к нему
+    upstream_requests = upstream["requests"]
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "viewer_requests": recorder.requests,
+        "errors": recorder.errors,
+        "segment_stalls": recorder.stalls,
+        "statuses": recorder.statuses,
+        "throughput": {
+            "requests_per_s": round(recorder.requests / elapsed, 1),
+            "mbit_per_s": round(recorder.bytes * 8 / elapsed / 1e6, 1),
+        },
+        "ttfb": {kind: summary(values) for kind, values in recorder.ttfb.items()},
+        "upstream": {
+            "requests": upstream_requests,
+            "by_kind": upstream["by_kind"],
+            "amplification": round(upstream_requests / recorder.requests, 3) if recorder.requests else None,
+        },
+        "app": {
+            "peak_rss_mb": round(rss, 1) if rss is not None else None,
+            "loop_lag_p99_ms": round(lag_p99 * 1000, 2) if lag_p99 is not None else None,
+            "loop_lag_max_ms": round(lag_max * 1000, 2) if lag_max is not None else None,
+        },
+    }
+
+
+def print_report(results: Dict):
+    print(f"запросов зрителей: {results['viewer_requests']} за {results['elapsed_s']}с, "
+          f"ошибок: {results['errors']}, сегментов не загружено: {results['segment_stalls']}")
+    throughput = results["throughput"]
+    print(f"пропускная способность: {throughput['requests_per_s']} запросов/с, {throughput['mbit_per_s']} Мбит/с")
+    for kind, values in results["ttfb"].items():
+        print(f"TTFB {kind:<8} p50 {values['p50_ms']} мс, p99 {values['p99_ms']} мс ({values['count']} запросов)")
+    upstream = results["upstream"]
+    print(f"запросов к источнику: {upstream['requests']} {upstream['by_kind']}, "
+          f"на запрос зрителя: {upstream['amplification']}")
+    app = results["app"]
+    print(f"приложение: пиковый RSS {app['peak_rss_mb']} МБ, задержка цикла событий "
+          f"p99 не больше {app['loop_lag_p99_ms']} мс (граница бакета), максимум {app['loop_lag_max_ms']} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /proxy на локальном источнике")
+    parser.add_argument("--players", type=int, default=20, help="имитированных плееров")
+    parser.add_argument("--channels", type=int, default=4, help="каналов, между которыми делятся плееры")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность теста, секунд")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="normal")
+    parser.add_argument("--segment-size", type=int, default=500_000, help="размер сегмента, байт")
+    parser.add_argument("--target-duration", type=int, default=2, help="длительность сегмента, секунд")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="переменная окружения приложения (можно повторять)")
+    parser.add_argument("--seed", type=int, default=1, help="зерно для разброса старта плееров")
+    parser.add_argument("--output", help="файл результатов (по умолчанию bench/results/load-<время>.json)")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = asyncio.run(run(args))
+    print_report(results)
+    config = {name: value for name, value in vars(args).items() if name != "output"}
+    print(f"результаты: {save_results('load', results, config, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+"""Ограниченный по объему кэш плейлистов и сегментов"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from config import env_float, env_int, env_str
+
+
+# Общий бюджет памяти кэша и максимальный размер одного сегмента
+CACHE_MAX_BYTES = env_int("CACHE_MAX_BYTES", 256 * 1024 * 1024)
+SEGMENT_MAX_CACHE_BYTES = env_int("SEGMENT_MAX_CACHE_BYTES", 16 * 1024 * 1024)
+
+# Время жизни по типам содержимого (в секундах)
+CACHE_TTL_MASTER = env_float("CACHE_TTL_MASTER", 60.0)
+CACHE_TTL_MEDIA_DEFAULT = env_float("CACHE_TTL_MEDIA_DEFAULT", 2.0)
+CACHE_TTL_MEDIA_MIN = env_float("CACHE_TTL_MEDIA_MIN", 0.5)
+CACHE_TTL_VOD = env_float("CACHE_TTL_VOD", 600.0)
+CACHE_TTL_SEGMENT = env_float("CACHE_TTL_SEGMENT", 600.0)
+
+# Каталог для вытеснения сегментов на диск (пусто - выключено)
+CACHE_SPILL_DIR = env_str("CACHE_SPILL_DIR", "")
+CACHE_SPILL_MAX_BYTES = env_int("CACHE_SPILL_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+
+# Общий для воркеров кэш (режим WORKERS_SHARED): бюджет файлов в общем каталоге
+# и бюджет памяти каждого воркера поверх него
+SHARED_CACHE_MAX_BYTES = env_int("SHARED_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+SHARED_LOCAL_CACHE_BYTES = env_int("SHARED_LOCAL_CACHE_BYTES", 32 * 1024 * 1024)
+
+TARGET_DURATION_RE = re.compile(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)')
+MIN_UPDATE_PERIOD_RE = re.compile(r'minimumUpdatePeriod="PT(\d+(?:\.\d+)?)S"')
+
+
+# Параметры, которые не влияют на ответ и не должны попадать в ключ
+IGNORED_QUERY_PARAMS = frozenset(('_nocache',))
+
+
+def canonical_cache_key(url: str, vary: Optional[Dict[str, str]] = None) -> str:
+    """
+    Ключ кэша, общий для всех зрителей: URL без параметров-«пробойников»
+    плюс только те заголовки запроса, которые действительно меняют ответ.
+    """
+    parts = urlsplit(url)
+    query = parts.query
+    if query and any(param in query for param in IGNORED_QUERY_PARAMS):
+        query = urlencode([(k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+                           if k not in IGNORED_QUERY_PARAMS])
+    key = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+    if vary:
+        key += ''.join(f"|{name.lower()}={value}" for name, value in sorted(vary.items()))
+    return key
+
+
+def classify_manifest(text: str) -> str:
+    """Тип плейлиста для выбора TTL: master, media или vod"""
+    if '#EXT-X-STREAM-INF' in text:
+        return "master"
+    if '#EXT-X-ENDLIST' in text:
+        return "vod"
+    if '<MPD' in text:
+        return "media" if 'type="dynamic"' in text else "master"
+    return "media"
+
+
+def media_playlist_ttl(text: str) -> float:
+    """
+    Живой плейлист обновляется раз в target duration,
+    поэтому кэшируем его на половину этого времени.
+    """
+    match = TARGET_DURATION_RE.search(text) or MIN_UPDATE_PERIOD_RE.search(text)
+    if not match:
+        return CACHE_TTL_MEDIA_DEFAULT
+    return max(CACHE_TTL_MEDIA_MIN, float(match.group(1)) / 2)
+
+
+def manifest_ttl(kind: str, text: str) -> float:
+    if kind == "master":
+        return CACHE_TTL_MASTER
+    if kind == "vod":
+        return CACHE_TTL_VOD
+    return media_playlist_ttl(text)
+
+
+class CacheEntry:
+    __slots__ = ('body', 'headers', 'status_code', 'content_type', 'kind', 'expires', 'size', 'url')
+
+    def __init__(self, body: bytes, headers: Dict[str, str], status_code: int,
+                 content_type: str, kind: str, expires: float, url: Optional[str] = None):
+        self.body = body
+        self.headers = headers
+        self.status_code = status_code
+        self.content_type = content_type
+        self.kind = kind
+        self.expires = expires
+        self.size = len(body)
+        # Конечный адрес ответа после редиректов (для плейлистов)
+        self.url = url
+
+
+class _SpilledEntry:
+    """Метаданные сегмента, вытесненного на диск (тело лежит в файле)"""
+    __slots__ = ('path', 'headers', 'status_code', 'content_type', 'expires', 'size')
+
+    def __init__(self, path: str, entry: CacheEntry):
+        self.path = path
+        self.headers = entry.headers
+        self.status_code = entry.status_code
+        self.content_type = entry.content_type
+        self.expires = entry.expires
+        self.size = entry.size
+
+
+class SharedStore:
+    """
+    Кэш ответов в каталоге, общем для всех воркеров (лучше на tmpfs, /dev/shm):
+    по файлу на ключ, в первой строке - метаданные ответа в JSON, дальше тело.
+    Время истечения записывается в mtime файла, поэтому проверка свежести -
+    один stat. Файл пишется во временный и подменяется целиком, читатели
+    не видят его недописанным. Просроченные файлы и превышение бюджета
+    убирает sweep(), его вызывает один воркер.
+
+    Методы синхронные, из цикла событий вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = SHARED_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.reads = 0
+        self.writes = 0
+        self.sweeps = 0
+        self.swept = 0
+        self.entries = 0
+        self.bytes = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".seg")
+
+    def contains(self, key: str) -> bool:
+        try:
+            return os.stat(self.path(key)).st_mtime > time.time()
+        except OSError:
+            return False
+
+    def read(self, key: str) -> Optional[CacheEntry]:
+        try:
+            with open(self.path(key), "rb") as f:
+                expires = os.fstat(f.fileno()).st_mtime
+                if expires <= time.time():
+                    return None
+                meta = json.loads(f.readline())
+                if meta.get("key") != key:
+                    return None
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        self.reads += 1
+        return CacheEntry(body, meta["headers"], meta["status_code"], meta["content_type"],
+                          meta["kind"], expires, meta.get("url"))
+
+    def write(self, key: str, entry: CacheEntry):
+        path = self.path(key)
+        meta = {
+            "key": key,
+            "headers": entry.headers,
+            "status_code": entry.status_code,
+            "content_type": entry.content_type,
+            "kind": entry.kind,
+            "url": entry.url,
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n")
+                f.write(entry.body)
+            os.utime(tmp_path, (entry.expires, entry.expires))
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self.writes += 1
+
+    def sweep(self) -> Tuple[int, int]:
+        """Удаляет просроченные записи, затем ближайшие к истечению сверх бюджета"""
+        now = time.time()
+        alive = []
+        removed = 0
+        for item in os.scandir(self.directory):
+            try:
+                stat = item.stat()
+            except OSError:
+                continue
+            if item.name.endswith(".tmp"):
+                # Недописанный файл упавшего воркера
+                if stat.st_ctime < now - 60:
+                    removed += self._remove(item.path)
+            elif stat.st_mtime <= now:
+                removed += self._remove(item.path)
+            else:
+                alive.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in alive)
+        if total > self.max_bytes:
+            alive.sort()
+            while alive and total > self.max_bytes:
+                _, size, path = alive.pop(0)
+                total -= size
+                removed += self._remove(path)
+        self.sweeps += 1
+        self.swept += removed
+        self.entries = len(alive)
+        self.bytes = total
+        return removed, total
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def clear(self) -> int:
+        count = 0
+        for item in os.scandir(self.directory):
+            count += self._remove(item.path)
+        self.entries = 0
+        self.bytes = 0
+        return count
+
+    def stats(self) -> Dict:
+        return {
+            "directory": self.directory,
+            "max_bytes": self.max_bytes,
+            # По последнему обходу (его делает только ведущий воркер)
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "reads": self.reads,
+            "writes": self.writes,
+            "sweeps": self.sweeps,
+            "swept": self.swept,
+        }
+
+
+class ResponseCache:
+    """
+    LRU-кэш ответов с бюджетом в байтах и TTL для каждой записи.
+    Вытесненные из памяти сегменты при наличии spill_dir
+    сохраняются на диск со своим бюджетом.
+
+    С shared (SharedStore) каждый ответ также записывается в общий для
+    воркеров каталог, и промах в памяти проверяется там: источник получает
+    один запрос на все воркеры, а память воркера - только верхний уровень.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES,
+                 spill_dir: str = CACHE_SPILL_DIR,
+                 spill_max_bytes: int = CACHE_SPILL_MAX_BYTES,
+                 shared: Optional[SharedStore] = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir or None
+        self.spill_max_bytes = spill_max_bytes
+        self.shared = shared
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._spilled: "OrderedDict[str, _SpilledEntry]" = OrderedDict()
+        self.bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spills = 0
+        self.shared_hits = 0
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self._purge_spill_dir()
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._spilled)
+
+    def __contains__(self, key: str) -> bool:
+        """Есть ли свежая запись; в статистику попаданий не входит"""
+        entry = self._entries.get(key) or self._spilled.get(key)
+        if entry is not None and entry.expires > time.time():
+            return True
+        return self.shared is not None and self.shared.contains(key)
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+            self.expirations += 1
+
+        spilled = self._spilled.get(key)
+        if spilled is not None:
+            if spilled.expires > now:
+                body = await asyncio.to_thread(self._read_file, spilled.path)
+                if body is not None and key in self._spilled:
+                    self._drop_spilled(key)
+                    entry = CacheEntry(body, spilled.headers, spilled.status_code,
+                                       spilled.content_type, "segment", spilled.expires)
+                    await self._store(key, entry)
+                    self.disk_hits += 1
+                    return entry
+            if key in self._spilled:
+                self._drop_spilled(key)
+                self.expirations += 1
+
+        if self.shared is not None:
+            entry = await asyncio.to_thread(self.shared.read, key)
+            if entry is not None:
+                # Ответ уже получил другой воркер
+                if entry.size <= self.max_bytes:
+                    await self._store(key, entry)
+                self.shared_hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, body: bytes, headers: Dict[str, str], status_code: int,
+                  content_type: str, kind: str, ttl: Optional[float] = None,
+                  url: Optional[str] = None) -> CacheEntry:
+        """Сохраняет ответ; при ttl <= 0 запись только создается, но не кэшируется"""
+        if ttl is None:
+            ttl = CACHE_TTL_SEGMENT if kind == "segment" else CACHE_TTL_MASTER
+        entry = CacheEntry(body, headers, status_code, content_type, kind, time.time() + ttl, url)
+        if ttl > 0 and entry.size <= self.max_bytes:
+            await self._store(key, entry)
+        if ttl > 0 and self.shared is not None and entry.size <= self.shared.max_bytes:
+            await asyncio.to_thread(self.shared.write, key, entry)
+        return entry
+
+    async def _store(self, key: str, entry: CacheEntry):
+        if key in self._entries:
+            self._remove(key)
+        if key in self._spilled:
+            self._drop_spilled(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+
+        # Вытесняем самые давно использованные записи
+        now = time.time()
+        while self.bytes > self.max_bytes and self._entries:
+            old_key, old_entry = self._entries.popitem(last=False)
+            self.bytes -= old_entry.size
+            self.evictions += 1
+            if self.spill_dir and old_entry.kind == "segment" and old_entry.expires > now:
+                await self._spill(old_key, old_entry)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    async def _spill(self, key: str, entry: CacheEntry):
+        if entry.size > self.spill_max_bytes:
+            return
+        path = os.path.join(self.spill_dir, hashlib.sha1(key.encode()).hexdigest() + ".seg")
+        try:
+            await asyncio.to_thread(self._write_file, path, entry.body)
+        except OSError:
+            return
+        # Пока файл писался, запись могла снова попасть в память
+        if key in self._entries:
+            return
+        if key in self._spilled:
+            self._drop_spilled(key)
+        self._spilled[key] = _SpilledEntry(path, entry)
+        self.disk_bytes += entry.size
+        self.spills += 1
+        while self.disk_bytes > self.spill_max_bytes and self._spilled:
+            self._drop_spilled(next(iter(self._spilled)))
+
+    def _drop_spilled(self, key: str):
+        spilled = self._spilled.pop(key)
+        self.disk_bytes -= spilled.size
+        try:
+            os.remove(spilled.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _write_file(path: str, body: bytes):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_file(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _purge_spill_dir(self):
+        for name in os.listdir(self.spill_dir):
+            if name.endswith((".seg", ".tmp")):
+                try:
+                    os.remove(os.path.join(self.spill_dir, name))
+                except OSError:
+                    pass
+
+    async def clear(self, local_only: bool = False) -> int:
+        """
+        Очищает кэш, возвращает число удаленных записей.
+        local_only - только память и диск этого воркера, без общего каталога.
+        Файлы удаляются в рабочем потоке
+        """
+        count = len(self)
+        self._entries.clear()
+        self.bytes = 0
+        paths = [spilled.path for spilled in self._spilled.values()]
+        self._spilled.clear()
+        self.disk_bytes = 0
+        if paths:
+            await asyncio.to_thread(self._remove_files, paths)
+        if self.shared is not None and not local_only:
+            count += await asyncio.to_thread(self.shared.clear)
+        return count
+
+    @staticmethod
+    def _remove_files(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.disk_hits + self.shared_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "shared_hits": self.shared_hits,
+            "hit_ratio": round((self.hits + self.disk_hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spilled_entries": len(self._spilled),
+            "disk_bytes": self.disk_bytes,
+            "spills": self.spills,
+            "shared": self.shared.stats() if self.shared is not None else None,
+        }
@@ -0,0 +1,295 @@
+"""Каталог каналов: M3U-плейлист, разобранный один раз при обновлении"""
+import hashlib
+import json
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from cache import canonical_cache_key
+from httputil import compress_variants
+from profiles import HeaderProfile, profile_headers
+
+DEFAULT_GROUP = "Без категории"
+
+# key="value" в строках #EXTM3U и #EXTINF
+ATTR_RE = re.compile(r'([\w-]+)="([^"]*)"')
+
+
+def normalize_text(text: str) -> str:
+    """Регистронезависимая форма для поиска; «ё» и «е» не различаются"""
+    return text.casefold().replace('ё', 'е')
+
+
+class SearchIndex:
+    """
+    Индекс n-грамм (1-3 символа) по названиям каналов.
+    Запрос до трех символов - одна выборка из словаря, длиннее -
+    пересечение списков триграмм и проверка подстроки у кандидатов.
+    """
+
+    def __init__(self, names: Sequence[str]):
+        self.names = [normalize_text(name) for name in names]
+        self.grams: Dict[str, List[int]] = {}
+        for pos, name in enumerate(self.names):
+            seen = set()
+            for size in (1, 2, 3):
+                for i in range(len(name) - size + 1):
+                    gram = name[i:i + size]
+                    if gram not in seen:
+                        seen.add(gram)
+                        self.grams.setdefault(gram, []).append(pos)
+
+    def search(self, query: str) -> List[int]:
+        """Позиции каналов, в названии которых есть query; сначала совпадения с начала"""
+        q = normalize_text(query).strip()
+        if not q:
+            return list(range(len(self.names)))
+        if len(q) <= 3:
+            found = self.grams.get(q, [])
+        else:
+            postings = sorted((self.grams.get(q[i:i + 3], []) for i in range(len(q) - 2)), key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(posting)
+            found = [pos for pos in sorted(candidates) if q in self.names[pos]]
+        names = self.names
+        return sorted(found, key=lambda pos: not names[pos].startswith(q))
+
+
+class Channel:
+    __slots__ = ('id', 'name', 'group', 'logo', 'url', 'attrs', 'vlc_opts', 'profile', 'mirrors')
+
+    def __init__(self, channel_id: str, name: str, attrs: Dict[str, str]):
+        self.id = channel_id
+        self.name = name
+        self.attrs = attrs
+        self.group = attrs.get('group-title') or DEFAULT_GROUP
+        self.logo = attrs.get('tvg-logo') or None
+        self.url = ""
+        # Опции из #EXTVLCOPT, например http-user-agent
+        self.vlc_opts: Dict[str, str] = {}
+        # Заголовки для источника (User-Agent, Referer, Origin), если заданы
+        self.profile: Optional[HeaderProfile] = None
+        # Тот же канал из менее приоритетных плейлистов (при объединении источников)
+        self.mirrors: List["Channel"] = []
+
+    def copy(self, channel_id: str) -> "Channel":
+        """Копия с другим id: каталоги не делят изменяемые записи"""
+        channel = Channel(channel_id, self.name, self.attrs)
+        channel.url = self.url
+        channel.vlc_opts = self.vlc_opts
+        channel.profile = self.profile
+        return channel
+
+    @property
+    def tvg_key(self) -> Optional[str]:
+        """tvg-id вместе с названием: один tvg-id часто стоит у совсем разных каналов"""
+        return f"tvg:{self.tvg_id}|{normalize_text(self.name)}" if self.tvg_id else None
+
+    def dedup_keys(self) -> List[str]:
+        """Признаки одного и того же канала в разных плейлистах"""
+        keys = [canonical_cache_key(self.url)]
+        if self.tvg_key:
+            keys.append(self.tvg_key)
+        return keys
+
+    @property
+    def tvg_id(self) -> Optional[str]:
+        return self.attrs.get('tvg-id')
+
+    @property
+    def catchup(self) -> Dict[str, str]:
+        return {k: v for k, v in self.attrs.items() if k.startswith('catchup')}
+
+    def to_dict(self, health: Optional[Dict] = None) -> Dict:
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "group": self.group,
+            "logo": self.logo,
+            "logo_thumb": f"/logo/{self.id}?v={logo_version(self.logo)}" if self.logo else None,
+            "url": self.url,
+        }
+        if health is not None:
+            data["health"] = health
+        return data
+
+
+def logo_version(url: str) -> str:
+    """Версия в адресе /logo/{id}: меняется вместе с адресом логотипа канала"""
+    return hashlib.sha1(url.encode()).hexdigest()[:12]
+
+
+def parse_extinf(line: str):
+    """Разбирает '#EXTINF:-1 key="value" ...,Название' на атрибуты и название"""
+    body = line[len('#EXTINF:'):]
+    # Название идет после запятой, стоящей за последним атрибутом
+    last_quote = body.rfind('"')
+    comma = body.find(',', last_quote + 1 if last_quote >= 0 else 0)
+    if comma < 0:
+        return None, None
+    return dict(ATTR_RE.findall(body[:comma])), body[comma + 1:].strip()
+
+
+class Catalog:
+    """
+    Неизменяемый снимок плейлиста. Новый каталог строится целиком
+    и подменяет старый одним присваиванием.
+    """
+
+    def __init__(self, channels: List[Channel], header: Dict[str, str],
+                 version: str, updated_at: float):
+        self.channels = channels
+        self.header = header
+        self.version = version
+        self.updated_at = updated_at
+        self.by_id: Dict[str, Channel] = {channel.id: channel for channel in channels}
+        # Профили зеркал тоже: зритель может быть направлен на любое из них
+        self.profiles: Dict[str, HeaderProfile] = {
+            entry.profile.id: entry.profile
+            for channel in channels for entry in (channel, *channel.mirrors) if entry.profile is not None}
+        self.groups: Dict[str, List[Channel]] = {}
+        # Каналы с одинаковыми tvg-id и названием - зеркала друг друга
+        self.by_tvg: Dict[str, List[Channel]] = {}
+        for channel in channels:
+            self.groups.setdefault(channel.group, []).append(channel)
+            if channel.tvg_key:
+                self.by_tvg.setdefault(channel.tvg_key, []).append(channel)
+        self.search_index = SearchIndex([channel.name for channel in channels])
+        # Готовые ответы /api/channels и /api/groups во всех кодировках
+        self.channels_payload = compress_variants(self.build_channels_payload())
+        self.groups_payload = compress_variants(self._build_groups_payload())
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def get(self, channel_id: str) -> Optional[Channel]:
+        return self.by_id.get(channel_id)
+
+    def alternatives(self, channel: Channel) -> List[Channel]:
+        """Сам канал и его зеркала: из других источников и записи с тем же tvg-id"""
+        found = [channel]
+        for other in self.by_tvg.get(channel.tvg_key, []) if channel.tvg_key else []:
+            if other is not channel:
+                found.append(other)
+        for candidate in list(found):
+            found.extend(candidate.mirrors)
+        return found
+
+    def profile(self, profile_id: Optional[str]) -> Optional[HeaderProfile]:
+        return self.profiles.get(profile_id) if profile_id else None
+
+    def query(self, group: Optional[str] = None, q: Optional[str] = None) -> List[Channel]:
+        """Каналы группы group, в названии которых встречается q"""
+        if q:
+            found = [self.channels[pos] for pos in self.search_index.search(q)]
+            if group:
+                found = [channel for channel in found if channel.group == group]
+            return found
+        if group:
+            return self.groups.get(group, [])
+        return self.channels
+
+    def _build_groups_payload(self) -> bytes:
+        content = {
+            "version": self.version,
+            "groups": [{"name": group, "count": len(members)} for group, members in self.groups.items()],
+            "total": len(self.channels),
+            "last_update": self.updated_at,
+        }
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def build_channels_payload(self, health: Optional[Callable[[Channel], Optional[Dict]]] = None) -> bytes:
+        """
+        JSON для /api/channels, кодируется один раз на версию плейлиста
+        (и на версию результатов проверки каналов, если передан health).
+        Категории ссылаются на id каналов, а не повторяют их целиком.
+        """
+        content = {
+            "version": self.version,
+            "channels": [channel.to_dict(health(channel) if health else None) for channel in self.channels],
+            "categories": {group: [channel.id for channel in members]
+                           for group, members in self.groups.items()},
+            "last_update": self.updated_at,
+        }
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def parse_channels(content: str) -> Tuple[List[Channel], Dict[str, str]]:
+    """Разбирает текст M3U: каналы по порядку и атрибуты строки #EXTM3U"""
+    channels: List[Channel] = []
+    header: Dict[str, str] = {}
+    channel: Optional[Channel] = None
+    channel_id = 0
+    profiles: Dict[str, HeaderProfile] = {}
+
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXTINF:'):
+            attrs, name = parse_extinf(line)
+            if attrs is None:
+                continue
+            channel_id += 1
+            channel = Channel(str(channel_id), name, attrs)
+        elif line.startswith('#EXTVLCOPT:'):
+            if channel is not None:
+                key, _, value = line[len('#EXTVLCOPT:'):].partition('=')
+                channel.vlc_opts[key.strip()] = value.strip()
+        elif line.startswith('#EXTM3U'):
+            header = dict(ATTR_RE.findall(line))
+        elif line.startswith('#'):
+            continue
+        elif channel is not None:
+            channel.url = line
+            headers = profile_headers(channel.attrs, channel.vlc_opts)
+            if headers:
+                # Одинаковые профили разных каналов - один объект
+                profile = HeaderProfile(headers)
+                channel.profile = profiles.setdefault(profile.id, profile)
+            channels.append(channel)
+            channel = None
+
+    return channels, header
+
+
+def playlist_version(content: str) -> str:
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def parse_playlist(content: str, updated_at: float) -> Catalog:
+    """Разбирает текст M3U в каталог каналов"""
+    channels, header = parse_channels(content)
+    return Catalog(channels, header, playlist_version(content), updated_at)
+
+
+def merge_playlists(playlists: Sequence[Tuple[List[Channel], Dict[str, str]]],
+                    version: str, updated_at: float) -> Catalog:
+    """
+    Объединяет разобранные плейлисты в один каталог в порядке приоритета.
+    Канал, который уже есть в более приоритетном плейлисте (тот же адрес
+    или tvg-id с названием), не повторяется и становится зеркалом первого.
+    Внутри одного плейлиста каналы не объединяются.
+    """
+    channels: List[Channel] = []
+    header: Dict[str, str] = {}
+    seen: Dict[str, Channel] = {}
+    for source_channels, source_header in playlists:
+        for name, value in source_header.items():
+            header.setdefault(name, value)
+        added: Dict[str, Channel] = {}
+        for source_channel in source_channels:
+            keys = source_channel.dedup_keys()
+            original = next((seen[key] for key in keys if key in seen), None)
+            if original is not None:
+                original.mirrors.append(source_channel)
+                continue
+            channel = source_channel.copy(str(len(channels) + 1))
+            channels.append(channel)
+            for key in keys:
+                added.setdefault(key, channel)
+        for key, channel in added.items():
+            seen.setdefault(key, channel)
+    return Catalog(channels, header, version, updated_at)
@@ -0,0 +1,179 @@
+"""Объединение одновременных одинаковых запросов к источникам (single-flight)"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class _Flight:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Первый запрос по ключу запускает загрузку в отдельной задаче,
+    остальные ждут тот же результат. Отключение любого из зрителей,
+    включая первого, не прерывает загрузку для остальных.
+
+    Результат можно оставить доступным и после завершения factory (hold):
+    например, открытый ответ, тело которого еще скачивается.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._held: Dict[str, Any] = {}
+        self.hosts: Dict[str, Dict[str, int]] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights or key in self._held
+
+    def hold(self, key: str, result: Any, until: asyncio.Future):
+        """Новые вызовы do(key) получают result, пока не завершится until"""
+        self._held[key] = result
+
+        def release(_):
+            if self._held.get(key) is result:
+                del self._held[key]
+
+        until.add_done_callback(release)
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: str, host: str, factory: Callable[[], Awaitable[Any]],
+                 on_orphan: Optional[Callable[[Any], None]] = None) -> Any:
+        """
+        Выполняет factory() один раз для всех одновременных вызовов с ключом key.
+        on_orphan получает результат, если к моменту готовности его уже никто не ждет.
+        """
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = self.hosts[host] = {"leaders": 0, "coalesced": 0}
+
+        flight = self._flights.get(key)
+        if flight is None and key in self._held:
+            stats["coalesced"] += 1
+            return self._held[key]
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight, on_orphan))
+            stats["leaders"] += 1
+        else:
+            stats["coalesced"] += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key: str, flight: _Flight, on_orphan):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        task = flight.task
+        if task.cancelled() or task.exception() is not None:
+            return
+        if flight.waiters == 0 and on_orphan is not None:
+            on_orphan(task.result())
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._flights),
+            "held": len(self._held),
+            "leaders": sum(s["leaders"] for s in self.hosts.values()),
+            "coalesced": sum(s["coalesced"] for s in self.hosts.values()),
+            "hosts": self.hosts,
+        }
+
+
+class SharedBody:
+    """
+    Тело ответа, которое скачивается из источника один раз и читается
+    любым числом зрителей: каждый получает все фрагменты с начала,
+    в том числе подключившись посреди загрузки.
+    """
+
+    def __init__(self, response, exit_stack, chunk_size: int,
+                 on_complete: Optional[Callable[[bytes], Awaitable[None]]] = None):
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._event = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(response, exit_stack, chunk_size, on_complete))
+
+    async def _pump(self, response, exit_stack, chunk_size, on_complete):
+        completed = False
+        try:
+            async for chunk in response.aiter_bytes(chunk_size):
+                self.chunks.append(chunk)
+                self.size += len(chunk)
+                self._wake()
+            completed = True
+        except Exception as e:
+            self.error = e
+        finally:
+            if not completed and self.error is None:
+                self.error = ConnectionError("Загрузка из источника прервана")
+            self.done = True
+            self._wake()
+            await exit_stack.aclose()
+        if self.error is None and on_complete is not None:
+            await on_complete(b''.join(self.chunks))
+
+    def _wake(self):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def iter_chunks(self):
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._event.wait()
+
+
+class UpstreamHandle:
+    """
+    Открытый ответ источника. Тело либо разделяется между зрителями
+    (shared), либо принадлежит одному зрителю, забравшему его через claim().
+    """
+
+    def __init__(self, response, headers: Dict[str, str], status_code: int, exit_stack):
+        self.response = response
+        self.headers = headers
+        self.status_code = status_code
+        self.content_type = response.headers.get('content-type', '').lower()
+        self.exit_stack = exit_stack
+        self.shared: Optional[SharedBody] = None
+        self._claimed = False
+
+    @property
+    def content_length(self) -> Optional[int]:
+        value = self.response.headers.get('content-length')
+        return int(value) if value and value.isdigit() else None
+
+    def share(self, chunk_size: int, on_complete=None) -> SharedBody:
+        self.shared = SharedBody(self.response, self.exit_stack, chunk_size, on_complete)
+        return self.shared
+
+    def claim(self) -> bool:
+        """Забирает неразделяемый ответ; удается только одному зрителю"""
+        if self.shared is not None or self._claimed:
+            return False
+        self._claimed = True
+        return True
+
+    def discard(self):
+        """Закрывает ответ, который так никто и не забрал"""
+        if self.shared is None and not self._claimed:
+            self._claimed = True
+            asyncio.ensure_future(self.exit_stack.aclose())
@@ -0,0 +1,33 @@
+"""Чтение настроек из переменных окружения"""
+import os
+from typing import List
+
+
+def env_str(name: str, default: str = "") -> str:
+    return os.getenv(name, default)
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_list(name: str, default: str = "") -> List[str]:
+    """Список через запятую: 'a.com, b.com' -> ['a.com', 'b.com']"""
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
@@ -0,0 +1,353 @@
+"""Переписывание DASH-манифестов (MPD): все ссылки направляются через /proxy"""
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote_plus, urljoin
+from xml.sax.saxutils import escape, unescape
+
+from hls_rewriter import PROXY_PREFIX, proxied_url
+
+# Сколько манифестов помнить для повторной отдачи готового результата
+MAX_MANIFEST_STATES = 1024
+
+# Атрибуты со ссылками по элементам (без префикса пространства имен)
+URL_ATTRIBUTES = {
+    'SegmentTemplate': ('media', 'initialization', 'index', 'bitstreamSwitching'),
+    'SegmentURL': ('media', 'index'),
+    'Initialization': ('sourceURL',),
+    'RepresentationIndex': ('sourceURL',),
+    'BitstreamSwitching': ('sourceURL',),
+    'MPD': (),
+    'Period': ('xlink:href',),
+    'AdaptationSet': ('xlink:href',),
+    'Representation': (),
+}
+
+# Элементы, у которых может быть свой BaseURL
+SCOPE_ELEMENTS = frozenset(('MPD', 'Period', 'AdaptationSet', 'Representation'))
+# Элементы, текст которых - ссылка
+TEXT_ELEMENTS = frozenset(('BaseURL', 'Location', 'PatchLocation'))
+
+# Только нужные элементы, комментарии и CDATA; остальное (в том числе тысячи <S>
+# из SegmentTimeline) пропускается движком регулярных выражений без разбора
+TOKEN_RE = re.compile(
+    r'<!--.*?-->|<!\[CDATA\[.*?\]\]>'
+    r'|<(/?)((?:[\w.-]+:)?(' + '|'.join(sorted(set(URL_ATTRIBUTES) | TEXT_ELEMENTS)) + r'))(?=[\s/>])'
+    r'((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>',
+    re.DOTALL)
+ATTRIBUTE_RE = re.compile(r'(\s)([\w.:-]+)(\s*=\s*)(?:"([^"]*)"|\'([^\']*)\')')
+MPD_TAG_RE = re.compile(r'<(?:[\w.-]+:)?MPD(?=[\s/>])((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+# Подстановки шаблона: $Number$, $Number%05d$, $RepresentationID$, $$
+TEMPLATE_TOKEN_RE = re.compile(r'(\$[A-Za-z]*(?:%0\d+[diuxX])?\$)')
+
+ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+
+@lru_cache(maxsize=65536)
+def proxied_template(base_url: str, template: str, suffix: str = '') -> Optional[str]:
+    """
+    Ссылка через прокси для шаблона SegmentTemplate: идентификаторы $...$
+    остаются как есть, чтобы плеер подставил в них номер или время сегмента.
+    """
+    if '$' not in template:
+        return proxied_url(base_url, template, suffix)
+    full_url = urljoin(base_url, template)
+    if not full_url.startswith(('http://', 'https://')):
+        return None
+    parts = TEMPLATE_TOKEN_RE.split(full_url)
+    return PROXY_PREFIX + ''.join(part if index % 2 else quote_plus(part)
+                                  for index, part in enumerate(parts)) + suffix
+
+
+def mpd_attributes(content: str) -> Tuple[bool, Optional[str]]:
+    """Динамический ли манифест и его publishTime - по корневому элементу"""
+    match = MPD_TAG_RE.search(content)
+    if match is None:
+        return False, None
+    dynamic, publish_time = False, None
+    for attr in ATTRIBUTE_RE.finditer(' ' + match.group(1)):
+        value = attr.group(4) if attr.group(4) is not None else attr.group(5)
+        if attr.group(2) == 'type':
+            dynamic = value.strip() == 'dynamic'
+        elif attr.group(2) == 'publishTime':
+            publish_time = value.strip()
+    return dynamic, publish_time
+
+
+def template_links(attributes: str) -> Dict[str, str]:
+    """Ссылки SegmentTemplate в исходном виде"""
+    names = URL_ATTRIBUTES['SegmentTemplate']
+    return {attr.group(2): unescape(attr.group(4) if attr.group(4) is not None else attr.group(5)).strip()
+            for attr in ATTRIBUTE_RE.finditer(attributes) if attr.group(2) in names}
+
+
+def _drop_indent(out: List[str], end: int):
+    """Удаляет отступ и перевод строки перед удаленным элементом (out[end - 1])"""
+    if end > 0:
+        previous = out[end - 1].rstrip(' \t')
+        if previous.endswith('\n'):
+            out[end - 1] = previous[:-1].rstrip('\r')
+
+
+class DashResult:
+    __slots__ = ('body', 'dynamic', 'elapsed', 'reused', 'rewritten')
+
+    def __init__(self, body: bytes, dynamic: bool, elapsed: float, reused: bool = False, rewritten: int = 0):
+        self.body = body
+        self.dynamic = dynamic
+        self.elapsed = elapsed
+        self.reused = reused
+        self.rewritten = rewritten
+
+
+class ManifestState:
+    __slots__ = ('source', 'base', 'publish_time', 'result')
+
+    def __init__(self, source: str, base: str, publish_time: Optional[str], result: DashResult):
+        self.source = source
+        self.base = base
+        self.publish_time = publish_time
+        self.result = result
+
+
+class _Scope:
+    """
+    Открытый элемент MPD/Period/AdaptationSet/Representation и его базовый адрес.
+    template - ссылки SegmentTemplate, действующие в элементе (как в манифесте,
+    с наследованием от родителей), template_base - адрес, от которого они
+    разрешены в выводе.
+    """
+    __slots__ = ('name', 'inherited', 'base', 'has_base', 'template', 'template_base',
+                 'own_template', 'template_slot', 'prefix')
+
+    def __init__(self, name: str, base: str, parent: Optional["_Scope"] = None):
+        self.name = name
+        self.inherited = base
+        self.base = base
+        self.has_base = False
+        self.template: Dict[str, str] = parent.template if parent is not None else {}
+        self.template_base = parent.template_base if parent is not None else base
+        self.own_template = False
+        # Место в выводе для собственного SegmentTemplate элемента
+        self.template_slot = -1
+        self.prefix = ''
+
+
+class DashRewriter:
+    """
+    Переписывает MPD за один проход по нужным элементам, сохраняя остальной
+    текст манифеста байт в байт.
+
+    Базовые адреса вычисляются по иерархии BaseURL (MPD > Period > AdaptationSet >
+    Representation), и все ссылки (SegmentTemplate, SegmentList/SegmentURL,
+    Initialization, RepresentationIndex, Location) становятся абсолютными
+    ссылками /proxy. BaseURL-каталоги после этого не нужны и удаляются:
+    иначе плеер разрешал бы /proxy относительно хоста источника. BaseURL,
+    указывающий на файл (SegmentBase), заменяется ссылкой через прокси.
+
+    Если у элемента свой BaseURL-каталог, а SegmentTemplate унаследован
+    от родителя (например, общий шаблон AdaptationSet и BaseURL у каждой
+    Representation), на месте BaseURL выводится собственный SegmentTemplate
+    элемента со ссылками шаблона, разрешенными от его каталога; остальные
+    атрибуты плеер по-прежнему наследует от родительского шаблона.
+
+    Готовый результат хранится по адресу манифеста: статический MPD
+    переписывается заново только при изменении текста, динамический -
+    при изменении publishTime.
+    """
+
+    def __init__(self, max_states: int = MAX_MANIFEST_STATES):
+        self.max_states = max_states
+        self._states: "OrderedDict[str, ManifestState]" = OrderedDict()
+        self.rewrites = 0
+        self.reuses = 0
+        self.urls_rewritten = 0
+        self.base_urls_resolved = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def rewrite(self, content: str, mpd_url: str, suffix: str = '',
+                base_url: Optional[str] = None) -> DashResult:
+        """
+        suffix добавляется к каждой ссылке /proxy (профиль заголовков канала).
+        base_url - конечный адрес манифеста после редиректов, относительно
+        которого разрешаются ссылки; готовый результат хранится по mpd_url.
+        """
+        started = time.perf_counter()
+        base = base_url or mpd_url
+        key = mpd_url + suffix
+        dynamic, publish_time = mpd_attributes(content)
+
+        state = self._states.get(key)
+        if state is not None and state.base == base and (
+                state.source == content or (dynamic and publish_time and state.publish_time == publish_time)):
+            self._states.move_to_end(key)
+            self.reuses += 1
+            cached = state.result
+            return DashResult(cached.body, cached.dynamic, time.perf_counter() - started, reused=True)
+
+        body, rewritten = self._render(content, base, suffix)
+        elapsed = time.perf_counter() - started
+        result = DashResult(body.encode('utf-8'), dynamic, elapsed, rewritten=rewritten)
+
+        self._states[key] = ManifestState(content, base, publish_time, result)
+        self._states.move_to_end(key)
+        if len(self._states) > self.max_states:
+            self._states.popitem(last=False)
+
+        self.rewrites += 1
+        self.urls_rewritten += rewritten
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return result
+
+    def _render(self, content: str, base: str, suffix: str) -> Tuple[str, int]:
+        out: List[str] = []
+        scopes: List[_Scope] = [_Scope('', base)]
+        last = 0
+        rewritten = 0
+        text_start = -1
+        open_tag = ''
+
+        for match in TOKEN_RE.finditer(content):
+            name = match.group(3)
+            if name is None:
+                # Комментарий или CDATA - как есть
+                continue
+            closing = match.group(1) == '/'
+            attributes = match.group(4)
+            self_closing = attributes.endswith('/')
+
+            if name in TEXT_ELEMENTS:
+                if not closing and not self_closing:
+                    out.append(content[last:match.start()])
+                    text_start = match.end()
+                    open_tag = match.group(0)
+                elif closing and text_start >= 0:
+                    text = content[text_start:match.start()]
+                    rewritten += self._text_element(name, open_tag, text, match.group(0), out, scopes, suffix)
+                    text_start = -1
+                else:
+                    continue
+                last = match.end()
+                continue
+
+            if closing:
+                if name in SCOPE_ELEMENTS and len(scopes) > 1 and scopes[-1].name == name:
+                    rewritten += self._close_scope(scopes.pop(), out, suffix)
+                continue
+
+            scope = scopes[-1]
+            tag_base = scope.base
+            names = URL_ATTRIBUTES[name]
+            inherited = {}
+            if name == 'SegmentTemplate':
+                # Ссылки родительского шаблона, которых нет в этом, разрешаются от каталога элемента
+                own = template_links(attributes)
+                pending = scope.template_slot >= 0 and not scope.own_template
+                if scope.template and (pending or tag_base != scope.template_base):
+                    inherited = {attr: value for attr, value in scope.template.items() if attr not in own}
+                scope.template = {**scope.template, **own}
+                scope.template_base = tag_base
+                scope.own_template = True
+            if (names and any(attr in attributes for attr in names)) or inherited:
+                out.append(content[last:match.start()])
+                new_attributes, count = self._attributes(attributes, names, tag_base, suffix,
+                                                         templated=name == 'SegmentTemplate')
+                for attr, value in inherited.items():
+                    new_value = proxied_template(tag_base, value, suffix)
+                    if new_value is not None:
+                        new_attributes = f' {attr}="{escape(new_value, ATTRIBUTE_ENTITIES)}"' + new_attributes
+                        count += 1
+                out.append(match.group(0)[:match.start(4) - match.start()] + new_attributes + '>')
+                last = match.end()
+                rewritten += count
+            if name in SCOPE_ELEMENTS and not self_closing:
+                scopes.append(_Scope(name, tag_base, scope))
+
+        out.append(content[last:])
+        return ''.join(out), rewritten
+
+    def _attributes(self, attributes: str, names: Tuple[str, ...], base: str, suffix: str,
+                    templated: bool) -> Tuple[str, int]:
+        count = 0
+
+        def replace(attr: re.Match) -> str:
+            nonlocal count
+            if attr.group(2) not in names:
+                return attr.group(0)
+            value = unescape(attr.group(4) if attr.group(4) is not None else attr.group(5)).strip()
+            new_value = (proxied_template if templated else proxied_url)(base, value, suffix)
+            if new_value is None:
+                return attr.group(0)
+            count += 1
+            return f'{attr.group(1)}{attr.group(2)}{attr.group(3)}"{escape(new_value, ATTRIBUTE_ENTITIES)}"'
+
+        return ATTRIBUTE_RE.sub(replace, attributes), count
+
+    def _text_element(self, name: str, open_tag: str, text: str, close_tag: str,
+                      out: List[str], scopes: List[_Scope], suffix: str) -> int:
+        value = unescape(text).strip()
+        if name != 'BaseURL':
+            # Location и PatchLocation разрешаются от адреса самого манифеста
+            new_value = proxied_url(scopes[0].base, value, suffix)
+            out.append(open_tag + (escape(new_value) if new_value is not None else text) + close_tag)
+            return new_value is not None
+
+        scope = scopes[-1]
+        resolved = urljoin(scope.inherited, value)
+        if not scope.has_base:
+            # Действует первый BaseURL элемента, остальные - резервные адреса источника
+            scope.has_base = True
+            scope.base = resolved
+            self.base_urls_resolved += 1
+        new_value = proxied_url(resolved, '', suffix) if not resolved.endswith('/') else None
+        if new_value is not None:
+            out.append(open_tag + escape(new_value) + close_tag)
+            return 1
+        if resolved.startswith(('http://', 'https://')) or not value:
+            # Каталог: ссылки уже абсолютные, элемент удаляется. Если в элементе
+            # действует шаблон родителя, на его месте может понадобиться свой
+            if (scope.template and scope.template_slot < 0 and not scope.own_template
+                    and scope.base != scope.template_base):
+                scope.template_slot = len(out)
+                scope.prefix = open_tag[1:open_tag.index('BaseURL')]
+                out.append('')
+                scope.template_base = scope.base
+            else:
+                _drop_indent(out, len(out))
+            return 0
+        out.append(open_tag + text + close_tag)
+        return 0
+
+    @staticmethod
+    def _close_scope(scope: _Scope, out: List[str], suffix: str) -> int:
+        """Шаблон родителя, разрешенный от каталога элемента, если своего шаблона так и не было"""
+        slot = scope.template_slot
+        if slot < 0:
+            return 0
+        if scope.own_template:
+            _drop_indent(out, slot)
+            return 0
+        links = []
+        for attr, value in scope.template.items():
+            new_value = proxied_template(scope.base, value, suffix)
+            if new_value is not None:
+                links.append(f' {attr}="{escape(new_value, ATTRIBUTE_ENTITIES)}"')
+        out[slot] = f'<{scope.prefix}SegmentTemplate{"".join(links)}/>' if links else ''
+        if not links:
+            _drop_indent(out, slot)
+        return len(links)
+
+    def stats(self) -> dict:
+        return {
+            "rewrites": self.rewrites,
+            "reuses": self.reuses,
+            "urls_rewritten": self.urls_rewritten,
+            "base_urls_resolved": self.base_urls_resolved,
+            "manifests": len(self._states),
+            "avg_ms": round(self.total_time / self.rewrites * 1000, 3) if self.rewrites else 0.0,
+            "max_ms": round(self.max_time * 1000, 3),
+        }
@@ -0,0 +1,416 @@
+"""
+Телепрограмма (EPG) из XMLTV-файлов, объявленных в заголовке плейлиста
+(url-tvg / x-tvg-url) или заданных в EPG_URLS.
+
+Файлы бывают на сотни мегабайт, поэтому целиком они не хранятся ни в сжатом,
+ни в разобранном виде: ответ источника по частям распаковывается и разбирается
+в рабочем потоке (XmltvParser), а в память попадают только передачи из окна
+[сейчас - EPG_WINDOW_PAST, сейчас + EPG_WINDOW_FUTURE]. Передачи канала
+хранятся отсортированными массивами времени начала и конца, поэтому
+передача в эфире и следующая находятся двоичным поиском.
+
+Обновление идет по расписанию плейлиста (PLAYLIST_REFRESH_TIME) условными
+запросами: неизменившийся файл не скачивается и не разбирается, пока окно
+загруженных передач не подходит к концу.
+"""
+import asyncio
+import calendar
+import logging
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+import zlib
+from array import array
+from bisect import bisect_right
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import env_bool, env_float, env_list
+from metrics import PLAYLIST_PARSE
+from playlist import PLAYLIST_REFRESH_TIME, PLAYLIST_RETRY_DELAY
+from upstream import UpstreamPool
+
+logger = logging.getLogger("iptv.epg")
+
+EPG_ENABLED = env_bool("EPG_ENABLED", True)
+# Адреса XMLTV через запятую; по умолчанию - из заголовка плейлиста
+EPG_URLS = env_list("EPG_URLS", "")
+# Окно хранимых передач относительно момента загрузки, в часах
+EPG_WINDOW_PAST = env_float("EPG_WINDOW_PAST", 3.0)
+EPG_WINDOW_FUTURE = env_float("EPG_WINDOW_FUTURE", 24.0)
+# Хранить описания передач (основной объем файла)
+EPG_DESCRIPTIONS = env_bool("EPG_DESCRIPTIONS", True)
+EPG_REFRESH_TIME = env_float("EPG_REFRESH_TIME", PLAYLIST_REFRESH_TIME)
+# Таймаут загрузки одного файла целиком
+EPG_FETCH_TIMEOUT = env_float("EPG_FETCH_TIMEOUT", 600.0)
+
+EPG_CHUNK_SIZE = 256 * 1024
+# Сколько распакованного XML разбирается за раз: сжатие XMLTV бывает
+# десятикратным и больше, кусок ответа целиком раздул бы дерево разбора
+XML_CHUNK_SIZE = 256 * 1024
+# Описание длиннее обрезается
+DESCRIPTION_MAX_LENGTH = 500
+
+
+def epg_urls(header: Dict[str, str]) -> List[str]:
+    """Адреса телепрограммы из заголовка #EXTM3U: через запятую или точку с запятой"""
+    value = header.get("url-tvg") or header.get("x-tvg-url") or ""
+    return [url.strip() for url in value.replace(";", ",").split(",") if url.strip()]
+
+
+def parse_xmltv_time(value: str) -> Optional[int]:
+    """'20260101120000 +0300' -> unix-время; без смещения время считается UTC"""
+    try:
+        ts = calendar.timegm((int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                              int(value[8:10] or 0), int(value[10:12] or 0), int(value[12:14] or 0), 0, 0, 0))
+    except (ValueError, IndexError):
+        return None
+    offset = value[14:].strip()
+    if len(offset) == 5 and offset[0] in "+-" and offset[1:].isdigit():
+        seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        ts -= seconds if offset[0] == "+" else -seconds
+    return ts
+
+
+class Programme:
+    __slots__ = ('start', 'stop', 'title', 'description')
+
+    def __init__(self, start: int, stop: int, title: str, description: Optional[str]):
+        self.start = start
+        self.stop = stop
+        self.title = title
+        self.description = description
+
+    def to_dict(self) -> Dict:
+        data = {"title": self.title, "start": self.start, "stop": self.stop}
+        if self.description:
+            data["description"] = self.description
+        return data
+
+
+class Schedule:
+    """Передачи одного канала: параллельные массивы, отсортированные по началу"""
+    __slots__ = ('starts', 'stops', 'titles', 'descriptions')
+
+    def __init__(self, programmes: List[Tuple[int, int, str, Optional[str]]]):
+        programmes.sort()
+        self.starts = array('q', (item[0] for item in programmes))
+        self.stops = array('q', (item[1] for item in programmes))
+        self.titles = tuple(item[2] for item in programmes)
+        self.descriptions = tuple(item[3] for item in programmes)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def programme(self, index: int) -> Programme:
+        return Programme(self.starts[index], self.stops[index], self.titles[index], self.descriptions[index])
+
+    def now_next(self, at: float) -> Tuple[Optional[Programme], Optional[Programme]]:
+        index = bisect_right(self.starts, at) - 1
+        current = self.programme(index) if index >= 0 and self.stops[index] > at else None
+        following = self.programme(index + 1) if index + 1 < len(self.starts) else None
+        return current, following
+
+
+class XmltvParser:
+    """
+    Потоковый разбор XMLTV: feed() получает очередной кусок ответа
+    (gzip или обычный XML), распаковывает его и разбирает готовые элементы.
+    Разобранные элементы сразу удаляются из дерева, поэтому память не растет
+    с размером файла. Вызывается из рабочего потока.
+    """
+
+    def __init__(self, window_start: float, window_end: float, descriptions: bool = EPG_DESCRIPTIONS):
+        self.window_start = window_start
+        self.window_end = window_end
+        self.descriptions = descriptions
+        self.programmes: Dict[str, List[Tuple[int, int, str, Optional[str]]]] = {}
+        self.total = 0
+        self.skipped = 0
+        # Время распаковки и разбора, без ожидания сети
+        self.elapsed = 0.0
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._decompressor = None
+        self._started = False
+        self._root = None
+        self._depth = 0
+
+    def feed(self, data: bytes):
+        started = time.perf_counter()
+        if not self._started:
+            self._started = True
+            if data[:2] == b"\x1f\x8b":
+                # 32 + MAX_WBITS: gzip-заголовок разбирает zlib
+                self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        if self._decompressor is None:
+            self._parse(data)
+        while self._decompressor is not None and data:
+            self._parse(self._decompressor.decompress(data, XML_CHUNK_SIZE))
+            data = self._decompressor.unconsumed_tail
+        self.elapsed += time.perf_counter() - started
+
+    def close(self) -> Dict[str, Schedule]:
+        """Завершает разбор; передачи по каналам"""
+        started = time.perf_counter()
+        if self._decompressor is not None:
+            self._parse(self._decompressor.flush())
+        self._parser.close()
+        self._drain()
+        schedules = {channel: Schedule(items) for channel, items in self.programmes.items()}
+        self.elapsed += time.perf_counter() - started
+        return schedules
+
+    def _parse(self, data: bytes):
+        self._parser.feed(data)
+        self._drain()
+
+    def _drain(self):
+        for event, element in self._parser.read_events():
+            if event == "start":
+                if self._root is None:
+                    self._root = element
+                self._depth += 1
+                continue
+            self._depth -= 1
+            # Элементы верхнего уровня под <tv>: programme и channel
+            if self._depth != 1:
+                continue
+            if element.tag == "programme":
+                self._programme(element)
+            self._root.clear()
+
+    def _programme(self, element):
+        self.total += 1
+        channel = element.get("channel")
+        start = parse_xmltv_time(element.get("start") or "")
+        stop = parse_xmltv_time(element.get("stop") or "")
+        if not channel or start is None:
+            self.skipped += 1
+            return
+        if stop is None:
+            stop = start
+        if stop < self.window_start or start > self.window_end:
+            return
+        title = element.findtext("title") or ""
+        description = None
+        if self.descriptions:
+            description = element.findtext("desc")
+            if description:
+                description = description[:DESCRIPTION_MAX_LENGTH]
+        # Повторяющиеся названия (новости, сериалы) хранятся одной строкой
+        self.programmes.setdefault(sys.intern(channel), []).append((start, stop, sys.intern(title), description))
+
+
+class EpgFeed:
+    """Один файл телепрограммы: разобранные передачи и состояние условных запросов"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.schedules: Dict[str, Schedule] = {}
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        # До какого момента загружены передачи
+        self.window_end = 0.0
+        self.checked_at = 0.0
+        self.updated_at = 0.0
+        self.failures = 0
+        self.downloads = 0
+        self.not_modified = 0
+        self.bytes = 0
+        self.programmes = 0
+        self.elapsed = 0.0
+        self.last_error: Optional[str] = None
+
+    def stats(self) -> Dict:
+        return {
+            "url": self.url,
+            "channels": len(self.schedules),
+            "programmes": self.programmes,
+            "bytes": self.bytes,
+            "checked_at": self.checked_at or None,
+            "updated_at": self.updated_at or None,
+            "elapsed": round(self.elapsed, 3),
+            "downloads": self.downloads,
+            "not_modified": self.not_modified,
+            "last_error": self.last_error,
+        }
+
+
+class EpgStore:
+    """
+    Телепрограмма по tvg-id. urls возвращает текущий список файлов
+    (меняется вместе с плейлистом); файлы загружаются по очереди,
+    при совпадении tvg-id в нескольких файлах побеждает первый.
+    """
+
+    def __init__(self, pool: UpstreamPool, urls: Callable[[], Iterable[str]],
+                 enabled: bool = EPG_ENABLED,
+                 refresh_time: float = EPG_REFRESH_TIME,
+                 window_past: float = EPG_WINDOW_PAST * 3600,
+                 window_future: float = EPG_WINDOW_FUTURE * 3600,
+                 timeout: float = EPG_FETCH_TIMEOUT):
+        self.pool = pool
+        self.urls = urls
+        self.enabled = enabled
+        self.refresh_time = refresh_time
+        self.window_past = window_past
+        self.window_future = window_future
+        self.timeout = timeout
+        self.feeds: Dict[str, EpgFeed] = {}
+        self.index: Dict[str, Schedule] = {}
+        self.generation = 0
+        self.updated_at = 0.0
+        # Вызывается после каждой пересборки индекса
+        self.on_update: Optional[Callable[[], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def adopt(self, index: Dict[str, Schedule]):
+        """Индекс, собранный в другом процессе"""
+        self.index = index
+        self.generation += 1
+        self.updated_at = time.time()
+
+    def now_next(self, tvg_ids: Iterable[str], at: Optional[float] = None) -> Dict[str, Optional[Dict]]:
+        """Передачи в эфире и следующие для набора tvg-id; нет программы - None"""
+        at = time.time() if at is None else at
+        result = {}
+        for tvg_id in tvg_ids:
+            schedule = self.index.get(tvg_id)
+            if schedule is None:
+                result[tvg_id] = None
+                continue
+            current, following = schedule.now_next(at)
+            result[tvg_id] = {
+                "now": current.to_dict() if current else None,
+                "next": following.to_dict() if following else None,
+            }
+        return result
+
+    def sources_changed(self):
+        """Плейлист обновился: список файлов мог измениться"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка обновления телепрограммы: %s", e)
+            feeds = list(self.feeds.values())
+            delay = min((self._next_check(feed) for feed in feeds), default=time.time() + self.refresh_time) - time.time()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(delay, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_check(self, feed: EpgFeed) -> float:
+        if feed.failures:
+            return feed.checked_at + min(self.refresh_time, PLAYLIST_RETRY_DELAY * 2 ** (feed.failures - 1))
+        # Окно загруженных передач кончается раньше планового обновления
+        return min(feed.checked_at + self.refresh_time, feed.window_end - self.window_future / 2)
+
+    async def refresh(self, due_only: bool = True):
+        urls = list(dict.fromkeys(self.urls()))
+        removed = set(self.feeds) - set(urls)
+        for url in removed:
+            del self.feeds[url]
+        changed = bool(removed)
+        now = time.time()
+        for url in urls:
+            feed = self.feeds.get(url)
+            if feed is None:
+                feed = self.feeds[url] = EpgFeed(url)
+            if due_only and feed.checked_at and self._next_check(feed) > now:
+                continue
+            changed |= await self._update(feed)
+        if changed:
+            self._rebuild([self.feeds[url] for url in urls])
+            if self.on_update is not None:
+                await self.on_update()
+
+    async def _update(self, feed: EpgFeed) -> bool:
+        started = time.monotonic()
+        try:
+            changed = await asyncio.wait_for(self._download(feed), self.timeout)
+        except Exception as e:
+            feed.failures += 1
+            feed.last_error = str(e) or type(e).__name__
+            logger.error("Ошибка при загрузке телепрограммы %s: %s", feed.url, feed.last_error)
+            return False
+        finally:
+            feed.checked_at = time.time()
+            feed.elapsed = time.monotonic() - started
+        feed.failures = 0
+        feed.last_error = None
+        return changed
+
+    async def _download(self, feed: EpgFeed) -> bool:
+        now = time.time()
+        headers = {}
+        # Условный запрос, только пока загруженных передач хватает на половину окна
+        if feed.schedules and feed.window_end - now > self.window_future / 2:
+            if feed.etag:
+                headers["If-None-Match"] = feed.etag
+            if feed.last_modified:
+                headers["If-Modified-Since"] = feed.last_modified
+
+        logger.info("Загрузка телепрограммы: %s", feed.url)
+        parser = XmltvParser(now - self.window_past, now + self.window_future)
+        size = 0
+        async with self.pool.host_slot(feed.url):
+            async with self.pool.client.stream("GET", feed.url, headers=headers, follow_redirects=True,
+                                               timeout=self.pool.timeout_for("segment")) as response:
+                if response.status_code == 304:
+                    feed.not_modified += 1
+                    logger.info("Телепрограмма не изменилась: %s", feed.url)
+                    return False
+                if response.status_code != 200:
+                    raise RuntimeError(f"HTTP {response.status_code}")
+                async for chunk in response.aiter_bytes(EPG_CHUNK_SIZE):
+                    size += len(chunk)
+                    await asyncio.to_thread(parser.feed, chunk)
+                schedules = await asyncio.to_thread(parser.close)
+                PLAYLIST_PARSE.labels("epg").observe(parser.elapsed)
+                feed.etag = response.headers.get("etag")
+                feed.last_modified = response.headers.get("last-modified")
+
+        feed.schedules = schedules
+        feed.window_end = now + self.window_future
+        feed.downloads += 1
+        feed.bytes = size
+        feed.programmes = sum(len(schedule) for schedule in schedules.values())
+        feed.updated_at = time.time()
+        logger.info("Телепрограмма загружена: %s, %s байт, %s каналов, %s передач в окне из %s",
+                    feed.url, size, len(schedules), feed.programmes, parser.total)
+        return True
+
+    def _rebuild(self, feeds: List[EpgFeed]):
+        index: Dict[str, Schedule] = {}
+        for feed in feeds:
+            for tvg_id, schedule in feed.schedules.items():
+                index.setdefault(tvg_id, schedule)
+        self.index = index
+        self.generation += 1
+        self.updated_at = time.time()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "channels": len(self.index),
+            "generation": self.generation,
+            "updated_at": self.updated_at or None,
+            "feeds": [feed.stats() for feed in self.feeds.values()],
+        }
@@ -0,0 +1,215 @@
+"""Фоновая проверка каналов: доступность и задержка источников"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import env_bool, env_float, env_int
+
+logger = logging.getLogger("iptv.health")
+
+HEALTH_ENABLED = env_bool("HEALTH_ENABLED", True)
+# Одновременных проверок и таймаут одной проверки (до первого байта ответа)
+HEALTH_CONCURRENCY = env_int("HEALTH_CONCURRENCY", 8)
+HEALTH_TIMEOUT = env_float("HEALTH_TIMEOUT", 8.0)
+# Канал, проверенный позже чем HEALTH_RECHECK секунд назад, пропускается
+HEALTH_RECHECK = env_float("HEALTH_RECHECK", 30 * 60)
+# Пауза между обходами каталога
+HEALTH_INTERVAL = env_float("HEALTH_INTERVAL", 5 * 60)
+# Сколько последних проверок помнить для доли успешных
+HEALTH_HISTORY = env_int("HEALTH_HISTORY", 10)
+# Результаты публикуются в /api/channels пачками по столько проверок
+HEALTH_BATCH = env_int("HEALTH_BATCH", 200)
+
+# Вес новой задержки в скользящем среднем
+LATENCY_WEIGHT = 0.3
+
+
+class ChannelHealth:
+    __slots__ = ('ok', 'status', 'latency', 'checked_at', 'history', 'error')
+
+    def __init__(self):
+        self.ok = False
+        self.status: Optional[int] = None
+        # Скользящее среднее времени до первого байта, мс (только успешные проверки)
+        self.latency: Optional[float] = None
+        self.checked_at = 0.0
+        self.history: deque = deque(maxlen=HEALTH_HISTORY)
+        self.error: Optional[str] = None
+
+    def record(self, ok: bool, status: Optional[int], elapsed: float, error: Optional[str]):
+        self.ok = ok
+        self.status = status
+        self.error = error
+        self.checked_at = time.time()
+        self.history.append(ok)
+        if ok:
+            latency = elapsed * 1000
+            self.latency = latency if self.latency is None else (
+                self.latency + (latency - self.latency) * LATENCY_WEIGHT)
+
+    @property
+    def uptime(self) -> float:
+        return sum(self.history) / len(self.history) if self.history else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "ok": self.ok,
+            "latency_ms": round(self.latency) if self.latency is not None else None,
+            "uptime": round(self.uptime, 2),
+            "checked_at": round(self.checked_at),
+        }
+
+
+# Канал для проверки: адрес потока и профиль заголовков
+Target = Tuple[str, object]
+
+
+class HealthProber:
+    """
+    Обходит каталог в фоне и проверяет каналы с ограниченным параллелизмом:
+    probe(url, profile) открывает ответ источника (для HLS - первый плейлист)
+    и возвращает код ответа. Результаты хранятся по адресу потока, поэтому
+    переживают пересборку каталога; недавно проверенные каналы пропускаются.
+
+    generation растет, когда появляются новые результаты: по нему
+    пересобирается готовый ответ /api/channels.
+    """
+
+    def __init__(self,
+                 probe: Callable[[str, object], Awaitable[int]],
+                 targets: Callable[[], Iterable[Target]],
+                 concurrency: int = HEALTH_CONCURRENCY,
+                 timeout: float = HEALTH_TIMEOUT,
+                 recheck: float = HEALTH_RECHECK,
+                 interval: float = HEALTH_INTERVAL,
+                 enabled: bool = HEALTH_ENABLED):
+        self.probe = probe
+        self.targets = targets
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.recheck = recheck
+        self.interval = interval
+        self.enabled = enabled
+        self.health: Dict[str, ChannelHealth] = {}
+        self.generation = 0
+        self.updated_at = 0.0
+        self.rounds = 0
+        self.probes = 0
+        self.failures = 0
+        self.skipped = 0
+        # Вызывается после каждой опубликованной пачки результатов
+        self.on_update: Optional[Callable[[], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def adopt(self, health: Dict[str, ChannelHealth]):
+        """Результаты проверок, выполненных другим процессом"""
+        self.health = health
+        self.generation += 1
+        self.updated_at = time.time()
+
+    def get(self, url: str) -> Optional[ChannelHealth]:
+        return self.health.get(url)
+
+    def to_dict(self, url: str) -> Optional[Dict]:
+        health = self.health.get(url)
+        return health.to_dict() if health is not None and health.checked_at else None
+
+    def best(self, candidates: List) -> object:
+        """
+        Самое быстрое из рабочих зеркал канала (объекты с url);
+        если ни одно не проверено или не работает - первое
+        """
+        healthy = [(self.health[candidate.url].latency or 0.0, position, candidate)
+                   for position, candidate in enumerate(candidates)
+                   if candidate.url in self.health and self.health[candidate.url].ok]
+        return min(healthy)[2] if healthy else candidates[0]
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Ошибка обхода каналов: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def check_all(self):
+        """Один обход: сначала не проверявшиеся каналы, затем проверенные давнее всех"""
+        now = time.time()
+        pending: Dict[str, object] = {}
+        known = set()
+        for url, profile in self.targets():
+            known.add(url)
+            health = self.health.get(url)
+            if health is not None and now - health.checked_at < self.recheck:
+                continue
+            pending.setdefault(url, profile)
+        # Каналы, которых больше нет в каталоге, забываются
+        for url in [url for url in self.health if url not in known]:
+            del self.health[url]
+        self.skipped += len(known) - len(pending)
+        if not pending:
+            return
+
+        order = sorted(pending, key=lambda url: self.health[url].checked_at if url in self.health else 0.0)
+        logger.info("Проверка каналов: %s из %s", len(order), len(known))
+        slots = asyncio.Semaphore(self.concurrency)
+        for start in range(0, len(order), HEALTH_BATCH):
+            batch = order[start:start + HEALTH_BATCH]
+            await asyncio.gather(*(self._check(url, pending[url], slots) for url in batch))
+            self.generation += 1
+            self.updated_at = time.time()
+            if self.on_update is not None:
+                await self.on_update()
+        self.rounds += 1
+        alive = sum(1 for url in order if self.health[url].ok)
+        logger.info("Проверка каналов завершена: работают %s из %s", alive, len(order))
+
+    async def _check(self, url: str, profile: object, slots: asyncio.Semaphore):
+        async with slots:
+            started = time.monotonic()
+            status, error = None, None
+            try:
+                status = await asyncio.wait_for(self.probe(url, profile), self.timeout)
+            except asyncio.TimeoutError:
+                error = "timeout"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            elapsed = time.monotonic() - started
+        ok = status is not None and status < 400
+        health = self.health.get(url)
+        if health is None:
+            health = self.health[url] = ChannelHealth()
+        health.record(ok, status, elapsed, error)
+        self.probes += 1
+        if not ok:
+            self.failures += 1
+
+    def stats(self) -> Dict:
+        checked = [health for health in self.health.values() if health.checked_at]
+        latencies = sorted(health.latency for health in checked if health.ok and health.latency is not None)
+        return {
+            "enabled": self.enabled,
+            "channels": len(checked),
+            "healthy": sum(1 for health in checked if health.ok),
+            "median_latency_ms": round(latencies[len(latencies) // 2]) if latencies else None,
+            "rounds": self.rounds,
+            "probes": self.probes,
+            "failures": self.failures,
+            "skipped_recent": self.skipped,
+        }
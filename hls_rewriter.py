@@ -0,0 +1,415 @@
+"""Переписывание HLS-плейлистов (m3u8): все ссылки направляются через /proxy"""
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional
+from urllib.parse import quote_plus, urlencode, urljoin
+
+PROXY_PREFIX = "/proxy?url="
+
+# Теги, у которых ссылка находится в атрибуте URI="..."
+URI_TAGS = (
+    '#EXT-X-KEY:',
+    '#EXT-X-SESSION-KEY:',
+    '#EXT-X-MAP:',
+    '#EXT-X-MEDIA:',
+    '#EXT-X-I-FRAME-STREAM-INF:',
+    '#EXT-X-PART:',
+    '#EXT-X-PRELOAD-HINT:',
+    '#EXT-X-RENDITION-REPORT:',
+    '#EXT-X-SESSION-DATA:',
+)
+
+# Теги уровня плейлиста; все остальные теги относятся к следующему сегменту
+PLAYLIST_TAGS = (
+    '#EXTM3U',
+    '#EXT-X-VERSION',
+    '#EXT-X-TARGETDURATION',
+    '#EXT-X-MEDIA-SEQUENCE',
+    '#EXT-X-DISCONTINUITY-SEQUENCE',
+    '#EXT-X-PLAYLIST-TYPE',
+    '#EXT-X-SERVER-CONTROL',
+    '#EXT-X-PART-INF',
+    '#EXT-X-START',
+    '#EXT-X-INDEPENDENT-SEGMENTS',
+    '#EXT-X-ALLOW-CACHE',
+    '#EXT-X-SKIP',
+    '#EXT-X-ENDLIST',
+    '#EXT-X-PRELOAD-HINT',
+    '#EXT-X-RENDITION-REPORT',
+)
+
+# Параметры LL-HLS, которые плеер добавляет к адресу плейлиста
+DELIVERY_DIRECTIVES = ('_HLS_msn', '_HLS_part', '_HLS_skip')
+
+# Сколько живых плейлистов помнить для инкрементального переписывания
+MAX_PLAYLIST_STATES = 2048
+
+# Сколько последних сегментов прошлой версии можно не совпасть
+# (у LL-HLS они теряют частичные сегменты при следующем обновлении)
+REUSE_TAIL_TRIES = 4
+
+
+@lru_cache(maxsize=65536)
+def proxied_url(base_url: str, uri: str, suffix: str = '') -> Optional[str]:
+    """
+    Ссылка на ресурс через прокси. Результат запоминается, поэтому
+    сегменты, уже встречавшиеся в прошлых версиях плейлиста,
+    не пересчитываются заново. Не-HTTP ссылки (skd://, data:) не трогаем.
+    suffix - дополнительные параметры /proxy, например профиль заголовков.
+    """
+    full_url = urljoin(base_url, uri)
+    if not full_url.startswith(('http://', 'https://')):
+        return None
+    return PROXY_PREFIX + quote_plus(full_url) + suffix
+
+
+def rewrite_uri_attribute(line: str, base_url: str, suffix: str = '') -> str:
+    start = line.find('URI="')
+    if start < 0:
+        return line
+    start += 5
+    end = line.find('"', start)
+    if end < 0:
+        return line
+    new_uri = proxied_url(base_url, line[start:end], suffix)
+    if new_uri is None:
+        return line
+    return line[:start] + new_uri + line[end:]
+
+
+def tag_int(line: str) -> int:
+    try:
+        return int(line.split(':', 1)[1].strip())
+    except (IndexError, ValueError):
+        return 0
+
+
+def with_delivery_directives(url: str, directives: Dict[str, str]) -> str:
+    if not directives:
+        return url
+    separator = '&' if '?' in url else '?'
+    return url + separator + urlencode(directives)
+
+
+class RewriteResult:
+    __slots__ = ('body', 'is_master', 'elapsed', 'reused', 'rewritten')
+
+    def __init__(self, body: bytes, is_master: bool, elapsed: float, reused: int = 0, rewritten: int = 0):
+        self.body = body
+        self.is_master = is_master
+        self.elapsed = elapsed
+        self.reused = reused
+        self.rewritten = rewritten
+
+
+class PlaylistState:
+    """
+    Последняя версия живого медиа-плейлиста. Участок с сегментами хранится
+    в исходном и переписанном виде вместе со смещениями начала каждого
+    сегмента, чтобы следующая версия окна могла взять общую часть целиком.
+    """
+    __slots__ = ('source', 'base', 'result', 'first_seq', 'src_region', 'out_region',
+                 'src_base', 'out_base', 'src_starts', 'out_starts', 'can_block_reload', 'can_skip')
+
+    def __init__(self):
+        self.source: Optional[str] = None
+        self.base: Optional[str] = None
+        self.result: Optional[RewriteResult] = None
+        self.first_seq = 0
+        self.src_region = ''
+        self.out_region = ''
+        # Смещения сегментов first_seq, first_seq + 1, ... в координатах,
+        # общих для всех версий окна; начало участка - src_base / out_base
+        self.src_base = 0
+        self.out_base = 0
+        self.src_starts: List[int] = []
+        self.out_starts: List[int] = []
+        self.can_block_reload = False
+        self.can_skip = False
+
+
+class _Pass:
+    """Состояние одного прохода по плейлисту"""
+    __slots__ = ('out', 'base', 'suffix', 'is_master', 'has_playlist_type', 'has_endlist', 'tweaks',
+                 'media_sequence', 'skipped', 'can_block_reload', 'can_skip')
+
+    def __init__(self, tweaks: bool, is_master: bool, base: str, suffix: str = ''):
+        self.out: List[str] = []
+        self.base = base
+        self.suffix = suffix
+        self.is_master = is_master
+        self.has_playlist_type = False
+        self.has_endlist = False
+        self.tweaks = tweaks
+        self.media_sequence = 0
+        self.skipped = 0
+        self.can_block_reload = False
+        self.can_skip = False
+
+
+class HlsRewriter:
+    """
+    Переписывает мастер- и медиа-плейлисты за один проход по строкам.
+
+    Для живых плейлистов хранится состояние по адресу источника: если текст
+    не изменился, всем зрителям отдаются уже готовые байты, а при сдвиге окна
+    общая с прошлой версией часть сегментов берется готовой и переписывается
+    только новый хвост.
+
+    buffer_tweaks сохраняет прежнее поведение прокси для медиа-плейлистов:
+    удвоенный EXT-X-TARGETDURATION и EXT-X-PLAYLIST-TYPE:VOD, если тип не указан.
+    Для LL-HLS (EXT-X-SERVER-CONTROL / EXT-X-PART-INF) они не применяются.
+    """
+
+    def __init__(self, buffer_tweaks: bool = True, max_states: int = MAX_PLAYLIST_STATES):
+        self.buffer_tweaks = buffer_tweaks
+        self.max_states = max_states
+        self._states: "OrderedDict[str, PlaylistState]" = OrderedDict()
+        self.rewrites = 0
+        self.full_reuses = 0
+        self.segments_reused = 0
+        self.segments_rewritten = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def _state(self, playlist_url: str) -> PlaylistState:
+        state = self._states.get(playlist_url)
+        if state is None:
+            state = self._states[playlist_url] = PlaylistState()
+            if len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(playlist_url)
+        return state
+
+    def allowed_directives(self, playlist_url: str, params: Dict[str, str], suffix: str = '') -> Dict[str, str]:
+        """
+        Параметры LL-HLS, которые можно передать источнику: блокирующая
+        перезагрузка (_HLS_msn/_HLS_part) и дельта-обновления (_HLS_skip)
+        только если источник объявил их поддержку в EXT-X-SERVER-CONTROL.
+        """
+        state = self._states.get(playlist_url + suffix)
+        if state is None:
+            return {}
+        allowed = {}
+        for name, value in params.items():
+            if name in ('_HLS_msn', '_HLS_part') and state.can_block_reload:
+                allowed[name] = value
+            elif name == '_HLS_skip' and state.can_skip:
+                allowed[name] = value
+        return allowed
+
+    def rewrite(self, content: str, playlist_url: str, incremental: bool = True,
+                suffix: str = '', base_url: Optional[str] = None) -> RewriteResult:
+        """
+        suffix добавляется к каждой ссылке /proxy (профиль заголовков канала).
+        base_url - конечный адрес плейлиста после редиректов, относительно
+        которого разрешаются ссылки; состояние хранится по playlist_url.
+        """
+        started = time.perf_counter()
+        base = base_url or playlist_url
+        state = self._state(playlist_url + suffix) if incremental else None
+        if state is not None and state.base != base:
+            # Источник перенаправил на другой адрес - прошлые ссылки не подходят
+            state.base = base
+            state.source = None
+            state.src_starts = []
+            state.out_starts = []
+
+        # Плейлист не изменился с прошлого запроса - отдаем готовый результат
+        if state is not None and state.source == content and state.result is not None:
+            self.full_reuses += 1
+            cached = state.result
+            return RewriteResult(cached.body, cached.is_master, time.perf_counter() - started,
+                                 reused=len(state.src_starts))
+
+        scan = _Pass(self.buffer_tweaks
+                     and '#EXT-X-SERVER-CONTROL' not in content and '#EXT-X-PART-INF' not in content,
+                     '#EXT-X-STREAM-INF' in content, base, suffix)
+        out = scan.out
+        length = len(content)
+
+        # Заголовок: теги уровня плейлиста до первого сегмента
+        pos = 0
+        while pos < length:
+            end = content.find('\n', pos)
+            if end < 0:
+                end = length
+            line = content[pos:end].rstrip('\r')
+            if line and (line[0] != '#' or not line.startswith(PLAYLIST_TAGS)):
+                break
+            if line:
+                self._line(line, scan)
+            else:
+                out.append(line)
+            pos = end + 1
+        pos = min(pos, length)
+        header_end = len(out)
+        region_start = pos
+        first_seq = scan.media_sequence + scan.skipped
+
+        src_base = out_base = 0
+        src_starts: List[int] = []
+        out_starts: List[int] = []
+        out_pos = 0
+        reused = rewritten = 0
+        region_src_end = 0
+        region_out_end = header_end
+
+        # Общая с прошлой версией часть окна берется готовой. Перед ней могут
+        # стоять теги, которые источник повторяет в начале окна (EXT-X-KEY, EXT-X-MAP),
+        # а у последних сегментов LL-HLS со временем исчезают частичные сегменты
+        if state is not None and state.src_starts:
+            index = first_seq - state.first_seq
+            count = len(state.src_starts)
+            for stop in range(count, max(index, count - REUSE_TAIL_TRIES) - 1, -1):
+                if not 0 <= index < stop:
+                    break
+                src_from = state.src_starts[index] - state.src_base
+                out_from = state.out_starts[index] - state.out_base
+                if stop == count:
+                    overlap = state.src_region[src_from:]
+                    reused_text = state.out_region[out_from:]
+                else:
+                    overlap = state.src_region[src_from:state.src_starts[stop] - state.src_base].rstrip('\r\n')
+                    reused_text = state.out_region[out_from:state.out_starts[stop] - state.out_base].rstrip('\n')
+                found = content.find(overlap, pos)
+                end = found + len(overlap)
+                if found < 0 or not (end == length or content[end] in '\r\n') \
+                        or not self._tags_only(content, pos, found):
+                    continue
+                for line in content[pos:found].splitlines():
+                    self._line(line, scan) if line else out.append(line)
+                prefix_out = sum(len(line) + 1 for line in out[header_end:])
+                src_base = state.src_starts[index] - (found - pos)
+                out_base = state.out_starts[index] - prefix_out
+                src_starts = [src_base] + state.src_starts[index + 1:stop]
+                out_starts = [out_base] + state.out_starts[index + 1:stop]
+                out.append(reused_text)
+                out_pos = prefix_out + len(reused_text) + 1
+                reused = len(src_starts)
+                region_src_end = end - region_start
+                region_out_end = len(out)
+                pos = end + 2 if content.startswith('\r\n', end) else end + 1
+                break
+
+        # Новые сегменты и хвост плейлиста
+        in_block = False
+        cursor = pos
+        for raw in content[pos:].splitlines(True):
+            line_start = cursor
+            cursor += len(raw)
+            line = raw.rstrip('\r\n')
+            if not line:
+                out.append(line)
+                out_pos += 1
+                continue
+            if not in_block and not line.startswith(PLAYLIST_TAGS):
+                # Первая строка нового сегмента
+                in_block = True
+                src_starts.append(src_base + line_start - region_start)
+                out_starts.append(out_base + out_pos)
+            self._line(line, scan)
+            out_pos += len(out[-1]) + 1
+            if line[0] != '#':
+                # Ссылка на сегмент или вариантный плейлист завершает блок
+                in_block = False
+                rewritten += 1
+                region_src_end = line_start + len(line) - region_start
+                region_out_end = len(out)
+        if in_block:
+            # Частичные сегменты LL-HLS без ссылки на целый сегмент
+            src_starts.pop()
+            out_starts.pop()
+
+        if state is not None:
+            state.source = content
+            state.first_seq = first_seq
+            state.src_region = content[region_start:region_start + region_src_end]
+            state.out_region = '\n'.join(out[header_end:region_out_end])
+            state.src_base = src_base
+            state.out_base = out_base
+            state.src_starts = src_starts
+            state.out_starts = out_starts
+            state.can_block_reload = scan.can_block_reload
+            state.can_skip = scan.can_skip
+
+        # Тип VOD вставляется после заголовка, перед метаданными сегментов
+        if scan.tweaks and not scan.is_master and not scan.has_playlist_type and not scan.has_endlist:
+            out.insert(header_end, '#EXT-X-PLAYLIST-TYPE:VOD')
+
+        elapsed = time.perf_counter() - started
+        result = RewriteResult('\n'.join(out).encode('utf-8'), scan.is_master, elapsed, reused, rewritten)
+        if state is not None:
+            state.result = result
+
+        self.rewrites += 1
+        self.segments_reused += reused
+        self.segments_rewritten += rewritten
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return result
+
+    @staticmethod
+    def _tags_only(content: str, start: int, end: int) -> bool:
+        """Между start и end только целые строки с тегами, без ссылок на сегменты"""
+        if start == end:
+            return True
+        if content[end - 1] != '\n':
+            return False
+        return all(not line or line[0] == '#' for line in content[start:end].splitlines())
+
+    def _line(self, line: str, scan: _Pass):
+        out = scan.out
+        if line[0] != '#':
+            uri = line.strip()
+            new_uri = proxied_url(scan.base, uri, scan.suffix)
+            out.append(new_uri if new_uri is not None else line)
+        elif line.startswith('#EXTINF:'):
+            out.append(line)
+        elif line.startswith('#EXT-X-TARGETDURATION:') and scan.tweaks:
+            # Увеличиваем целевую продолжительность для лучшей буферизации
+            try:
+                out.append(f'#EXT-X-TARGETDURATION:{int(line[22:].strip()) * 2}')
+            except ValueError:
+                out.append(line)
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            scan.media_sequence = tag_int(line)
+            out.append(line)
+        elif line.startswith('#EXT-X-SKIP:'):
+            # Дельта-плейлист: первые SKIPPED-SEGMENTS сегментов опущены
+            for attr in line[12:].split(','):
+                name, _, value = attr.partition('=')
+                if name.strip() == 'SKIPPED-SEGMENTS' and value.strip().isdigit():
+                    scan.skipped = int(value)
+            out.append(line)
+        elif line.startswith('#EXT-X-SERVER-CONTROL:'):
+            scan.can_block_reload = 'CAN-BLOCK-RELOAD=YES' in line
+            scan.can_skip = 'CAN-SKIP-UNTIL=' in line
+            out.append(line)
+        elif line.startswith('#EXT-X-PLAYLIST-TYPE:'):
+            scan.has_playlist_type = True
+            out.append(line)
+        elif line.startswith('#EXT-X-ENDLIST'):
+            scan.has_endlist = True
+            out.append(line)
+        elif line.startswith(URI_TAGS) or 'URI="' in line:
+            out.append(rewrite_uri_attribute(line, scan.base, scan.suffix))
+        else:
+            out.append(line)
+
+    def stats(self) -> dict:
+        memo = proxied_url.cache_info()
+        return {
+            "rewrites": self.rewrites,
+            "full_reuses": self.full_reuses,
+            "segments_reused": self.segments_reused,
+            "segments_rewritten": self.segments_rewritten,
+            "live_playlists": len(self._states),
+            "avg_ms": round(self.total_time / self.rewrites * 1000, 3) if self.rewrites else 0.0,
+            "max_ms": round(self.max_time * 1000, 3),
+            "url_memo_hits": memo.hits,
+            "url_memo_misses": memo.misses,
+            "url_memo_size": memo.currsize,
+        }
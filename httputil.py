@@ -0,0 +1,71 @@
+"""Предварительно сжатые ответы и условные запросы (ETag / Last-Modified)"""
+import gzip
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional
+
+try:
+    import brotli  # type: ignore
+except ImportError:  # brotli необязателен, без него отдаем gzip
+    brotli = None
+
+
+def compress_variants(body: bytes) -> Dict[str, bytes]:
+    """Тело во всех поддерживаемых кодировках, сжимается один раз"""
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return variants
+
+
+def choose_encoding(accept_encoding: Optional[str], available) -> str:
+    """Выбирает лучшую кодировку из Accept-Encoding (br > gzip > identity)"""
+    if not accept_encoding:
+        return "identity"
+    accepted = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def make_etag(tag: str, encoding: str = "identity") -> str:
+    """Сильный ETag; у каждой кодировки свое представление"""
+    if encoding == "identity":
+        return f'"{tag}"'
+    return f'"{tag}-{encoding}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Совпадает ли If-None-Match с ETag отдаваемого представления (из make_etag).
+    Сравнение слабое (W/ не учитывается), но у каждой кодировки свой ETag
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def not_modified_since(if_modified_since: Optional[str], timestamp: float) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        return int(timestamp) <= int(parsedate_to_datetime(if_modified_since).timestamp())
+    except (TypeError, ValueError):
+        return False
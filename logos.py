@@ -0,0 +1,269 @@
+"""
+Логотипы каналов через сервер: каждый tvg-logo скачивается один раз,
+уменьшается до миниатюры и хранится на диске.
+
+Файлы называются по хэшу содержимого (LOGO_CACHE_DIR/ab/abcdef....png),
+поэтому одинаковые логотипы разных каналов занимают один файл, а запись
+нельзя увидеть недописанной. Соответствие адреса логотипа и файла хранится
+в отдельном файле на каждый адрес (LOGO_CACHE_DIR/urls/<sha1 адреса>.json):
+оно переживает перезапуск, а воркеры, делящие каталог, не затирают записи
+друг друга. Уменьшение делает Pillow в рабочем потоке; без Pillow
+сохраняется исходная картинка.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from io import BytesIO
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlparse
+
+from coalesce import SingleFlight
+from config import env_bool, env_float, env_int, env_str
+from upstream import HostBusy, UpstreamPool
+
+try:
+    from PIL import Image  # type: ignore
+except ImportError:  # Pillow необязателен, без него логотипы не уменьшаются
+    Image = None
+
+logger = logging.getLogger("iptv.logos")
+
+LOGO_CACHE_DIR = env_str("LOGO_CACHE_DIR", "logo_cache")
+# Наибольшая сторона миниатюры, пикселей
+LOGO_SIZE = env_int("LOGO_SIZE", 96)
+# Одновременные загрузки логотипов со всех хостов
+LOGO_CONCURRENCY = env_int("LOGO_CONCURRENCY", 8)
+LOGO_FETCH_TIMEOUT = env_float("LOGO_FETCH_TIMEOUT", 10.0)
+# Картинки больше не скачиваются
+LOGO_MAX_BYTES = env_int("LOGO_MAX_BYTES", 2 * 1024 * 1024)
+# Через сколько секунд повторить логотип, который не удалось получить
+LOGO_RETRY_AFTER = env_float("LOGO_RETRY_AFTER", 6 * 60 * 60)
+# Загружать все логотипы сразу после обновления плейлиста
+LOGO_PREWARM = env_bool("LOGO_PREWARM", False)
+
+# Форматы, которые отдаются как есть, если Pillow нет или он их не читает
+PASSTHROUGH_TYPES = {
+    "image/png": "png", "image/jpeg": "jpg", "image/gif": "gif",
+    "image/webp": "webp", "image/svg+xml": "svg",
+}
+
+
+def sniff_type(body: bytes) -> str:
+    """Тип картинки по первым байтам: хосты нередко отдают логотипы как application/octet-stream"""
+    if body.startswith(b"\x89PNG"):
+        return "image/png"
+    if body.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if body.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if body[:4] == b"RIFF" and body[8:12] == b"WEBP":
+        return "image/webp"
+    if b"<svg" in body[:1024]:
+        return "image/svg+xml"
+    return ""
+
+
+def make_thumbnail(body: bytes, content_type: str, size: int = LOGO_SIZE) -> Tuple[bytes, str]:
+    """Миниатюра в PNG (прозрачность сохраняется); вызывается в рабочем потоке"""
+    if content_type not in PASSTHROUGH_TYPES:
+        content_type = sniff_type(body) or content_type
+    if Image is not None and content_type != "image/svg+xml":
+        try:
+            with Image.open(BytesIO(body)) as image:
+                image.draft("RGB", (size, size))
+                image = image.convert("RGBA")
+                image.thumbnail((size, size))
+                output = BytesIO()
+                image.save(output, format="PNG", optimize=True)
+                return output.getvalue(), "image/png"
+        except Exception as e:
+            logger.debug("Не удалось уменьшить логотип: %s", e)
+    if content_type not in PASSTHROUGH_TYPES:
+        raise ValueError(f"неподдерживаемый тип {content_type or 'без Content-Type'}")
+    return body, content_type
+
+
+class LogoFile:
+    __slots__ = ('digest', 'media_type', 'path')
+
+    def __init__(self, digest: str, media_type: str, path: str):
+        self.digest = digest
+        self.media_type = media_type
+        self.path = path
+
+
+class LogoStore:
+    def __init__(self, pool: UpstreamPool, directory: str = LOGO_CACHE_DIR,
+                 size: int = LOGO_SIZE, concurrency: int = LOGO_CONCURRENCY,
+                 timeout: float = LOGO_FETCH_TIMEOUT, max_bytes: int = LOGO_MAX_BYTES,
+                 retry_after: float = LOGO_RETRY_AFTER):
+        self.pool = pool
+        self.directory = directory
+        self.size = size
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        # адрес логотипа -> (хэш содержимого, тип)
+        self.index: Dict[str, Tuple[str, str]] = {}
+        # адрес -> время, до которого новые попытки не делаются
+        self.failures: Dict[str, float] = {}
+        self.fetched = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._flights = SingleFlight()
+        self._prewarm: Optional[asyncio.Task] = None
+
+    def entry_path(self, url: str) -> str:
+        return os.path.join(self.directory, "urls", hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def file_path(self, digest: str, media_type: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}.{PASSTHROUGH_TYPES.get(media_type, 'img')}")
+
+    async def start(self):
+        if Image is None:
+            logger.error("Pillow не установлен: логотипы отдаются без уменьшения (pip install Pillow)")
+        await asyncio.to_thread(os.makedirs, os.path.join(self.directory, "urls"), exist_ok=True)
+        migrated = await asyncio.to_thread(self._migrate_index)
+        if migrated:
+            logger.info("Индекс логотипов переведен на записи по адресам: %s адресов", migrated)
+
+    async def close(self):
+        if self._prewarm is not None:
+            self._prewarm.cancel()
+            await asyncio.gather(self._prewarm, return_exceptions=True)
+            self._prewarm = None
+
+    async def get(self, url: str) -> Optional[LogoFile]:
+        """Файл миниатюры; None - логотип получить не удалось"""
+        known = self.index.get(url)
+        if known is not None:
+            path = self.file_path(*known)
+            if await asyncio.to_thread(os.path.exists, path):
+                return LogoFile(known[0], known[1], path)
+            # Каталог кэша почистили на ходу - логотип загружается заново
+            if self.index.get(url) == known:
+                del self.index[url]
+        if self.failures.get(url, 0) > time.time():
+            return None
+        return await self._flights.do(url, urlparse(url).netloc, lambda: self._load(url))
+
+    async def _load(self, url: str) -> Optional[LogoFile]:
+        """Логотип с диска (его мог скачать и другой воркер), иначе загрузка"""
+        known = await asyncio.to_thread(self._read_entry, url)
+        if known is not None:
+            self.index[url] = known
+            return LogoFile(known[0], known[1], self.file_path(*known))
+        return await self._fetch(url)
+
+    def prewarm(self, urls: Iterable[str]):
+        """Загружает в фоне логотипы, которых еще нет на диске"""
+        missing = [url for url in dict.fromkeys(urls) if url not in self.index]
+        if self._prewarm is not None:
+            self._prewarm.cancel()
+        if missing:
+            logger.info("Загрузка %s логотипов", len(missing))
+            self._prewarm = asyncio.ensure_future(asyncio.gather(*(self.get(url) for url in missing)))
+
+    async def _fetch(self, url: str) -> Optional[LogoFile]:
+        try:
+            async with self._slots, self.pool.host_slot(url):
+                body, content_type = await self._download(url)
+            data, media_type = await asyncio.to_thread(make_thumbnail, body, content_type, self.size)
+            digest = hashlib.sha256(data).hexdigest()
+            path = self.file_path(digest, media_type)
+            await asyncio.to_thread(self._write_file, path, data)
+        except asyncio.CancelledError:
+            raise
+        except HostBusy:
+            # Хост занят зрителями - это не повод откладывать логотип надолго
+            return None
+        except Exception as e:
+            self.failed += 1
+            self.failures[url] = time.time() + self.retry_after
+            logger.warning("Логотип %s не получен: %s", url, str(e) or type(e).__name__,
+                           extra={"host": urlparse(url).netloc})
+            return None
+        self.fetched += 1
+        self.bytes_in += len(body)
+        self.bytes_out += len(data)
+        self.failures.pop(url, None)
+        self.index[url] = (digest, media_type)
+        try:
+            await asyncio.to_thread(self._write_entry, url, digest, media_type)
+        except OSError as e:
+            logger.warning("Не удалось сохранить запись логотипа: %s", e)
+        return LogoFile(digest, media_type, path)
+
+    async def _download(self, url: str) -> Tuple[bytes, str]:
+        async with self.pool.client.stream("GET", url, follow_redirects=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                raise ValueError(f"HTTP {response.status_code}")
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(f"больше {self.max_bytes} байт")
+                chunks.append(chunk)
+        return b"".join(chunks), content_type
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _migrate_index(self) -> int:
+        """Общий index.json прежних версий раскладывается в записи по адресам"""
+        path = os.path.join(self.directory, "index.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                index = json.load(f)
+            for url, (digest, media_type) in index.items():
+                self._write_entry(url, digest, media_type)
+            os.remove(path)
+        except (OSError, ValueError, TypeError):
+            return 0
+        return len(index)
+
+    def _read_entry(self, url: str) -> Optional[Tuple[str, str]]:
+        """Запись адреса, если ее файл миниатюры на месте"""
+        try:
+            with open(self.entry_path(url), encoding="utf-8") as f:
+                entry = json.load(f)
+            known = (entry["digest"], entry["type"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if entry.get("url") != url or not os.path.exists(self.file_path(*known)):
+            return None
+        return known
+
+    def _write_entry(self, url: str, digest: str, media_type: str):
+        path = self.entry_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "digest": digest, "type": media_type}, f)
+        os.replace(tmp, path)
+
+    def stats(self) -> Dict:
+        return {
+            "pillow": Image is not None,
+            "cached": len(self.index),
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "failing": sum(1 for until in self.failures.values() if until > time.time()),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "prewarm": self._prewarm is not None and not self._prewarm.done(),
+        }
@@ -0,0 +1,194 @@
+"""
+Журнал без задержек цикла событий: записи передаются через очередь
+фоновому потоку, который форматирует их и пишет в консоль и app.log.
+На горячем пути записи прореживаются по маршрутам, повторяющиеся ошибки
+источников ограничиваются по частоте.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from typing import Dict, Optional, Tuple
+
+from config import env_bool, env_float, env_int, env_list, env_str
+
+# json - по записи JSON на строку, text - прежний формат
+LOG_FORMAT = env_str("LOG_FORMAT", "json")
+LOG_LEVEL = env_str("LOG_LEVEL", "INFO").upper()
+LOG_FILE = env_str("LOG_FILE", "app.log")
+LOG_FILE_LEVEL = env_str("LOG_FILE_LEVEL", "WARNING").upper()
+# Доля записываемых INFO-записей по маршрутам: "proxy=0.01,upstream=0.01" (1 - все)
+LOG_SAMPLE_RATES = env_list("LOG_SAMPLE_RATES", "proxy=0.05,upstream=0.05")
+# Одинаковых предупреждений и ошибок (шаблон + хост) не больше LOG_ERROR_BURST за LOG_ERROR_WINDOW секунд
+LOG_ERROR_BURST = env_int("LOG_ERROR_BURST", 5)
+LOG_ERROR_WINDOW = env_float("LOG_ERROR_WINDOW", 60.0)
+LOG_QUEUE_SIZE = env_int("LOG_QUEUE_SIZE", 10000)
+LOG_ASYNC = env_bool("LOG_ASYNC", True)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты LogRecord, которые не переносятся в JSON как дополнительные поля
+_RECORD_FIELDS = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+def _parse_rates(items) -> Dict[str, float]:
+    rates: Dict[str, float] = {}
+    for item in items:
+        route, _, rate = item.partition("=")
+        try:
+            rates[route.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLE_RATES = _parse_rates(LOG_SAMPLE_RATES)
+
+
+def sampled(route: str) -> bool:
+    """
+    Писать ли INFO-запись маршрута. Проверяется до вызова logger,
+    поэтому отброшенная запись не создается и не форматируется
+    """
+    rate = SAMPLE_RATES.get(route, 1.0)
+    return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись - одна строка JSON; поля из extra= попадают в нее как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Пропускает не больше burst одинаковых предупреждений и ошибок за window секунд.
+    Одинаковые - с тем же шаблоном сообщения (до подстановки аргументов) и хостом
+    из extra; о пропущенных сообщается в первой записи следующего окна.
+    """
+
+    def __init__(self, burst: int = LOG_ERROR_BURST, window: float = LOG_ERROR_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._windows: Dict[Tuple, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        key = (record.name, record.msg, getattr(record, "host", None))
+        now = time.monotonic()
+        state = self._windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            suppressed = state[2] if state is not None else 0
+            if len(self._windows) > 4096:
+                self._windows.clear()
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        if state[1] < self.burst:
+            state[1] += 1
+            return True
+        state[2] += 1
+        return False
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        return f"{text} (пропущено повторов: {suppressed})" if suppressed else text
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging() -> None:
+    """
+    Корневой логгер получает только QueueHandler: в цикле событий запись
+    лишь кладется в очередь, форматирование и запись в файл идут в потоке.
+    Переполненная очередь отбрасывает записи, а не блокирует обработку запросов.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+        file_handler.setLevel(LOG_FILE_LEVEL)
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к источнику - на горячем пути это лишнее
+    if root.level > logging.DEBUG:
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if not LOG_ASYNC:
+        for handler in handlers:
+            handler.addFilter(RateLimitFilter())
+            root.addHandler(handler)
+        return
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def log_records_dropped() -> int:
+    """Сколько записей отброшено из-за переполненной очереди"""
+    return _DroppingQueueHandler.dropped
+
+
+def stop_logging() -> None:
+    """Дописывает оставшиеся в очереди записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование откладывается до потока записи: аргументы уже
+        # неизменяемы (строки и числа), исключение приводится к тексту здесь
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
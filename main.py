@@ -1,34 +1,92 @@
 from fastapi import FastAPI, Request, status, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse, Response, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 import os
 import re
+import asyncio
 import httpx  # type: ignore
 import logging
 import time
 import io
+from contextlib import asynccontextmanager, AsyncExitStack
 from urllib.parse import urljoin, urlparse, unquote, quote_plus
 from functools import lru_cache
 from typing import Optional, Dict, Any, Tuple
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
+from catalog import Catalog, Channel, logo_version
+from playlist import PlaylistError, PlaylistRefresher
+from health import HealthProber
+from epg import EPG_URLS, EpgStore, epg_urls
+from logos import LOGO_PREWARM, LogoStore
+from metrics import (ACTIVE_STREAMS, MANIFEST_REWRITE, REGISTRY, RELAYED_BYTES, CallbackMetric,
+                     LoopLagMonitor, ProxyViewers, UpstreamTrace, finish_trace, upstream_kind)
+from prefetch import Prefetcher
+from redirects import RedirectCache
+from profiles import PROFILE_PARAM, HeaderProfile, ProfileStats, profile_suffix
+from relay import RELAY_ENABLED, RELAY_START_TIMEOUT, RelayHub, RelayUnsupported
+from hls_rewriter import DELIVERY_DIRECTIVES, HlsRewriter, with_delivery_directives
+from dash_rewriter import DashRewriter
+from httputil import choose_encoding, compress_variants, etag_matches, http_date, make_etag, not_modified_since
+from cache import (ResponseCache, CacheEntry, SharedStore, CACHE_MAX_BYTES, SEGMENT_MAX_CACHE_BYTES,
+                   SHARED_LOCAL_CACHE_BYTES, canonical_cache_key, classify_manifest, manifest_ttl)
+from coalesce import SingleFlight, UpstreamHandle
+from logsetup import log_records_dropped, sampled, setup_logging
+from workers import CATALOG, CLEAR, EPG as EPG_EVENT, HEALTH as HEALTH_EVENT, REFRESH, WorkerCoordinator
+from upstream import (UpstreamPool, HostBusy, DEFAULT_ORIGIN, DEFAULT_REFERER, FORWARD_CLIENT_USER_AGENT,
+                      apply_cache_buster, guess_content_kind, upstream_user_agent)
+
+# Настройка логирования: запись в консоль и app.log (только WARNING и выше) идет
+# в фоновом потоке, цикл событий лишь кладет запись в очередь
+setup_logging()
 logger = logging.getLogger("iptv")
 
-# Устанавливаем уровень WARNING для файлового обработчика
-for handler in logger.handlers:
-    if isinstance(handler, logging.FileHandler):
-        handler.setLevel(logging.WARNING)
+# Общий пул соединений к внешним источникам
+UPSTREAM = UpstreamPool()
+
+# Согласование воркеров при запуске с --workers N (включается WORKERS_SHARED=1)
+WORKERS = WorkerCoordinator()
+
+# Плейлист каналов: снимок с диска при старте, дальше обновление в фоне
+PLAYLIST = PlaylistRefresher(UPSTREAM)
+# Телепрограмма из XMLTV-файлов плейлиста (url-tvg) или EPG_URLS
+EPG = EpgStore(UPSTREAM, lambda: EPG_URLS or epg_urls(PLAYLIST.catalog.header if PLAYLIST.catalog else {}))
+# Уменьшенные логотипы каналов на диске
+LOGOS = LogoStore(UPSTREAM)
+# Замер задержки цикла событий (включается LOOP_LAG_MONITOR=1)
+LOOP_LAG = LoopLagMonitor()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await UPSTREAM.start()
+    logger.info("Пул соединений запущен (HTTP/2: %s)", UPSTREAM.http2)
+    await WORKERS.start()
+    await LOGOS.start()
+    if not WORKERS.is_leader:
+        # Ведомый воркер берет каталог и результаты проверок у ведущего
+        await adopt_catalog()
+        await adopt_health()
+        await adopt_epg()
+    await PLAYLIST.start(background=WORKERS.is_leader)
+    if WORKERS.is_leader:
+        HEALTH.start()
+        EPG.start()
+    LOOP_LAG.start()
+    try:
+        yield
+    finally:
+        await LOOP_LAG.close()
+        await EPG.close()
+        await LOGOS.close()
+        await HEALTH.close()
+        await PLAYLIST.close()
+        await PREFETCHER.close()
+        await RELAY.close()
+        await WORKERS.close()
+        await UPSTREAM.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Подключение статики
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -36,20 +94,41 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Подключение шаблонов
 templates = Jinja2Templates(directory="templates")
 
-# Кэш для URL запросов
-URL_CACHE: Dict[str, Tuple[int, Any]] = {}
-CACHE_TTL = 180  # Время жизни кэша в секундах (увеличено с 30 до 180 секунд)
+# Кэш для URL запросов: бюджет в байтах, LRU и TTL по типу содержимого.
+# При нескольких воркерах под ним общий для всех каталог, а в памяти - только верхний уровень
+SHARED_CACHE = SharedStore(WORKERS.path("cache")) if WORKERS.enabled else None
+URL_CACHE = ResponseCache(max_bytes=SHARED_LOCAL_CACHE_BYTES if SHARED_CACHE else CACHE_MAX_BYTES,
+                          shared=SHARED_CACHE)
 
-# URL удаленного плейлиста IPTV
-PLAYLIST_URL = "https://gitlab.com/iptv135435/iptvshared/raw/main/IPTV_SHARED.m3u"
-# Как часто обновлять плейлист (в секундах) - каждые 6 часов
-PLAYLIST_REFRESH_TIME = 6 * 60 * 60
-# Время последнего обновления плейлиста
-LAST_PLAYLIST_UPDATE = 0
-# Кэш плейлиста
-PLAYLIST_CACHE = None
+# Счетчики запросов к источникам и сэкономленных благодаря кэшу
+PROXY_STATS = {"upstream_fetches": 0, "saved_upstream_fetches": 0}
+
+# Конечные адреса цепочек редиректов
+REDIRECTS = RedirectCache()
+
+# Коды ответов источников по профилям заголовков каналов
+PROFILE_STATS = ProfileStats()
+
+# Переписывание ссылок в HLS-плейлистах и DASH-манифестах
+HLS_REWRITER = HlsRewriter()
+DASH_REWRITER = DashRewriter()
+
+# Одновременные запросы одного плейлиста или сегмента объединяются в один
+MANIFEST_FLIGHTS = SingleFlight()
+SEGMENT_FLIGHTS = SingleFlight()
+
+def cache_key_for(url: str, user_agent: str, profile: Optional[HeaderProfile] = None) -> str:
+    """
+    Ключ кэша: User-Agent входит в него, только если он передается источнику от зрителя;
+    профиль заголовков канала - всегда, так как источник может отвечать по-разному
+    """
+    vary = {}
+    if FORWARD_CLIENT_USER_AGENT:
+        vary["user-agent"] = user_agent
+    if profile is not None:
+        vary["profile"] = profile.id
+    return canonical_cache_key(url, vary)
 
-# Функция очистки URL от вложенных префиксов /proxy?url=
 def sanitize_url(url: Optional[str]) -> Optional[str]:
     # Удаляем все вложенные /proxy?url= префиксы
     if not url:
@@ -70,29 +149,65 @@ def sanitize_url(url: Optional[str]) -> Optional[str]:
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    logger.info(f"Доступ к главной странице: {request.client.host}")
+    logger.info("Доступ к главной странице: %s", request.client.host)
     return templates.TemplateResponse("index.html", {"request": request})
 
 # Функция ручной обработки редиректов
-async def follow_redirects_manually(client, url, headers, max_redirects=8):
-    """Вручную следует по редиректам до макс. количества переходов"""
+async def follow_redirects_manually(client, url, headers, max_redirects=8, timeout=None, stream=False,
+                                    trace: Optional[UpstreamTrace] = None, remember: bool = True):
+    """
+    Вручную следует по редиректам до макс. количества переходов.
+    Конечный адрес цепочки запоминается: следующие запросы идут на него сразу,
+    а если он ответил не 2xx (истек токен сессии), цепочка проходится заново.
+    trace получает события httpx всех запросов цепочки (метрики /metrics).
+    remember=False - служебный запрос (проверка канала): цепочка проходится
+    целиком, без кэша редиректов, его статистики и записей в журнал.
+    """
+    extensions = {"trace": trace} if trace is not None else None
+    cached_url = REDIRECTS.get(url) if remember else None
+    if cached_url is not None:
+        request = client.build_request("GET", cached_url, headers=headers, timeout=timeout,
+                                       extensions=extensions)
+        try:
+            response = await client.send(request, stream=stream)
+        except httpx.TransportError as e:
+            response = None
+            logger.info("Сохраненный адрес редиректа %s недоступен: %s", cached_url, e)
+        if response is not None:
+            if response.status_code < 300:
+                REDIRECTS.record_hops(0)
+                return response
+            logger.info("Сохраненный адрес редиректа %s ответил %s, проходим цепочку заново",
+                        cached_url, response.status_code)
+            if stream:
+                await response.aclose()
+        REDIRECTS.invalidate(url)
+    
+    origin_url = url
     for i in range(max_redirects):
-        response = await client.get(url, headers=headers)
+        request = client.build_request("GET", url, headers=headers, timeout=timeout, extensions=extensions)
+        response = await client.send(request, stream=stream)
         
         # Если это не редирект, возвращаем ответ
         if response.status_code < 300 or response.status_code >= 400:
+            if remember:
+                REDIRECTS.record_hops(i)
+                if i > 0 and response.status_code < 300:
+                    REDIRECTS.put(origin_url, url, i)
             return response
             
         # Получаем новый URL из заголовка Location
         new_url = response.headers.get('location')
         if not new_url:
             return response
+        
+        # Тело редиректа не нужно, освобождаем соединение
+        if stream:
+            await response.aclose()
             
         # Если относительный URL, преобразуем в абсолютный
         if not new_url.startswith(('http://', 'https://')):
-            parsed_url = urlparse(url)
-            base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-            new_url = urljoin(base_url, new_url)
+            new_url = urljoin(url, new_url)
             
         # Обновляем URL и пробуем снова
         url = new_url
@@ -100,124 +215,480 @@ async def follow_redirects_manually(client, url, headers, max_redirects=8):
     # Если достигли максимального числа редиректов
     raise HTTPException(status_code=310, detail=f"Слишком много редиректов (макс: {max_redirects})")
 
-# Функция для получения контента по URL
-async def fetch_content(url: str, user_agent: str) -> Tuple[Any, Dict, int]:
+# Заголовки ответа, которые не передаются зрителю
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade')
+
+def filter_response_headers(response, stream: bool) -> Dict[str, str]:
     """
-    Делает запрос к внешнему ресурсу
-    Возвращает (контент, заголовки, статус-код)
+    Отбирает заголовки ответа для зрителя.
+    При потоковой передаче тело идет без перекодирования,
+    поэтому Content-Length и Content-Range сохраняются.
     """
-    # Формируем заголовки запроса    
+    encoded = 'content-encoding' in response.headers
+    drop = HOP_BY_HOP_HEADERS
+    if not stream or encoded:
+        drop = drop + ('content-encoding', 'content-length')
+    return {k: v for k, v in response.headers.items() if k.lower() not in drop}
+
+def upstream_headers(user_agent: str, stream: bool = False,
+                     profile: Optional[HeaderProfile] = None) -> Dict[str, str]:
+    """Заголовки запроса к источнику; заголовки профиля канала заменяют стандартные"""
     headers = {
         'User-Agent': user_agent,
         'Accept': '*/*',
         'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Origin': 'https://live-mirror-01.ott.tricolor.tv',
-        'Referer': 'https://live-mirror-01.ott.tricolor.tv/',
     }
+    if DEFAULT_ORIGIN:
+        headers['Origin'] = DEFAULT_ORIGIN
+    if DEFAULT_REFERER:
+        headers['Referer'] = DEFAULT_REFERER
+    if stream:
+        # Сегменты передаются как есть, без сжатия - байты идут зрителю без перекодирования
+        headers['Accept-Encoding'] = 'identity'
+    if profile is not None:
+        headers.update(profile.headers)
+    return headers
+
+# Функция для получения контента по URL
+async def fetch_content(url: str, user_agent: str, stream: bool = False,
+                        range_headers: Optional[Dict[str, str]] = None,
+                        exit_stack: Optional[AsyncExitStack] = None,
+                        profile: Optional[HeaderProfile] = None,
+                        trace_kind: Optional[str] = None) -> Tuple[Any, Dict, int]:
+    """
+    Делает запрос к внешнему ресурсу
+    Возвращает (контент, заголовки, статус-код)
+    
+    Заголовки профиля канала (User-Agent, Referer, Origin из плейлиста) заменяют стандартные.
+    
+    При stream=True тело не читается: ответ остается открытым, а его закрытие
+    регистрируется в exit_stack. Слот хоста держится только до заголовков ответа:
+    фильм или поток udpxy может передаваться часами, а число соединений
+    и так ограничивает пул.
+    
+    trace_kind - тип ресурса для метрик; если он станет известен только
+    по содержимому, вызывающий передает его позже через finish_trace().
+    """
+    # Формируем заголовки запроса    
+    headers = upstream_headers(user_agent, stream, profile)
+    if range_headers:
+        headers.update(range_headers)
+    
+    # Таймауты зависят от типа ресурса: плейлист или сегмент
+    timeout = UPSTREAM.timeout_for(guess_content_kind(url))
+    trace = UpstreamTrace(trace_kind)
+    
+    local_stack = None
+    if exit_stack is None:
+        exit_stack = local_stack = AsyncExitStack()
     
     # Выполняем запрос
     try:
-        # Создаем клиент с таймаутом, но без follow_redirects (так как он не везде работает)
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            logger.info(f"Запрос к внешнему ресурсу: {url}")
-            
+        # Общий клиент без follow_redirects (так как он не везде работает)
+        client = UPSTREAM.client
+        if sampled("upstream"):
+            logger.info("Запрос к внешнему ресурсу: %s", url)
+        
+        async with UPSTREAM.host_slot(url):
             # Сначала пробуем прямой запрос
             try:
                 # Делаем запрос и вручную обрабатываем редиректы
-                response = await follow_redirects_manually(client, url, headers, max_redirects=8)
-                
-                # Получаем заголовки ответа
-                resp_headers = {k: v for k, v in response.headers.items() 
-                                if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
-                
-                return response, resp_headers, response.status_code
-                
+                response = await follow_redirects_manually(client, url, headers, max_redirects=8,
+                                                           timeout=timeout, stream=stream, trace=trace)
+            except (httpx.TimeoutException, httpx.NetworkError):
+                # Источник недоступен - повторять тот же запрос напрямую бессмысленно
+                raise
             except Exception as e:
-                logger.warning(f"Ошибка при следовании редиректам: {str(e)}, пробуем прямой запрос")
+                logger.warning("Ошибка при следовании редиректам: %s, пробуем прямой запрос", e,
+                               extra={"host": urlparse(url).netloc})
                 # Если что-то пошло не так при обработке редиректов, делаем прямой запрос
-                response = await client.get(url, headers=headers)
-                
-                # Получаем заголовки ответа
-                resp_headers = {k: v for k, v in response.headers.items() 
-                                if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
-                
-                return response, resp_headers, response.status_code
+                request = client.build_request("GET", url, headers=headers, timeout=timeout,
+                                               extensions={"trace": trace})
+                response = await client.send(request, stream=stream)
+        
+        if stream:
+            exit_stack.push_async_callback(response.aclose)
+        PROFILE_STATS.record(profile, response.status_code)
+        
+        # Получаем заголовки ответа
+        resp_headers = filter_response_headers(response, stream)
+        
+        return response, resp_headers, response.status_code
             
+    except HostBusy as e:
+        logger.warning("Нет свободного слота для %s за %s с", e.host, UPSTREAM.slot_timeout,
+                       extra={"host": e.host})
+        raise HTTPException(status_code=503, detail=str(e))
     except httpx.HTTPStatusError as e:
-        logger.error(f"Ошибка HTTP статуса при запросе {url}: {str(e)}")
+        PROFILE_STATS.record(profile, e.response.status_code)
+        logger.error("Ошибка HTTP статуса при запросе %s: %s", url, e, extra={"host": urlparse(url).netloc})
         raise HTTPException(status_code=e.response.status_code, detail=f"Ошибка удаленного сервера: {str(e)}")
     except httpx.TimeoutException:
-        logger.error(f"Таймаут при запросе {url}")
+        PROFILE_STATS.record(profile, "timeout")
+        logger.error("Таймаут при запросе %s", url, extra={"host": urlparse(url).netloc})
         raise HTTPException(status_code=504, detail="Превышено время ожидания ответа от сервера")
     except httpx.RequestError as e:
-        logger.error(f"Ошибка запроса к {url}: {str(e)}")
+        PROFILE_STATS.record(profile, "error")
+        logger.error("Ошибка запроса к %s: %s", url, e, extra={"host": urlparse(url).netloc})
         raise HTTPException(status_code=502, detail=f"Ошибка подключения: {str(e)}")
     except Exception as e:
-        logger.error(f"Неожиданная ошибка при запросе {url}: {str(e)}")
+        logger.error("Неожиданная ошибка при запросе %s: %s", url, e, extra={"host": urlparse(url).netloc})
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка: {str(e)}")
+    finally:
+        if local_stack is not None:
+            await local_stack.aclose()
+
+# Размер фрагмента при передаче потока зрителю
+STREAM_CHUNK_SIZE = 64 * 1024
+
+async def relay_upstream(response, exit_stack: Optional[AsyncExitStack] = None, on_complete=None):
+    """
+    Передает тело ответа зрителю по мере поступления.
+    Следующий фрагмент читается только после отправки предыдущего,
+    при отключении зрителя соединение с источником закрывается.
+    Если задан on_complete, полностью полученное тело (не больше
+    SEGMENT_MAX_CACHE_BYTES) передается в него, например для кэширования.
+    """
+    chunks = [] if on_complete is not None else None
+    collected = 0
+    relayed = RELAYED_BYTES.labels("upstream")
+    ACTIVE_STREAMS.inc()
+    try:
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            relayed.inc(len(chunk))
+            if chunks is not None:
+                collected += len(chunk)
+                if collected > SEGMENT_MAX_CACHE_BYTES:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            await on_complete(b''.join(chunks))
+    finally:
+        ACTIVE_STREAMS.dec()
+        if exit_stack is not None:
+            await exit_stack.aclose()
+        else:
+            await response.aclose()
+
+async def counted_chunks(chunks, counter):
+    """Передача общей загрузки зрителю с учетом отданных байт"""
+    ACTIVE_STREAMS.inc()
+    try:
+        async for chunk in chunks:
+            counter.inc(len(chunk))
+            yield chunk
+    finally:
+        ACTIVE_STREAMS.dec()
 
 # Функция для получения кэшированного контента
-async def fetch_cached_content(url: str, user_agent: str) -> Tuple[Any, Dict, int]:
+async def fetch_cached_content(url: str, user_agent: str,
+                               profile: Optional[HeaderProfile] = None) -> CacheEntry:
     """
-    Кэширующая обертка для запросов к внешним ресурсам
-    Возвращает (контент, заголовки, статус-код)
+    Кэширующая обертка для запросов к плейлистам
+    Возвращает запись кэша (тело, заголовки, статус-код, тип содержимого)
     """
-    # Проверяем кэш
-    current_time = time.time()
-    cache_key = f"{url}:{user_agent}"
-    
-    if cache_key in URL_CACHE:
-        timestamp, cache_data = URL_CACHE[cache_key]
-        if current_time - timestamp < CACHE_TTL:
-            logger.debug(f"Используем кэшированный ответ для {url}")
-            return cache_data
-    
-    # Получаем содержимое через некэшированную функцию
-    result = await fetch_content(url, user_agent)
+    cache_key = cache_key_for(url, user_agent, profile)
+    cached = await URL_CACHE.get(cache_key)
+    if cached is not None:
+        logger.debug("Используем кэшированный ответ для %s", url)
+        PROXY_STATS["saved_upstream_fetches"] += 1
+        return cached
     
-    # Сохраняем в кэш
-    URL_CACHE[cache_key] = (current_time, result)
+    async def load() -> CacheEntry:
+        # Получаем содержимое через некэшированную функцию
+        PROXY_STATS["upstream_fetches"] += 1
+        response, resp_headers, status_code = await fetch_content(apply_cache_buster(url), user_agent,
+                                                                  profile=profile)
+        body = response.content
+        content_type = response.headers.get('content-type', '').lower()
+        
+        # TTL зависит от типа плейлиста: мастер, живой или VOD
+        text = body.decode('utf-8', errors='replace')
+        kind = classify_manifest(text)
+        finish_trace(response, upstream_kind(kind, text))
+        ttl = manifest_ttl(kind, text) if status_code == 200 else 0
+        
+        return await URL_CACHE.put(cache_key, body, resp_headers, status_code, content_type, kind, ttl,
+                                   url=str(response.request.url))
     
-    return result
+    # Если этот плейлист уже загружается для другого зрителя - ждем тот же результат
+    if cache_key in MANIFEST_FLIGHTS:
+        PROXY_STATS["saved_upstream_fetches"] += 1
+    return await MANIFEST_FLIGHTS.do(cache_key, urlparse(url).netloc, load)
 
-# Функция загрузки удаленного плейлиста
-async def fetch_remote_playlist():
-    """Загружает плейлист с удаленного URL и возвращает его содержимое"""
-    global LAST_PLAYLIST_UPDATE, PLAYLIST_CACHE
-    
-    current_time = time.time()
-    
-    # Проверяем, нужно ли обновлять плейлист
-    if PLAYLIST_CACHE is not None and current_time - LAST_PLAYLIST_UPDATE < PLAYLIST_REFRESH_TIME:
-        logger.debug("Используем кэшированный плейлист")
-        return PLAYLIST_CACHE
-    
+# Открытие потока из источника
+async def open_upstream(url: str, user_agent: str,
+                        range_headers: Optional[Dict[str, str]] = None,
+                        profile: Optional[HeaderProfile] = None) -> UpstreamHandle:
+    """Открывает ответ источника потоком, не читая тело"""
+    PROXY_STATS["upstream_fetches"] += 1
+    exit_stack = AsyncExitStack()
     try:
-        logger.info(f"Загрузка удаленного плейлиста: {PLAYLIST_URL}")
+        response, resp_headers, status_code = await fetch_content(
+            apply_cache_buster(url), user_agent, stream=True, range_headers=range_headers,
+            exit_stack=exit_stack, profile=profile, trace_kind="segment")
+    except BaseException:
+        await exit_stack.aclose()
+        raise
+    return UpstreamHandle(response, resp_headers, status_code, exit_stack)
+
+def is_manifest_type(content_type: str) -> bool:
+    return 'mpegurl' in content_type or 'dash+xml' in content_type
+
+async def open_shared_segment(url: str, user_agent: str, cache_key: str,
+                              profile: Optional[HeaderProfile] = None) -> UpstreamHandle:
+    """
+    Открывает сегмент так, чтобы его тело могли читать все зрители,
+    запросившие его одновременно. Разделяются только ответы 200 известной
+    длины: потоки без Content-Length (бесконечный TS) отдаются одному зрителю.
+    """
+    handle = await open_upstream(url, user_agent, profile=profile)
+    length = handle.content_length
+    if (handle.status_code == 200 and length is not None and length <= SEGMENT_MAX_CACHE_BYTES
+            and not is_manifest_type(handle.content_type)):
+        headers = stream_response_headers(handle.headers, handle.content_type)
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(PLAYLIST_URL)
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка загрузки плейлиста: HTTP {response.status_code}")
-                if PLAYLIST_CACHE:  # Используем старый кэш, если есть
-                    return PLAYLIST_CACHE
-                raise HTTPException(status_code=response.status_code, 
-                                   detail=f"Ошибка загрузки плейлиста: HTTP {response.status_code}")
-            
-            # Обновляем кэш и время последнего обновления
-            PLAYLIST_CACHE = response.text
-            LAST_PLAYLIST_UPDATE = current_time
-            
-            logger.info(f"Плейлист успешно загружен, размер: {len(PLAYLIST_CACHE)} байт")
-            return PLAYLIST_CACHE
-            
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке плейлиста: {str(e)}")
-        if PLAYLIST_CACHE:  # Используем старый кэш, если есть
-            return PLAYLIST_CACHE
-        raise HTTPException(status_code=500, 
-                           detail=f"Не удалось загрузить плейлист: {str(e)}")
+        async def store(body: bytes):
+            await URL_CACHE.put(cache_key, body, headers, handle.status_code, handle.content_type, "segment")
+        
+        shared = handle.share(STREAM_CHUNK_SIZE, on_complete=store)
+        # Зрители, пришедшие, пока тело еще скачивается, читают ту же загрузку:
+        # сначала уже полученные фрагменты, затем новые по мере поступления
+        SEGMENT_FLIGHTS.hold(cache_key, handle, shared.task)
+    return handle
+
+async def prefetch_playlist(url: str, user_agent: str,
+                            profile: Optional[HeaderProfile]) -> Optional[Tuple[str, str]]:
+    """
+    Текст плейлиста для упреждающей загрузки (через общий кэш плейлистов)
+    и адрес, от которого разрешаются ссылки - тот же, что у переписанного плейлиста
+    """
+    entry = await fetch_cached_content(url, user_agent, profile)
+    if entry.status_code != 200:
+        return None
+    return entry.body.decode('utf-8', errors='replace'), entry.url or url
+
+async def prefetch_segment(url: str, user_agent: str, profile: Optional[HeaderProfile]) -> Optional[str]:
+    """
+    Загружает сегмент в кэш. Загрузка идет через SEGMENT_FLIGHTS, поэтому
+    зритель, запросивший сегмент в это время, читает ту же загрузку.
+    """
+    cache_key = cache_key_for(url, user_agent, profile)
+    handle = await SEGMENT_FLIGHTS.do(
+        cache_key, urlparse(url).netloc,
+        lambda: open_shared_segment(url, user_agent, cache_key, profile),
+        on_orphan=UpstreamHandle.discard)
+    if handle.shared is None:
+        # Ответ, который нельзя закэшировать, сразу закрываем
+        if handle.claim():
+            await handle.exit_stack.aclose()
+        return None
+    await handle.shared.task
+    return cache_key if handle.shared.error is None else None
+
+# Упреждающая загрузка сегментов для каналов, которые сейчас смотрят
+PREFETCHER = Prefetcher(
+    prefetch_playlist,
+    prefetch_segment,
+    lambda url, user_agent, profile: cache_key_for(url, user_agent, profile) in URL_CACHE,
+)
+
+async def relay_fetch(url: str, profile: Optional[HeaderProfile]) -> Tuple[int, bytes, str]:
+    """
+    Запрос ретранслятора к источнику с заголовками канала. Тело читается
+    целиком, но не больше SEGMENT_MAX_CACHE_BYTES: непрерывный поток
+    (например, MPEG-TS без сегментов) ретранслировать нельзя.
+    """
+    user_agent = (profile and profile.user_agent) or upstream_user_agent(None)
+    handle = await open_upstream(url, user_agent, profile=profile)
+    try:
+        length = handle.content_length
+        if length is not None and length > SEGMENT_MAX_CACHE_BYTES:
+            raise RelayUnsupported("Ответ источника слишком большой для буфера")
+        body = bytearray()
+        async for chunk in handle.response.aiter_bytes(STREAM_CHUNK_SIZE):
+            body += chunk
+            if len(body) > SEGMENT_MAX_CACHE_BYTES:
+                raise RelayUnsupported("Источник отдает непрерывный поток")
+        return handle.status_code, bytes(body), handle.content_type
+    finally:
+        await handle.exit_stack.aclose()
+
+# Ретрансляция каналов: одна сессия к источнику на канал для всех зрителей
+RELAY = RelayHub(relay_fetch)
+
+# Зрители каналов, которые смотрят через /proxy. Канал передается в параметре ch
+# и, как профиль, переходит во все ссылки переписанного плейлиста
+PROXY_VIEWERS = ProxyViewers()
+CHANNEL_PARAM = "ch"
+
+def channel_proxy_url(channel_id: str, channel: Channel) -> str:
+    """Ссылка /proxy на поток канала с его профилем заголовков"""
+    return (f"/proxy?url={quote_plus(channel.url)}{profile_suffix(channel.profile)}"
+            f"&{CHANNEL_PARAM}={quote_plus(channel_id)}")
+
+async def probe_channel(url: str, profile: Optional[HeaderProfile]) -> int:
+    """
+    Проверка канала: ответ источника до первого фрагмента тела (для HLS -
+    начало плейлиста). Идет мимо fetch_content и кэша редиректов, чтобы обход
+    тысяч каналов не попадал в журнал и статистику запросов зрителей.
+    """
+    user_agent = (profile and profile.user_agent) or upstream_user_agent(None)
+    headers = upstream_headers(user_agent, stream=True, profile=profile)
+    async with UPSTREAM.host_slot(url):
+        response = await follow_redirects_manually(UPSTREAM.client, url, headers,
+                                                   timeout=UPSTREAM.timeout_for("manifest"), stream=True,
+                                                   remember=False)
+        try:
+            if response.status_code < 400:
+                async for _ in response.aiter_raw(STREAM_CHUNK_SIZE):
+                    break
+        finally:
+            await response.aclose()
+    return response.status_code
+
+def health_targets():
+    """Все адреса каталога для проверки, включая зеркала из других источников"""
+    catalog = PLAYLIST.catalog
+    if catalog is None:
+        return
+    for channel in catalog.channels:
+        yield channel.url, channel.profile
+        for mirror in channel.mirrors:
+            yield mirror.url, mirror.profile
+
+# Фоновая проверка доступности каналов
+HEALTH = HealthProber(probe_channel, health_targets)
+
+async def publish_catalog(catalog: Catalog):
+    """Ведущий воркер передает собранный каталог остальным"""
+    EPG.sources_changed()
+    if LOGO_PREWARM and WORKERS.is_leader:
+        # Логотипы нового плейлиста загружаются заранее, до первого показа списка
+        LOGOS.prewarm(channel.logo for channel in catalog.channels if channel.logo)
+    if WORKERS.enabled and WORKERS.is_leader:
+        await asyncio.to_thread(WORKERS.save_object, CATALOG, catalog)
+        await WORKERS.publish(CATALOG)
+
+async def adopt_catalog():
+    catalog = await asyncio.to_thread(WORKERS.load_object, CATALOG)
+    if catalog is not None and PLAYLIST.adopt(catalog):
+        logger.info("Каталог %s получен от ведущего воркера", catalog.version)
+
+async def publish_health():
+    if WORKERS.enabled and WORKERS.is_leader:
+        await asyncio.to_thread(WORKERS.save_object, HEALTH_EVENT, HEALTH.health)
+        await WORKERS.publish(HEALTH_EVENT)
+
+async def adopt_health():
+    health = await asyncio.to_thread(WORKERS.load_object, HEALTH_EVENT)
+    if health is not None:
+        HEALTH.adopt(health)
+
+async def publish_epg():
+    if WORKERS.enabled and WORKERS.is_leader:
+        await asyncio.to_thread(WORKERS.save_object, EPG_EVENT, EPG.index)
+        await WORKERS.publish(EPG_EVENT)
+
+async def adopt_epg():
+    index = await asyncio.to_thread(WORKERS.load_object, EPG_EVENT)
+    if index is not None:
+        EPG.adopt(index)
+
+async def clear_local_cache():
+    """Кэш очищен по запросу к другому воркеру"""
+    await URL_CACHE.clear(local_only=True)
+    REDIRECTS.clear()
+
+async def refresh_for_worker() -> Optional[str]:
+    """Обновление плейлиста, запрошенное у ведомого воркера"""
+    catalog = await PLAYLIST.refresh()
+    return PLAYLIST.last_error or (None if catalog is not None else "Каталог не получен")
+
+async def become_leader():
+    """Прежний ведущий завершился: этот воркер начинает обновлять плейлист и проверять каналы"""
+    await adopt_health()
+    await adopt_epg()
+    PLAYLIST.run_in_background()
+    HEALTH.start()
+    EPG.start()
+
+PLAYLIST.on_rebuild = publish_catalog
+HEALTH.on_update = publish_health
+EPG.on_update = publish_epg
+WORKERS.handlers.update({
+    CATALOG: adopt_catalog,
+    HEALTH_EVENT: adopt_health,
+    EPG_EVENT: adopt_epg,
+    CLEAR: clear_local_cache,
+    REFRESH: refresh_for_worker,
+})
+WORKERS.on_leader = become_leader
+if SHARED_CACHE is not None:
+    WORKERS.sweeper = SHARED_CACHE.sweep
+
+# Готовый ответ /api/channels с результатами проверок: (версия, варианты сжатия)
+CHANNELS_HEALTH_PAYLOAD: Dict[str, Any] = {"tag": None, "version": None, "variants": None, "updated_at": 0.0}
+# Пересборка ответа с проверками: одна на новую пачку, сколько бы запросов ни пришло
+CHANNELS_FLIGHTS = SingleFlight()
+
+async def build_channels_health_payload(catalog: Catalog, tag: str, updated_at: float):
+    body = await asyncio.to_thread(
+        catalog.build_channels_payload, lambda channel: HEALTH.to_dict(channel.url))
+    variants = await asyncio.to_thread(compress_variants, body)
+    CHANNELS_HEALTH_PAYLOAD.update(tag=tag, version=catalog.version, variants=variants, updated_at=updated_at)
+
+async def channels_payload(catalog: Catalog) -> Tuple[Dict[str, bytes], str, float]:
+    """
+    Полный список каналов. Пока проверок нет, это готовый ответ каталога;
+    с результатами проверок он пересобирается один раз на их новую пачку.
+    Пока идет пересборка, отдается прошлый ответ того же каталога
+    """
+    if not HEALTH.generation:
+        return catalog.channels_payload, catalog.version, catalog.updated_at
+    tag = f"{catalog.version}.h{HEALTH.generation}"
+    current = dict(CHANNELS_HEALTH_PAYLOAD)
+    if current["tag"] != tag:
+        def rebuild():
+            return CHANNELS_FLIGHTS.do(
+                tag, "channels",
+                lambda: build_channels_health_payload(catalog, tag, max(catalog.updated_at, HEALTH.updated_at)))
+        if current["version"] != catalog.version:
+            await rebuild()
+            current = dict(CHANNELS_HEALTH_PAYLOAD)
+        elif tag not in CHANNELS_FLIGHTS:
+            # Статусы проверок обновятся со следующим запросом
+            asyncio.ensure_future(rebuild()).add_done_callback(log_channels_rebuild)
+    return current["variants"], current["tag"], current["updated_at"]
+
+def log_channels_rebuild(task: asyncio.Future):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Не удалось пересобрать список каналов: %s", task.exception())
+
+def stream_response_headers(resp_headers: Dict[str, str], content_type: str) -> Dict[str, str]:
+    """Заголовки для передачи видео зрителю: браузер не должен кэшировать поток"""
+    headers = dict(resp_headers)
+    if content_type and ('video/' in content_type or '/ts' in content_type or '/mp4' in content_type):
+        for key in list(headers.keys()):
+            if key.lower() in ('cache-control', 'pragma', 'expires'):
+                del headers[key]
+        
+        headers.update({
+            'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+            'Pragma': 'no-cache',
+            'Expires': '0'
+        })
+    return headers
+
+# Получение актуального каталога каналов
+async def get_catalog() -> Catalog:
+    """Возвращает текущий каталог; обновляется он в фоне"""
+    try:
+        return await PLAYLIST.get_catalog()
+    except PlaylistError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 @app.get("/proxy")
 async def proxy_stream(url: str, request: Request):
@@ -227,156 +698,126 @@ async def proxy_stream(url: str, request: Request):
     # Очищаем URL от вложенных proxy вызовов
     clean_url = sanitize_url(url)
     if not clean_url:
-        logger.warning(f"Недопустимый URL: {url} от {client_ip}")
+        logger.warning("Недопустимый URL: %s от %s", url, client_ip)
         return Response(content=f"Недопустимый URL: {url}", status_code=400)
     
-    # Добавляем параметр для предотвращения кэширования CDN/edge серверами
-    # Если URL уже содержит параметры запроса
-    cache_buster = int(time.time())
-    if '?' in clean_url:
-        clean_url = f"{clean_url}&_nocache={cache_buster}"
-    else:
-        clean_url = f"{clean_url}?_nocache={cache_buster}"
+    # Профиль заголовков канала (User-Agent, Referer, Origin из плейлиста) передается
+    # в параметре p и переходит во все ссылки переписанного плейлиста
+    catalog = PLAYLIST.catalog
+    profile = catalog.profile(request.query_params.get(PROFILE_PARAM)) if catalog is not None else None
+    suffix = profile_suffix(profile)
+    
+    # Зритель канала учитывается в метрике iptv_channel_viewers
+    channel_id = request.query_params.get(CHANNEL_PARAM)
+    viewer = None
+    if channel_id and catalog is not None and catalog.get(channel_id) is not None:
+        suffix += f"&{CHANNEL_PARAM}={quote_plus(channel_id)}"
+        viewer = f"{client_ip}|{request.headers.get('user-agent', '')}"
+        PROXY_VIEWERS.touch(channel_id, viewer)
     
-    # Получаем user-agent от клиента, если доступен
-    user_agent = request.headers.get("user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+    # User-Agent для источника: из профиля канала, иначе общий для всех зрителей,
+    # если не включена передача UA зрителя
+    user_agent = (profile and profile.user_agent) or upstream_user_agent(request.headers.get("user-agent"))
+    
+    # Range-запросы (перемотка mp4) передаются источнику как есть
+    range_headers = {name.title(): request.headers[name]
+                     for name in ('range', 'if-range') if name in request.headers}
+    upstream_stack = None
+    
+    # Параметры LL-HLS (_HLS_msn, _HLS_part, _HLS_skip) плеер добавляет к адресу /proxy.
+    # Источнику они передаются, только если он объявил их поддержку
+    directives = {name: request.query_params[name] for name in DELIVERY_DIRECTIVES
+                  if name in request.query_params}
+    if directives:
+        directives = HLS_REWRITER.allowed_directives(clean_url, directives, suffix)
     
     try:
-        # Получаем содержимое с использованием кэша
-        response, resp_headers, status_code = await fetch_cached_content(clean_url, user_agent)
+        segment_key = cache_key_for(clean_url, user_agent, profile)
+        if guess_content_kind(clean_url) == "manifest" and not range_headers:
+            # Плейлисты небольшие: читаем целиком с использованием кэша
+            entry = await fetch_cached_content(with_delivery_directives(clean_url, directives), user_agent, profile)
+            response_body = entry.body
+            base_url = entry.url or clean_url
+            content_type = entry.content_type
+            resp_headers = dict(entry.headers)
+            status_code = entry.status_code
+        else:
+            # Сегмент уже в кэше - отдаем из памяти
+            if not range_headers:
+                PREFETCHER.record_request(segment_key)
+            cached = await URL_CACHE.get(segment_key) if not range_headers else None
+            if cached is not None:
+                PROXY_STATS["saved_upstream_fetches"] += 1
+                RELAYED_BYTES.labels("cache").inc(len(cached.body))
+                return Response(content=cached.body, status_code=cached.status_code, headers=cached.headers)
+            
+            # Сегменты открываем потоком, тело не буферизуется в памяти.
+            # Одновременные запросы одного сегмента читают общую загрузку
+            handle = None
+            if not range_headers:
+                if segment_key in SEGMENT_FLIGHTS:
+                    PROXY_STATS["saved_upstream_fetches"] += 1
+                handle = await SEGMENT_FLIGHTS.do(
+                    segment_key, urlparse(clean_url).netloc,
+                    lambda: open_shared_segment(clean_url, user_agent, segment_key, profile),
+                    on_orphan=UpstreamHandle.discard)
+                # Неразделяемый ответ уже забрал другой зритель - открываем свой
+                if handle.shared is None and not handle.claim():
+                    handle = None
+            if handle is None:
+                handle = await open_upstream(clean_url, user_agent, range_headers, profile)
+                handle.claim()
+            if handle.shared is None:
+                upstream_stack = handle.exit_stack
+            response = handle.response
+            base_url = str(response.request.url)
+            resp_headers = dict(handle.headers)
+            status_code = handle.status_code
+            content_type = handle.content_type
+            response_body = None
         
         # Для m3u8 плейлистов нужно обрабатывать URL к сегментам
-        content_type = response.headers.get('content-type', '').lower()
+        is_hls = 'application/vnd.apple.mpegurl' in content_type or clean_url.endswith('.m3u8')
+        is_dash = 'application/dash+xml' in content_type or clean_url.endswith('.mpd')
+        # Ошибку источника отдаем как есть: переписанный текст ошибки
+        # плеер принял бы за плейлист со ссылкой на сегмент
+        if status_code >= 400:
+            is_hls = is_dash = False
+        
+        # Плейлист без расширения в URL пришел потоком - дочитываем его целиком
+        if (is_hls or is_dash) and response_body is None:
+            if handle.shared is not None:
+                # Общая загрузка (расширение было только в параметрах адреса): тело
+                # читается из нее, источник закрывает ее собственная задача
+                response_body = b''.join([chunk async for chunk in handle.shared.iter_chunks()])
+            else:
+                response_body = await response.aread()
+            if upstream_stack is not None:
+                await upstream_stack.aclose()
+                upstream_stack = None
         
         # HLS (m3u8) плейлисты
-        if 'application/vnd.apple.mpegurl' in content_type or clean_url.endswith('.m3u8'):
-            logger.debug(f"Обрабатываем HLS плейлист: {clean_url}")
-            content = response.text
-            base_url = clean_url.rsplit('/', 1)[0] + '/'
-            
-            # Обработка ссылок внутри m3u8 файла
-            lines = content.splitlines()
-            processed_lines = []
+        if is_hls:
+            logger.debug("Обрабатываем HLS плейлист: %s", clean_url)
+            content = response_body.decode('utf-8', errors='replace')
             
-            # Проверяем, является ли это мастер-плейлистом или плейлистом фрагментов
-            is_master_playlist = any('#EXT-X-STREAM-INF' in line for line in lines)
-            
-            # Устанавливаем более длинный целевой период буферизации для плеера
-            if not is_master_playlist:
-                # Модифицируем плейлист с фрагментами для улучшения буферизации
-                has_target_duration = False
-                for line in lines:
-                    if line.startswith('#EXT-X-TARGETDURATION:'):
-                        # Извлекаем текущее значение и увеличиваем его для лучшей буферизации
-                        try:
-                            current_duration = int(line.split(':')[1].strip())
-                            # Увеличиваем целевую продолжительность для лучшей буферизации
-                            processed_lines.append(f'#EXT-X-TARGETDURATION:{current_duration * 2}')
-                            has_target_duration = True
-                            continue
-                        except (ValueError, IndexError):
-                            # Если не удалось преобразовать, оставляем как есть
-                            processed_lines.append(line)
-                            has_target_duration = True
-                            continue
-                    
-                    # Добавляем параметр для более длинного буфера, если его нет
-                    if line.startswith('#EXT-X-PLAYLIST-TYPE:'):
-                        processed_lines.append(line)
-                        continue
-                        
-                    # Если это строка с #EXTINF, прокси не требуется
-                    if line.startswith('#EXTINF:'):
-                        processed_lines.append(line)
-                        continue
-                        
-                    # Пропускаем комментарии и пустые строки при обработке ссылок
-                    if line.startswith('#') and 'URI=' not in line and 'http' not in line:
-                        processed_lines.append(line)
-                        continue
-                        
-                    # Обрабатываем URI в ключах
-                    if 'URI=' in line:
-                        line = re.sub(r'URI="([^"]+)"', 
-                                     lambda m: f'URI="/proxy?url={quote_plus(urljoin(base_url, m.group(1)))}"', 
-                                     line)
-                        processed_lines.append(line)
-                        continue
-                    
-                    # Обрабатываем HTTP URLs в комментариях
-                    if line.startswith('#') and ('http://' in line or 'https://' in line):
-                        line = re.sub(r'(https?://[^"\s,]+)', 
-                                     lambda m: f'/proxy?url={quote_plus(m.group(1))}', 
-                                     line)
-                        processed_lines.append(line)
-                        continue
-                    
-                    # Обрабатываем URL сегментов (ts или m3u8 файлы)
-                    if not line.startswith('#') and (line.strip().endswith('.ts') or 
-                                                   line.strip().endswith('.m3u8') or
-                                                   '.ts?' in line or
-                                                   '.m3u8?' in line):
-                        # Если это абсолютный URL
-                        if line.startswith('http'):
-                            processed_lines.append(f'/proxy?url={quote_plus(line)}')
-                        else:
-                            # Это относительный URL
-                            full_url = urljoin(base_url, line)
-                            processed_lines.append(f'/proxy?url={quote_plus(full_url)}')
-                        continue
-                    
-                    # Неизмененная строка
-                    processed_lines.append(line)
-                
-                # Добавляем тип плейлиста VOD, если его нет, для лучшей буферизации
-                if not any('#EXT-X-PLAYLIST-TYPE:VOD' in line for line in processed_lines) and not any('#EXT-X-ENDLIST' in line for line in processed_lines):
-                    # Вставляем после заголовка, но перед метаданными сегментов
-                    header_end_index = next((i for i, line in enumerate(processed_lines) 
-                                           if not line.startswith('#') or line.startswith('#EXTINF')), 0)
-                    processed_lines.insert(header_end_index, '#EXT-X-PLAYLIST-TYPE:VOD')
-            else:
-                # Обработка мастер-плейлиста проще, так как в нем только ссылки на другие плейлисты
-                for line in lines:
-                    # Пропускаем комментарии и пустые строки при обработке ссылок
-                    if line.startswith('#') and 'URI=' not in line and 'http' not in line:
-                        processed_lines.append(line)
-                        continue
-                        
-                    # Обрабатываем URI в ключах
-                    if 'URI=' in line:
-                        line = re.sub(r'URI="([^"]+)"', 
-                                     lambda m: f'URI="/proxy?url={quote_plus(urljoin(base_url, m.group(1)))}"', 
-                                     line)
-                        processed_lines.append(line)
-                        continue
-                    
-                    # Обрабатываем HTTP URLs в комментариях
-                    if line.startswith('#') and ('http://' in line or 'https://' in line):
-                        line = re.sub(r'(https?://[^"\s,]+)', 
-                                     lambda m: f'/proxy?url={quote_plus(m.group(1))}', 
-                                     line)
-                        processed_lines.append(line)
-                        continue
-                    
-                    # Обрабатываем URL фрагментов плейлистов
-                    if not line.startswith('#') and line.strip():
-                        # Если это абсолютный URL
-                        if line.startswith('http'):
-                            processed_lines.append(f'/proxy?url={quote_plus(line)}')
-                        else:
-                            # Это относительный URL
-                            full_url = urljoin(base_url, line)
-                            processed_lines.append(f'/proxy?url={quote_plus(full_url)}')
-                        continue
-                    
-                    # Неизмененная строка
-                    processed_lines.append(line)
+            # Все ссылки внутри m3u8 направляем через прокси; у живого плейлиста
+            # переписываются только новые сегменты, готовый ответ общий для всех зрителей
+            # Ссылки разрешаются от конечного адреса после редиректов, поэтому
+            # сегменты потом запрашиваются сразу у него, без цепочки переходов
+            result = HLS_REWRITER.rewrite(content, clean_url, suffix=suffix, base_url=base_url)
+            MANIFEST_REWRITE.labels("master" if result.is_master else "media").observe(result.elapsed)
+            RELAYED_BYTES.labels("manifest").inc(len(result.body))
             
-            content = '\n'.join(processed_lines)
+            # Пока зритель обновляет медиа-плейлист, следующие сегменты загружаются заранее
+            if not result.is_master and status_code == 200:
+                PREFETCHER.touch(clean_url, user_agent, profile)
             
-            # Замеряем время обработки и логируем
-            process_time = time.time() - start_time
-            logger.info(f"HLS прокси обработан за {process_time:.3f}с: {clean_url} -> {status_code}")
+            # Замеряем время обработки и логируем (выборочно, время есть в /metrics)
+            if sampled("proxy"):
+                logger.info("HLS прокси обработан за %.3fс (переписан за %.2fмс, новых сегментов %d): %s -> %s",
+                            time.time() - start_time, result.elapsed * 1000, result.rewritten,
+                            clean_url, status_code, extra={"route": "proxy"})
             
             # Устанавливаем правильные заголовки для кэширования в браузере
             custom_headers = {
@@ -386,28 +827,23 @@ async def proxy_stream(url: str, request: Request):
                 'Content-Type': 'application/vnd.apple.mpegurl'
             }
             
-            return Response(content=content, media_type="application/vnd.apple.mpegurl", headers=custom_headers)
+            return Response(content=result.body, media_type="application/vnd.apple.mpegurl", headers=custom_headers)
         
         # DASH (mpd) плейлисты
-        elif 'application/dash+xml' in content_type or clean_url.endswith('.mpd'):
-            logger.debug(f"Обрабатываем DASH плейлист: {clean_url}")
-            content = response.text
-            base_url = clean_url.rsplit('/', 1)[0] + '/'
-            
-            # Заменяем URLs в MPD файле на проксированные версии
-            # Заменяем адреса в SegmentTemplate
-            content = re.sub(r'(initialization|media)="([^"]+)"', 
-                            lambda m: f'{m.group(1)}="/proxy?url={quote_plus(urljoin(base_url, m.group(2)))}"',
-                            content)
+        elif is_dash:
+            logger.debug("Обрабатываем DASH плейлист: %s", clean_url)
+            content = response_body.decode('utf-8', errors='replace')
             
-            # Заменяем абсолютные URLs
-            content = re.sub(r'(https?://[^"\s]+\.m4s|https?://[^"\s]+\.mp4)', 
-                            lambda m: f'/proxy?url={quote_plus(m.group(1))}',
-                            content)
+            # Все ссылки MPD (с учетом иерархии BaseURL) направляем через прокси;
+            # динамический манифест переписывается заново только при смене publishTime
+            result = DASH_REWRITER.rewrite(content, clean_url, suffix=suffix, base_url=base_url)
+            MANIFEST_REWRITE.labels("dash").observe(result.elapsed)
+            RELAYED_BYTES.labels("manifest").inc(len(result.body))
             
             # Замеряем время обработки и логируем
-            process_time = time.time() - start_time
-            logger.info(f"DASH прокси обработан за {process_time:.3f}с: {clean_url} -> {status_code}")
+            if sampled("proxy"):
+                logger.info("DASH прокси обработан за %.3fс: %s -> %s",
+                            time.time() - start_time, clean_url, status_code, extra={"route": "proxy"})
             
             # Добавляем заголовки для предотвращения кэширования
             custom_headers = {
@@ -417,147 +853,267 @@ async def proxy_stream(url: str, request: Request):
                 'Content-Type': 'application/dash+xml'
             }
             
-            return Response(content=content, media_type="application/dash+xml", headers=custom_headers)
+            return Response(content=result.body, media_type="application/dash+xml", headers=custom_headers)
             
         else:
             # Для остальных типов контента просто проксируем как есть
-            process_time = time.time() - start_time
-            logger.info(f"Прокси поток обработан за {process_time:.3f}с: {clean_url} -> {status_code}")
+            if sampled("proxy"):
+                logger.info("Прокси поток обработан за %.3fс: %s -> %s",
+                            time.time() - start_time, clean_url, status_code, extra={"route": "proxy"})
             
             # Добавляем заголовки для стриминг-контента
-            if content_type and ('video/' in content_type or '/ts' in content_type or '/mp4' in content_type):
-                # Добавляем заголовки для стриминг-контента
-                for key in list(resp_headers.keys()):
-                    if key.lower() in ('cache-control', 'pragma', 'expires'):
-                        del resp_headers[key]
-                        
-                resp_headers.update({
-                    'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
-                    'Pragma': 'no-cache',
-                    'Expires': '0'
-                })
+            resp_headers = stream_response_headers(resp_headers, content_type)
+            
+            # Ответ, прочитанный целиком, отдаем сразу
+            if response_body is not None:
+                RELAYED_BYTES.labels("manifest").inc(len(response_body))
+                return Response(content=response_body, status_code=status_code, headers=resp_headers)
+            
+            # Общая загрузка: зритель читает ее с начала, источник не закрывается при его уходе
+            if handle.shared is not None:
+                content = counted_chunks(handle.shared.iter_chunks(), RELAYED_BYTES.labels("shared"))
+                return StreamingResponse(
+                    content=PROXY_VIEWERS.watching(channel_id, viewer, content) if viewer else content,
+                    status_code=status_code,
+                    headers=resp_headers
+                )
+            
+            # Полный ответ без Range сохраняем в кэш после передачи зрителю
+            on_complete = None
+            if status_code == 200 and not range_headers:
+                async def on_complete(body: bytes):
+                    await URL_CACHE.put(segment_key, body, resp_headers, status_code, content_type, "segment")
             
+            # Дальше за закрытие соединения с источником отвечает поток
+            relay_stack, upstream_stack = upstream_stack, None
+            content = relay_upstream(response, relay_stack, on_complete)
             return StreamingResponse(
-                content=response.iter_bytes(),
+                content=PROXY_VIEWERS.watching(channel_id, viewer, content) if viewer else content,
                 status_code=status_code,
-                headers=resp_headers
+                headers=resp_headers,
+                background=BackgroundTask(relay_stack.aclose) if relay_stack else None
             )
     
     except HTTPException as e:
         # Перехватываем и логируем HTTP ошибки
-        logger.error(f"Ошибка прокси для {clean_url}: {e.detail}")
+        logger.error("Ошибка прокси для %s: %s", clean_url, e.detail, extra={"host": urlparse(clean_url).netloc})
         return Response(
             content=f"Ошибка при обработке запроса: {e.detail}",
             status_code=e.status_code
         )
     except Exception as e:
         # Перехватываем все другие ошибки
-        logger.error(f"Неизвестная ошибка при прокси {clean_url}: {str(e)}", exc_info=True)
+        logger.error("Неизвестная ошибка при прокси %s: %s", clean_url, e, exc_info=True,
+                     extra={"host": urlparse(clean_url).netloc})
         return Response(
             content=f"Внутренняя ошибка сервера: {str(e)}",
             status_code=500
         )
+    finally:
+        if upstream_stack is not None:
+            await upstream_stack.aclose()
+
+# Ответ из заранее сжатых вариантов с поддержкой условных запросов
+def precompressed_response(request: Request, variants: Dict[str, bytes], tag: str, updated_at: float) -> Response:
+    # У каждой кодировки свой ETag: и 200, и 304 несут ETag выбранного представления
+    encoding = choose_encoding(request.headers.get("accept-encoding"), variants)
+    headers = {
+        "ETag": make_etag(tag, encoding),
+        "Last-Modified": http_date(updated_at),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    
+    # Условный запрос: браузер уже получил эту версию плейлиста
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, headers["ETag"]) or (
+            if_none_match is None
+            and not_modified_since(request.headers.get("if-modified-since"), updated_at)):
+        return Response(status_code=304, headers=headers)
+    
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=variants[encoding], media_type="application/json", headers=headers)
+
+# Размер страницы списка каналов
+CHANNELS_PAGE_DEFAULT = 100
+CHANNELS_PAGE_MAX = 1000
 
 @app.get("/api/channels")
-async def get_channels():
+async def get_channels(request: Request, group: Optional[str] = None, q: Optional[str] = None,
+                       limit: Optional[int] = None, cursor: Optional[str] = None):
     try:
-        logger.info(f"Загрузка списка каналов из удаленного плейлиста")
-        
-        # Получаем содержимое плейлиста из кэша или загружаем с URL
-        playlist_content = await fetch_remote_playlist()
+        catalog = await get_catalog()
         
-        # Разбираем плейлист
-        channels = []
-        categories = {}
-        channel_id = 0
+        # Без параметров - полный список, собранный и сжатый заранее
+        if group is None and q is None and limit is None and cursor is None:
+            variants, tag, updated_at = await channels_payload(catalog)
+            return precompressed_response(request, variants, tag, updated_at)
         
-        lines = playlist_content.splitlines()
+        # Курсор - позиция в результате для конкретной версии плейлиста
+        offset = 0
+        if cursor:
+            version, _, position = cursor.partition(".")
+            if version != catalog.version[:12] or not position.isdigit():
+                return JSONResponse(
+                    content={"error": "Курсор устарел: плейлист обновился, начните с первой страницы"},
+                    status_code=409
+                )
+            offset = int(position)
+        limit = max(1, min(limit or CHANNELS_PAGE_DEFAULT, CHANNELS_PAGE_MAX))
         
-        channel = None
-        for line in lines:
-            line = line.strip()
-            if line.startswith('#EXTINF:'):
-                group = "Без категории"
-                match = re.search(r'group-title="([^"]+)"', line)
-                if match:
-                    group = match.group(1)
-                
-                logo = None
-                logo_match = re.search(r'tvg-logo="([^"]+)"', line)
-                if logo_match:
-                    logo = logo_match.group(1)
-                
-                parts = line.split(',', 1)
-                if len(parts) > 1:
-                    channel_id += 1
-                    channel = {
-                        "id": str(channel_id),
-                        "name": parts[1].strip(),
-                        "group": group,
-                        "logo": logo
-                    }
-            elif channel and not line.startswith('#'):
-                channel["url"] = line
-                channels.append(channel)
-                if group not in categories:
-                    categories[group] = []
-                categories[group].append(channel)
-                channel = None
-
-        logger.info(f"Загружено {len(channels)} каналов в {len(categories)} категориях")
+        found = catalog.query(group=group, q=q)
+        page = found[offset:offset + limit]
+        next_offset = offset + len(page)
         return JSONResponse(content={
-            "channels": channels, 
-            "categories": categories,
-            "last_update": LAST_PLAYLIST_UPDATE  # Добавляем время последнего обновления
+            "version": catalog.version,
+            "channels": [channel.to_dict(HEALTH.to_dict(channel.url)) for channel in page],
+            "total": len(found),
+            "next_cursor": f"{catalog.version[:12]}.{next_offset}" if next_offset < len(found) else None,
+            "last_update": catalog.updated_at,
         })
     
     except Exception as e:
-        logger.error(f"Ошибка при загрузке плейлиста: {str(e)}", exc_info=True)
+        logger.error("Ошибка при загрузке плейлиста: %s", e, exc_info=True)
         return JSONResponse(
             content={"error": f"Ошибка при загрузке плейлиста: {str(e)}"}, 
             status_code=500
         )
 
+@app.get("/api/groups")
+async def get_groups(request: Request):
+    try:
+        catalog = await get_catalog()
+        return precompressed_response(request, catalog.groups_payload, f"g{catalog.version}", catalog.updated_at)
+    
+    except Exception as e:
+        logger.error("Ошибка при загрузке категорий: %s", e, exc_info=True)
+        return JSONResponse(
+            content={"error": f"Ошибка при загрузке категорий: {str(e)}"}, 
+            status_code=500
+        )
+
 @app.get("/api/stream/{channel_id}")
-async def stream_channel(channel_id: str, request: Request):
+async def stream_channel(channel_id: str, request: Request, mode: Optional[str] = None):
     try:
-        # Получаем плейлист
-        playlist_content = await fetch_remote_playlist()
+        catalog = await get_catalog()
+        channel = catalog.get(channel_id)
         
-        # Разбираем плейлист для поиска канала по ID
-        channels = []
-        current_id = 0
+        # Если канал не найден
+        if channel is None:
+            raise HTTPException(status_code=404, detail="Канал не найден")
         
-        lines = playlist_content.splitlines()
+        # Из зеркал канала выбираем самое быстрое из работающих
+        source = HEALTH.best(catalog.alternatives(channel))
         
-        channel = None
-        for line in lines:
-            line = line.strip()
-            if line.startswith('#EXTINF:'):
-                group = "Без категории"
-                match = re.search(r'group-title="([^"]+)"', line)
-                if match:
-                    group = match.group(1)
-                
-                parts = line.split(',', 1)
-                if len(parts) > 1:
-                    current_id += 1
-                    if str(current_id) == channel_id:
-                        channel = {"id": str(current_id), "name": parts[1].strip()}
-            elif channel and not line.startswith('#'):
-                channel["url"] = line
-                # Проксируем поток через наш прокси
-                return RedirectResponse(url=f"/proxy?url={quote_plus(channel['url'])}")
+        # Ретрансляция: все зрители канала читают одну сессию к источнику.
+        # Источник, который недавно не удалось ретранслировать, сразу смотрится через прокси
+        if mode == "relay" or (mode is None and RELAY_ENABLED):
+            if RELAY.get(channel_id) is not None or RELAY.unsupported(source.url) is None:
+                return RedirectResponse(url=f"/relay/{quote_plus(channel_id)}/index.m3u8")
+        if source is not channel:
+            logger.info("Канал %s: вместо %s используется зеркало %s", channel_id, channel.url, source.url)
         
-        # Если канал не найден
-        raise HTTPException(status_code=404, detail="Канал не найден")
+        # Проксируем поток через наш прокси вместе с профилем заголовков канала
+        return RedirectResponse(url=channel_proxy_url(channel_id, source))
     
     except HTTPException as e:
         raise e
     except Exception as e:
-        logger.error(f"Ошибка при стриминге канала: {str(e)}", exc_info=True)
+        logger.error("Ошибка при стриминге канала: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
+# Плейлист ретранслятора канала
+@app.get("/relay/{channel_id}/index.m3u8")
+async def relay_playlist(channel_id: str, request: Request):
+    catalog = await get_catalog()
+    channel = catalog.get(channel_id)
+    if channel is None:
+        raise HTTPException(status_code=404, detail="Канал не найден")
+    
+    try:
+        relay = RELAY.get(channel_id)
+        if relay is None:
+            # Сессия ретранслятора открывается к самому быстрому из работающих зеркал;
+            # идущая сессия не переключается, даже если быстрее стало другое
+            channel = HEALTH.best(catalog.alternatives(channel))
+            if RELAY.unsupported(channel.url) is not None:
+                return RedirectResponse(url=channel_proxy_url(channel_id, channel))
+            relay = RELAY.session(channel_id, channel.url, channel.profile)
+        else:
+            channel = next((c for c in catalog.alternatives(channel) if c.url == relay.url), channel)
+        relay.touch(f"{request.client.host}|{request.headers.get('user-agent', '')}")
+        if not relay.ready.is_set():
+            await asyncio.wait_for(relay.ready.wait(), RELAY_START_TIMEOUT)
+        if relay.error is not None or not relay.ring:
+            raise RelayUnsupported(relay.error or "Нет сегментов")
+    except (RelayUnsupported, asyncio.TimeoutError) as e:
+        # Канал, который нельзя ретранслировать, смотрится через обычный прокси
+        reason = str(e) or "таймаут"
+        RELAY.mark_unsupported(channel.url, reason)
+        logger.warning("Ретрансляция канала %s недоступна: %s", channel_id, reason,
+                       extra={"host": urlparse(channel.url).netloc})
+        return RedirectResponse(url=channel_proxy_url(channel_id, channel))
+    
+    body = relay.playlist(lambda seq: f"/relay/{quote_plus(channel_id)}/segment/{seq}")
+    return Response(content=body, media_type="application/vnd.apple.mpegurl", headers={
+        'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+        'Pragma': 'no-cache',
+        'Expires': '0',
+    })
+
+# Сегмент из кольцевого буфера ретранслятора
+@app.get("/relay/{channel_id}/segment/{seq}")
+async def relay_segment(channel_id: str, seq: int):
+    relay = RELAY.get(channel_id)
+    segment = relay.segment(seq) if relay is not None else None
+    if segment is None:
+        raise HTTPException(status_code=404, detail="Сегмент вне окна ретрансляции")
+    headers = stream_response_headers({}, segment.content_type)
+    RELAYED_BYTES.labels("relay").inc(len(segment.body))
+    return Response(content=segment.body, media_type=segment.content_type or "video/mp2t", headers=headers)
+
+# Логотип канала: /logo/{id}?v=... из logo_thumb в /api/channels.
+# Версия v меняется вместе с адресом логотипа, поэтому ответ можно кэшировать навсегда
+@app.get("/logo/{channel_id}")
+async def channel_logo(channel_id: str, request: Request, v: Optional[str] = None):
+    catalog = await get_catalog()
+    channel = catalog.get(channel_id)
+    if channel is None or not channel.logo:
+        raise HTTPException(status_code=404, detail="Логотип не найден")
+    logo = await LOGOS.get(channel.logo)
+    if logo is None:
+        raise HTTPException(status_code=404, detail="Логотип недоступен")
+    headers = {
+        "ETag": make_etag(logo.digest[:32]),
+        "Cache-Control": "public, max-age=31536000, immutable" if v == logo_version(channel.logo)
+        else "public, max-age=3600",
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(logo.path, media_type=logo.media_type, headers=headers)
+
+EPG_BATCH_MAX = 500
+
+# Передачи в эфире и следующие для набора каналов: /api/epg/now?ids=1,2,3
+@app.get("/api/epg/now")
+async def epg_now(ids: str, at: Optional[float] = None):
+    catalog = await get_catalog()
+    channel_ids = [channel_id for channel_id in ids.split(",") if channel_id][:EPG_BATCH_MAX]
+    tvg_ids = {}
+    for channel_id in channel_ids:
+        channel = catalog.get(channel_id)
+        tvg_ids[channel_id] = channel.tvg_id if channel is not None else None
+    found = EPG.now_next({tvg_id for tvg_id in tvg_ids.values() if tvg_id}, at)
+    return JSONResponse(
+        content={
+            "at": at or time.time(),
+            "channels": {channel_id: found.get(tvg_id) if tvg_id else None
+                         for channel_id, tvg_id in tvg_ids.items()},
+        },
+        headers={"Cache-Control": "max-age=30"},
+    )
+
 # Принудительное обновление плейлиста
 @app.get("/refresh-playlist")
 async def refresh_playlist(request: Request):
@@ -565,22 +1121,35 @@ async def refresh_playlist(request: Request):
         client_ip = request.client.host
         # Проверяем локальный запрос или с той же сети
         if client_ip.startswith("127.0.0.1") or client_ip.startswith("192.168.") or client_ip == "::1":
-            global LAST_PLAYLIST_UPDATE
-            LAST_PLAYLIST_UPDATE = 0  # Сбрасываем время обновления, чтобы принудительно обновить
-            
-            # Загружаем новый плейлист
-            playlist_content = await fetch_remote_playlist()
+            if not WORKERS.is_leader:
+                # Источники опрашивает только ведущий воркер; новый каталог придет от него
+                try:
+                    error = await WORKERS.request_refresh(PLAYLIST.timeout + 2 * WORKERS.sync_interval)
+                except asyncio.TimeoutError:
+                    return JSONResponse({"status": "error", "message": "Ведущий воркер не ответил"},
+                                        status_code=504)
+                if error:
+                    return JSONResponse({"status": "error", "message": error}, status_code=502)
+                await adopt_catalog()
+                catalog = PLAYLIST.catalog
+                return JSONResponse({"status": "success",
+                                     "message": f"Плейлист обновлен, {len(catalog) if catalog else 0} каналов"})
+
+            # Загружаем все источники сейчас, не дожидаясь планового обновления
+            catalog = await PLAYLIST.refresh()
+            if PLAYLIST.last_error or catalog is None:
+                return JSONResponse({"status": "error", "message": PLAYLIST.last_error}, status_code=502)
             
-            logger.info(f"Плейлист принудительно обновлен, размер: {len(playlist_content)} байт")
-            return JSONResponse({"status": "success", "message": f"Плейлист обновлен, получено {len(playlist_content)} байт"})
+            logger.info("Плейлист принудительно обновлен, %s каналов", len(catalog))
+            return JSONResponse({"status": "success", "message": f"Плейлист обновлен, {len(catalog)} каналов"})
         else:
-            logger.warning(f"Попытка обновить плейлист с неавторизованного IP: {client_ip}")
+            logger.warning("Попытка обновить плейлист с неавторизованного IP: %s", client_ip)
             return JSONResponse(
                 {"status": "error", "message": "Доступ запрещен"}, 
                 status_code=403
             )
     except Exception as e:
-        logger.error(f"Ошибка при обновлении плейлиста: {str(e)}")
+        logger.error("Ошибка при обновлении плейлиста: %s", e)
         return JSONResponse(
             {"status": "error", "message": str(e)},
             status_code=500
@@ -593,18 +1162,19 @@ async def clear_cache(request: Request):
         client_ip = request.client.host
         # Проверяем локальный запрос или с той же сети
         if client_ip.startswith("127.0.0.1") or client_ip.startswith("192.168.") or client_ip == "::1":
-            cache_size = len(URL_CACHE)
-            URL_CACHE.clear()
-            logger.info(f"Кэш очищен ({cache_size} элементов)")
+            cache_size = await URL_CACHE.clear()
+            redirects = REDIRECTS.clear()
+            await WORKERS.publish(CLEAR)
+            logger.info("Кэш очищен (%s элементов, %s адресов редиректов)", cache_size, redirects)
             return JSONResponse({"status": "success", "message": f"Кэш очищен ({cache_size} элементов)"})
         else:
-            logger.warning(f"Попытка очистить кэш с неавторизованного IP: {client_ip}")
+            logger.warning("Попытка очистить кэш с неавторизованного IP: %s", client_ip)
             return JSONResponse(
                 {"status": "error", "message": "Доступ запрещен"}, 
                 status_code=403
             )
     except Exception as e:
-        logger.error(f"Ошибка при очистке кэша: {str(e)}")
+        logger.error("Ошибка при очистке кэша: %s", e)
         return JSONResponse(
             {"status": "error", "message": str(e)},
             status_code=500
@@ -614,3 +1184,79 @@ async def clear_cache(request: Request):
 @app.get("/health")
 async def health_check():
     return {"status": "ok", "timestamp": time.time()}
+
+# Значения, которые уже считают кэш, пул и ретранслятор, читаются при опросе /metrics
+REGISTRY.register(CallbackMetric(
+    "iptv_cache_events", "Обращения к кэшу и вытеснения", "counter",
+    lambda: [((event,), getattr(URL_CACHE, attr)) for event, attr in (
+        ("hit", "hits"), ("disk_hit", "disk_hits"), ("miss", "misses"),
+        ("eviction", "evictions"), ("expiration", "expirations"))],
+    ("event",)))
+REGISTRY.register(CallbackMetric(
+    "iptv_cache_bytes", "Объем кэша в памяти", "gauge", lambda: [((), URL_CACHE.bytes)]))
+REGISTRY.register(CallbackMetric(
+    "iptv_upstream_in_flight", "Открытые запросы к источникам", "gauge", lambda: [((), UPSTREAM.in_flight)]))
+REGISTRY.register(CallbackMetric(
+    "iptv_upstream_requests", "Запросы к источникам и сэкономленные благодаря кэшу", "counter",
+    lambda: [(("fetched",), PROXY_STATS["upstream_fetches"]), (("saved",), PROXY_STATS["saved_upstream_fetches"])],
+    ("result",)))
+REGISTRY.register(CallbackMetric(
+    "iptv_channel_viewers", "Активные зрители каналов: через ретранслятор и через /proxy", "gauge",
+    lambda: [((channel_id, mode), viewers)
+             for mode, counts in (("relay", RELAY.viewers()), ("proxy", PROXY_VIEWERS.viewers()))
+             for channel_id, viewers in counts.items()],
+    ("channel", "mode")))
+REGISTRY.register(CallbackMetric(
+    "iptv_redirect_cache_events", "Обращения к кэшу редиректов", "counter",
+    lambda: [(("hit",), REDIRECTS.hits), (("miss",), REDIRECTS.misses),
+             (("invalidation",), REDIRECTS.invalidations)],
+    ("event",)))
+REGISTRY.register(CallbackMetric(
+    "iptv_redirect_hops", "Переходы по редиректам: пройденные и сэкономленные кэшем", "counter",
+    lambda: [(("walked",), REDIRECTS.hops_walked), (("saved",), REDIRECTS.hops_saved)],
+    ("result",)))
+REGISTRY.register(CallbackMetric(
+    "iptv_redirect_chains", "Запросы к источникам по длине цепочки редиректов", "counter",
+    lambda: [((str(hops),), count) for hops, count in sorted(REDIRECTS.hop_counts.items())],
+    ("hops",)))
+REGISTRY.register(CallbackMetric(
+    "iptv_prefetch_playlists", "Плейлисты, для которых идет упреждающая загрузка", "gauge",
+    lambda: [((), PREFETCHER.stats()["active_playlists"])]))
+
+# Метрики в формате Prometheus
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Статистика кэша и пула соединений
+@app.get("/stats")
+async def get_stats():
+    return {
+        "cache": URL_CACHE.stats(),
+        "proxy": PROXY_STATS,
+        "hls_rewrite": HLS_REWRITER.stats(),
+        "dash_rewrite": DASH_REWRITER.stats(),
+        "prefetch": PREFETCHER.stats(),
+        "relay": RELAY.stats(),
+        "profiles": PROFILE_STATS.stats(),
+        "redirects": REDIRECTS.stats(),
+        "health": HEALTH.stats(),
+        "epg": EPG.stats(),
+        "logos": LOGOS.stats(),
+        "logging": {
+            "dropped": log_records_dropped(),
+            "loop_lag_max": round(LOOP_LAG.max_lag, 4) if LOOP_LAG.enabled else None,
+        },
+        "coalescing": {
+            "manifests": MANIFEST_FLIGHTS.stats(),
+            "segments": SEGMENT_FLIGHTS.stats(),
+        },
+        "catalog": {
+            "version": PLAYLIST.catalog.version if PLAYLIST.catalog else None,
+            "channels": len(PLAYLIST.catalog) if PLAYLIST.catalog else 0,
+            "groups": len(PLAYLIST.catalog.groups) if PLAYLIST.catalog else 0,
+            **PLAYLIST.stats(),
+        },
+        "upstream": UPSTREAM.stats(),
+        "workers": WORKERS.stats(),
+    }
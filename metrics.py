@@ -0,0 +1,375 @@
+"""
+Метрики в текстовом формате Prometheus для /metrics.
+
+Счетчики и гистограммы с метками создаются заранее (labels() возвращает
+готовый дочерний объект), поэтому учет на горячем пути - это сложение
+и bisect без форматирования строк. Текст собирается только при опросе.
+Значения, которые уже считают кэш, пул и ретранслятор, читаются
+в момент опроса через callback-метрики.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from config import env_bool, env_float
+
+logger = logging.getLogger("iptv.metrics")
+
+# Замер задержки цикла событий (профилирование): как часто и с какой задержки предупреждать
+LOOP_LAG_MONITOR = env_bool("LOOP_LAG_MONITOR", False)
+LOOP_LAG_INTERVAL = env_float("LOOP_LAG_INTERVAL", 0.5)
+LOOP_LAG_WARN = env_float("LOOP_LAG_WARN", 0.1)
+# Зритель канала через /proxy считается ушедшим через столько секунд без запросов
+PROXY_VIEWER_TIMEOUT = env_float("PROXY_VIEWER_TIMEOUT", 30.0)
+
+# Границы гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Переписывание плейлистов и разбор каталога идут на порядки быстрее сети
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Типы ресурсов в метках kind
+KINDS = ("master", "media", "segment", "dash")
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Labels, object] = {}
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    @property
+    def sample_name(self) -> str:
+        """Имя рядов: у счетчиков с суффиксом _total, с ним же и HELP/TYPE"""
+        return f"{self.name}_total" if self.type_name == "counter" else self.name
+
+    def header(self) -> List[str]:
+        name = self.sample_name
+        return [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.type_name}"]
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, child in self._children.items():
+            lines.append(f"{self.sample_name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+        return lines
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """Значения, которые уже считает другой компонент: собираются при опросе"""
+
+    def __init__(self, name: str, documentation: str, type_name: str,
+                 collect: Callable[[], Iterable[Tuple[Labels, float]]], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.type_name = type_name
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, value in self.collect():
+            lines.append(f"{self.sample_name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+UPSTREAM_CONNECT = REGISTRY.register(Histogram(
+    "iptv_upstream_connect_seconds", "Установка нового соединения с источником (TCP и TLS)", ("kind",)))
+UPSTREAM_TTFB = REGISTRY.register(Histogram(
+    "iptv_upstream_ttfb_seconds", "От отправки запроса до заголовков ответа источника", ("kind",)))
+UPSTREAM_FETCH = REGISTRY.register(Histogram(
+    "iptv_upstream_fetch_seconds", "Запрос к источнику целиком, до закрытия ответа", ("kind",)))
+MANIFEST_REWRITE = REGISTRY.register(Histogram(
+    "iptv_manifest_rewrite_seconds", "Переписывание ссылок в плейлисте", ("kind",), FAST_BUCKETS))
+RELAYED_BYTES = REGISTRY.register(Counter(
+    "iptv_relayed_bytes", "Байты, отданные зрителям", ("source",)))
+PLAYLIST_PARSE = REGISTRY.register(Histogram(
+    "iptv_playlist_parse_seconds", "Разбор плейлиста каналов и сборка каталога", ("stage",), FAST_BUCKETS))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "iptv_event_loop_lag_seconds", "Опоздание цикла событий относительно запланированного пробуждения",
+    buckets=FAST_BUCKETS))
+ACTIVE_STREAMS = REGISTRY.register(Gauge(
+    "iptv_active_streams", "Потоки, которые сейчас передаются зрителям через /proxy"))
+
+# Пустые ряды для всех типов ресурсов, чтобы они были видны до первого запроса
+for _histogram in (UPSTREAM_CONNECT, UPSTREAM_TTFB, UPSTREAM_FETCH, MANIFEST_REWRITE):
+    for _kind in KINDS:
+        if _histogram is not MANIFEST_REWRITE or _kind != "segment":
+            _histogram.labels(_kind)
+
+
+def upstream_kind(kind: str, text: str = "") -> str:
+    """Тип ресурса для меток: master/media по содержимому плейлиста, dash для MPD"""
+    if '<MPD' in text:
+        return "dash"
+    return "master" if kind == "master" else "media" if kind in ("media", "vod") else "segment"
+
+
+class UpstreamTrace:
+    """
+    Обработчик trace-событий httpx для одного запроса к источнику.
+    Если тип ресурса известен заранее (сегмент), время записывается сразу;
+    для плейлистов - после разбора ответа, в finish().
+    """
+    __slots__ = ('kind', 'started', 'connect_started', 'connected', 'pending')
+
+    HEADERS_EVENTS = frozenset(("http11.receive_response_headers.complete",
+                                "http2.receive_response_headers.complete"))
+    CLOSED_EVENTS = frozenset(("http11.response_closed.complete", "http2.response_closed.complete"))
+    CONNECTED_EVENTS = frozenset(("connection.connect_tcp.complete", "connection.start_tls.complete"))
+    SEND_EVENTS = frozenset(("http11.send_request_headers.started", "http2.send_request_headers.started"))
+
+    def __init__(self, kind: Optional[str] = None):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.connect_started = 0.0
+        self.connected = 0.0
+        self.pending: Optional[List[Tuple[Histogram, float]]] = None if kind else []
+
+    async def __call__(self, event_name: str, info):
+        if event_name == "connection.connect_tcp.started":
+            self.connect_started = time.perf_counter()
+        elif event_name in self.CONNECTED_EVENTS:
+            # Для HTTPS соединение готово после TLS
+            self.connected = time.perf_counter()
+        elif event_name in self.SEND_EVENTS:
+            if self.connected:
+                self._observe(UPSTREAM_CONNECT, self.connected - self.connect_started)
+                self.connected = 0.0
+            # Каждый переход по редиректу - отдельный запрос к источнику
+            self.started = time.perf_counter()
+        elif event_name in self.HEADERS_EVENTS:
+            self._observe(UPSTREAM_TTFB, time.perf_counter() - self.started)
+        elif event_name in self.CLOSED_EVENTS:
+            self._observe(UPSTREAM_FETCH, time.perf_counter() - self.started)
+
+    def _observe(self, histogram: Histogram, value: float):
+        if self.pending is None:
+            histogram.labels(self.kind).observe(value)
+        else:
+            self.pending.append((histogram, value))
+
+    def finish(self, kind: str):
+        """Тип ресурса стал известен: записываем накопленные значения"""
+        self.kind = kind
+        pending, self.pending = self.pending, None
+        for histogram, value in pending or ():
+            histogram.labels(kind).observe(value)
+
+
+def finish_trace(response, kind: str):
+    trace = response.request.extensions.get("trace")
+    if isinstance(trace, UpstreamTrace):
+        trace.finish(kind)
+
+
+class LoopLagMonitor:
+    """
+    Профилирование цикла событий: задача засыпает на interval и замеряет,
+    насколько позже проснулась. Большое опоздание значит, что какой-то
+    обработчик надолго занял цикл синхронной работой.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, warn: float = LOOP_LAG_WARN,
+                 enabled: bool = LOOP_LAG_MONITOR):
+        self.interval = interval
+        self.warn = warn
+        self.enabled = enabled
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        histogram = LOOP_LAG.labels()
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            histogram.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag > self.warn:
+                logger.warning("Цикл событий опоздал на %.3fс", lag)
+
+
+class ProxyViewers:
+    """
+    Зрители каналов, которые смотрят через /proxy, а не через ретранслятор.
+    Зритель (адрес и User-Agent) активен, пока запрашивает плейлисты
+    и сегменты канала или читает его поток.
+    """
+
+    def __init__(self, timeout: float = PROXY_VIEWER_TIMEOUT):
+        self.timeout = timeout
+        # канал -> зритель -> время последнего запроса
+        self._seen: Dict[str, Dict[str, float]] = {}
+        # (канал, зритель) -> открытые потоки
+        self._streaming: Dict[Tuple[str, str], int] = {}
+
+    def touch(self, channel_id: str, viewer: str):
+        self._seen.setdefault(channel_id, {})[viewer] = time.monotonic()
+
+    async def watching(self, channel_id: str, viewer: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Передает поток канала; зритель активен, пока поток читается"""
+        key = (channel_id, viewer)
+        self._streaming[key] = self._streaming.get(key, 0) + 1
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            left = self._streaming.pop(key) - 1
+            if left:
+                self._streaming[key] = left
+            self.touch(channel_id, viewer)
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def viewers(self) -> Dict[str, int]:
+        """Активные зрители по каналам"""
+        horizon = time.monotonic() - self.timeout
+        active: Dict[str, Set[str]] = {}
+        for channel_id, seen in list(self._seen.items()):
+            for viewer in [v for v, at in seen.items() if at < horizon]:
+                del seen[viewer]
+            if seen:
+                active[channel_id] = set(seen)
+            else:
+                del self._seen[channel_id]
+        for channel_id, viewer in self._streaming:
+            active.setdefault(channel_id, set()).add(viewer)
+        return {channel_id: len(viewers) for channel_id, viewers in active.items()}
@@ -0,0 +1,421 @@
+"""Фоновое обновление плейлистов каналов, их объединение и снимки на диске"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from catalog import Catalog, Channel, merge_playlists, parse_channels, playlist_version
+from config import env_float, env_list, env_str
+from metrics import PLAYLIST_PARSE
+from upstream import UpstreamPool
+
+logger = logging.getLogger("iptv.playlist")
+
+# URL удаленного плейлиста IPTV
+PLAYLIST_URL = env_str("PLAYLIST_URL", "https://gitlab.com/iptv135435/iptvshared/raw/main/IPTV_SHARED.m3u")
+# Источники каналов по убыванию приоритета: URL или локальные файлы через запятую
+PLAYLIST_SOURCES = env_list("PLAYLIST_SOURCES", PLAYLIST_URL)
+# Как часто обновлять плейлист (в секундах) - каждые 6 часов
+PLAYLIST_REFRESH_TIME = env_float("PLAYLIST_REFRESH_TIME", 6 * 60 * 60)
+# Таймаут загрузки одного источника: медленный источник не задерживает остальные
+PLAYLIST_FETCH_TIMEOUT = env_float("PLAYLIST_FETCH_TIMEOUT", 30.0)
+# Пауза перед повтором после неудачной загрузки, удваивается до PLAYLIST_REFRESH_TIME
+PLAYLIST_RETRY_DELAY = env_float("PLAYLIST_RETRY_DELAY", 60.0)
+# Снимок последней версии: с него сервер стартует, не дожидаясь источника
+PLAYLIST_SNAPSHOT = env_str("PLAYLIST_SNAPSHOT", "playlist_snapshot.m3u")
+# Плейлист из репозитория - если снимков еще нет (пустое значение - не использовать)
+PLAYLIST_LOCAL_FALLBACK = env_str("PLAYLIST_LOCAL_FALLBACK", "local.m3u")
+
+
+class PlaylistError(Exception):
+    """Плейлист не удалось загрузить, а предыдущей версии нет"""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_remote(location: str) -> bool:
+    return location.startswith(('http://', 'https://'))
+
+
+def snapshot_path(base_path: str, index: int) -> str:
+    """Снимок первого источника - base_path, остальных - с номером: playlist_snapshot.2.m3u"""
+    if not base_path or index == 0:
+        return base_path
+    stem, ext = os.path.splitext(base_path)
+    return f"{stem}.{index + 1}{ext}"
+
+
+def _timed(stage: str, func, *args):
+    """Вызов в рабочем потоке с записью длительности в метрику разбора"""
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        PLAYLIST_PARSE.labels(stage).observe(time.perf_counter() - started)
+
+
+def _read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _read_file(path: str, mtime: float):
+    """Текст локального плейлиста, если файл изменился с mtime, иначе None"""
+    current = os.stat(path).st_mtime
+    if current == mtime:
+        return None, current
+    return _read_text(path), current
+
+
+def _write_snapshot(path: str, content: Optional[str], meta: Dict):
+    """
+    Атомарная запись: читатель видит либо старый снимок, либо новый целиком.
+    content=None - плейлист не изменился, обновляются только метаданные
+    """
+    files = [(path + ".json", json.dumps(meta))]
+    if content is not None:
+        files.insert(0, (path, content))
+    for target, data in files:
+        tmp = target + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, target)
+
+
+class PlaylistSource:
+    """
+    Один плейлист из списка источников: последняя полученная версия,
+    уже разобранная на каналы, и состояние условных запросов к нему
+    """
+
+    def __init__(self, location: str, snapshot: str = ""):
+        self.location = location
+        self.remote = is_remote(location)
+        self.snapshot = snapshot if self.remote else ""
+        self.content: Optional[str] = None
+        self.version: Optional[str] = None
+        self.channels: List[Channel] = []
+        self.header: Dict[str, str] = {}
+        # Откуда взята текущая версия: remote, file, snapshot или local
+        self.origin: Optional[str] = None
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.mtime = 0.0
+        # Когда менялось содержимое и когда источник последний раз проверен
+        self.updated_at = 0.0
+        self.checked_at = 0.0
+        self.last_error: Optional[str] = None
+        self.failures = 0
+        self.downloads = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def set_content(self, content: str, origin: str, updated_at: float) -> bool:
+        """Новая версия; разбирается только изменившийся плейлист. True - каталог нужно пересобрать"""
+        self.origin = origin
+        if content == self.content:
+            return False
+        self.channels, self.header = await asyncio.to_thread(_timed, "parse", parse_channels, content)
+        self.content = content
+        self.version = playlist_version(content)
+        self.updated_at = updated_at
+        return True
+
+    def next_check(self, refresh_time: float) -> float:
+        if self.failures:
+            return self.checked_at + min(refresh_time, PLAYLIST_RETRY_DELAY * 2 ** (self.failures - 1))
+        return self.checked_at + refresh_time
+
+    def stats(self) -> Dict:
+        return {
+            "location": self.location,
+            "origin": self.origin,
+            "channels": len(self.channels),
+            "checked_at": self.checked_at or None,
+            "refreshing": self._refreshing is not None and not self._refreshing.done(),
+            "elapsed": round(self.elapsed, 3),
+            "downloads": self.downloads,
+            "not_modified": self.not_modified,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class PlaylistRefresher:
+    """
+    Плейлисты обновляет фоновая задача раз в refresh_time; запросы всегда
+    получают текущий каталог сразу и никогда не ждут источник (stale-while-revalidate).
+
+    Источники загружаются параллельно, каждый со своим таймаутом, и объединяются
+    в один каталог в порядке приоритета. Каталог пересобирается, как только
+    изменился любой источник, не дожидаясь остальных; заново разбирается
+    только изменившийся плейлист.
+
+    По каждому источнику одновременно идет не больше одной загрузки:
+    принудительное обновление присоединяется к уже начатой. Удаленные
+    источники опрашиваются условным запросом (If-None-Match/If-Modified-Since),
+    неизменившийся плейлист не скачивается.
+    """
+
+    def __init__(self, pool: UpstreamPool, sources: Optional[List[str]] = None,
+                 refresh_time: float = PLAYLIST_REFRESH_TIME,
+                 timeout: float = PLAYLIST_FETCH_TIMEOUT,
+                 snapshot_base: str = PLAYLIST_SNAPSHOT,
+                 fallback_path: str = PLAYLIST_LOCAL_FALLBACK):
+        self.pool = pool
+        self.refresh_time = refresh_time
+        self.timeout = timeout
+        self.fallback_path = fallback_path
+        self.sources = [PlaylistSource(location, snapshot_path(snapshot_base, index))
+                        for index, location in enumerate(sources or PLAYLIST_SOURCES)]
+        self.catalog: Optional[Catalog] = None
+        self.rebuilds = 0
+        # Вызывается с новым каталогом после каждой пересборки
+        self.on_rebuild: Optional[Callable[[Catalog], Awaitable[None]]] = None
+        self.background = True
+        self._task: Optional[asyncio.Task] = None
+        self._rebuild_lock = asyncio.Lock()
+        self._ready = asyncio.Event()
+
+    async def start(self, background: bool = True):
+        """
+        Загружает снимки с диска и запускает фоновое обновление.
+        background=False - каталог приходит извне (adopt), источники не опрашиваются
+        """
+        self.background = background
+        if self.catalog is None:
+            await self.load_snapshots()
+        if background:
+            self.run_in_background()
+
+    def run_in_background(self):
+        self.background = True
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def adopt(self, catalog: Catalog) -> bool:
+        """Каталог, собранный в другом процессе"""
+        if self.catalog is not None and self.catalog.version == catalog.version:
+            return False
+        self.catalog = catalog
+        self.rebuilds += 1
+        self._ready.set()
+        return True
+
+    async def close(self):
+        tasks = [self._task] + [source._refreshing for source in self.sources]
+        for task in tasks:
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = None
+        for source in self.sources:
+            source._refreshing = None
+
+    async def load_snapshots(self):
+        """Снимки удаленных источников и локальные файлы; без снимков - плейлист из репозитория"""
+        for source in self.sources:
+            if source.remote:
+                await self._load_snapshot(source)
+            else:
+                try:
+                    await self._read_local(source)
+                except OSError as e:
+                    source.last_error = str(e)
+                    logger.error("Не удалось прочитать плейлист %s: %s", source.location, e)
+        if not any(source.content for source in self.sources) and self.fallback_path:
+            content = await asyncio.to_thread(_read_text, self.fallback_path)
+            if content:
+                await self.sources[0].set_content(content, "local", time.time())
+        await self._rebuild()
+        if self.catalog is not None:
+            origins = ", ".join(sorted({source.origin for source in self.sources if source.origin}))
+            logger.info("Плейлист загружен с диска (%s): %s каналов в %s категориях",
+                        origins, len(self.catalog), len(self.catalog.groups))
+
+    async def _load_snapshot(self, source: PlaylistSource):
+        if not source.snapshot:
+            return
+        content = await asyncio.to_thread(_read_text, source.snapshot)
+        if not content:
+            return
+        meta_text = await asyncio.to_thread(_read_text, source.snapshot + ".json")
+        try:
+            meta = json.loads(meta_text) if meta_text else {}
+        except ValueError:
+            meta = {}
+        # Снимок чужого адреса (список источников изменился) не используется
+        if meta.get("url") != source.location:
+            return
+        await source.set_content(content, "snapshot", meta.get("updated_at") or time.time())
+        source.etag = meta.get("etag")
+        source.last_modified = meta.get("last_modified")
+        # Снимок моложе refresh_time не перезагружается сразу после старта
+        source.checked_at = meta.get("checked_at") or 0.0
+
+    async def get_catalog(self) -> Catalog:
+        """
+        Текущий каталог. Ждать приходится, только если версии еще нет совсем,
+        и только до первого ответившего источника
+        """
+        if self.catalog is None and not self.background:
+            try:
+                await asyncio.wait_for(self._ready.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise PlaylistError("Каталог еще не получен от ведущего воркера", status_code=503)
+        if self.catalog is None:
+            refreshing = asyncio.ensure_future(self.refresh())
+            ready = asyncio.ensure_future(self._ready.wait())
+            await asyncio.wait([refreshing, ready], return_when=asyncio.FIRST_COMPLETED)
+            ready.cancel()
+            if self.catalog is None:
+                errors = "; ".join(source.last_error for source in self.sources if source.last_error)
+                raise PlaylistError(f"Не удалось загрузить плейлист: {errors}")
+        return self.catalog
+
+    async def refresh(self, due_only: bool = False) -> Optional[Catalog]:
+        """Обновить источники сейчас (due_only - только те, которым пора); уже идущие загрузки не дублируются"""
+        now = time.time()
+        await asyncio.gather(*(self._refresh_source(source) for source in self.sources
+                               if not due_only or source.next_check(self.refresh_time) <= now))
+        return self.catalog
+
+    @property
+    def last_error(self) -> Optional[str]:
+        """Ошибка, если не обновился ни один источник"""
+        errors = [source.last_error for source in self.sources]
+        return "; ".join(errors) if all(errors) else None
+
+    async def _run(self):
+        while True:
+            next_check = min(source.next_check(self.refresh_time) for source in self.sources)
+            delay = next_check - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.refresh(due_only=True)
+
+    async def _refresh_source(self, source: PlaylistSource):
+        if source._refreshing is None or source._refreshing.done():
+            source._refreshing = asyncio.ensure_future(self._update(source))
+        await asyncio.shield(source._refreshing)
+
+    async def _update(self, source: PlaylistSource):
+        started = time.monotonic()
+        try:
+            if source.remote:
+                changed = await asyncio.wait_for(self._download(source), self.timeout)
+            else:
+                changed = await self._read_local(source)
+        except Exception as e:
+            source.errors += 1
+            source.failures += 1
+            source.checked_at = time.time()
+            source.last_error = str(e) or type(e).__name__
+            logger.error("Ошибка при загрузке плейлиста %s: %s", source.location, source.last_error,
+                         extra={"host": urlparse(source.location).netloc})
+            return
+        finally:
+            source.elapsed = time.monotonic() - started
+        source.failures = 0
+        source.last_error = None
+        if changed:
+            await self._rebuild()
+
+    async def _read_local(self, source: PlaylistSource) -> bool:
+        content, source.mtime = await asyncio.to_thread(_read_file, source.location, source.mtime)
+        source.checked_at = time.time()
+        if content is None:
+            return False
+        return await source.set_content(content, "file", source.mtime)
+
+    async def _download(self, source: PlaylistSource) -> bool:
+        headers = {}
+        # Без текущей версии условный запрос бессмыслен
+        if source.content is not None:
+            if source.etag:
+                headers["If-None-Match"] = source.etag
+            if source.last_modified:
+                headers["If-Modified-Since"] = source.last_modified
+
+        logger.info("Загрузка удаленного плейлиста: %s", source.location)
+        async with self.pool.host_slot(source.location):
+            response = await self.pool.client.get(source.location, headers=headers, timeout=self.timeout)
+        now = time.time()
+
+        if response.status_code == 304 and source.content is not None:
+            source.not_modified += 1
+            source.checked_at = now
+            logger.info("Плейлист не изменился: %s", source.location)
+            await self._save(source, None)
+            return False
+        if response.status_code != 200:
+            raise PlaylistError(f"Ошибка загрузки плейлиста: HTTP {response.status_code}",
+                                status_code=response.status_code)
+
+        source.downloads += 1
+        content = response.text
+        changed = await source.set_content(content, "remote", now)
+        source.etag = response.headers.get("etag")
+        source.last_modified = response.headers.get("last-modified")
+        source.checked_at = now
+        await self._save(source, content)
+
+        logger.info("Плейлист успешно загружен: %s, размер: %s байт, %s каналов",
+                    source.location, len(content), len(source.channels))
+        return changed
+
+    async def _save(self, source: PlaylistSource, content: Optional[str]):
+        if not source.snapshot:
+            return
+        meta = {
+            "url": source.location,
+            "etag": source.etag,
+            "last_modified": source.last_modified,
+            "updated_at": source.updated_at,
+            "checked_at": source.checked_at,
+        }
+        try:
+            await asyncio.to_thread(_write_snapshot, source.snapshot, content, meta)
+        except OSError as e:
+            logger.warning("Не удалось сохранить снимок плейлиста: %s", e)
+
+    async def _rebuild(self):
+        """Собирает каталог из текущих версий всех источников"""
+        async with self._rebuild_lock:
+            loaded = [source for source in self.sources if source.content is not None]
+            if not loaded:
+                return
+            # С одним источником версия каталога - хэш плейлиста, как и раньше
+            versions = [source.version for source in loaded]
+            version = versions[0] if len(versions) == 1 else hashlib.sha1('\n'.join(versions).encode()).hexdigest()
+            if self.catalog is not None and self.catalog.version == version:
+                return
+            updated_at = max(source.updated_at for source in loaded)
+            self.catalog = await asyncio.to_thread(
+                _timed, "merge", merge_playlists, [(source.channels, source.header) for source in loaded], version, updated_at)
+            self.rebuilds += 1
+            self._ready.set()
+            logger.info("Каталог собран из %s источников: %s каналов в %s категориях",
+                        len(loaded), len(self.catalog), len(self.catalog.groups))
+            if self.on_rebuild is not None:
+                await self.on_rebuild(self.catalog)
+
+    def stats(self) -> Dict:
+        checked = [source.checked_at for source in self.sources if source.checked_at]
+        return {
+            "checked_at": max(checked) if checked else None,
+            "next_refresh": min(source.next_check(self.refresh_time) for source in self.sources),
+            "rebuilds": self.rebuilds,
+            "sources": [source.stats() for source in self.sources],
+        }
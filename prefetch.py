@@ -0,0 +1,185 @@
+"""Упреждающая загрузка сегментов живых каналов в кэш"""
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+from config import env_bool, env_float, env_int
+
+logger = logging.getLogger("iptv.prefetch")
+
+# Сколько последних сегментов окна держать в кэше заранее
+PREFETCH_ENABLED = env_bool("PREFETCH_ENABLED", True)
+PREFETCH_SEGMENTS = env_int("PREFETCH_SEGMENTS", 3)
+# Через сколько секунд без запросов плейлиста загрузка для канала останавливается
+PREFETCH_IDLE_TIMEOUT = env_float("PREFETCH_IDLE_TIMEOUT", 30.0)
+PREFETCH_PER_HOST_LIMIT = env_int("PREFETCH_PER_HOST_LIMIT", 4)
+PREFETCH_MAX_PLAYLISTS = env_int("PREFETCH_MAX_PLAYLISTS", 256)
+
+TARGET_DURATION_RE = re.compile(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)')
+
+# Сколько загруженных заранее ключей помнить для подсчета попаданий
+TRACKED_KEYS = 4096
+
+
+def playlist_segments(text: str, playlist_url: str) -> List[str]:
+    """Абсолютные ссылки на сегменты медиа-плейлиста по порядку"""
+    return [urljoin(playlist_url, line.strip()) for line in text.splitlines()
+            if line.strip() and not line.startswith('#')]
+
+
+def poll_interval(text: str) -> float:
+    match = TARGET_DURATION_RE.search(text)
+    return max(1.0, float(match.group(1))) if match else 2.0
+
+
+class _Watch:
+    __slots__ = ('url', 'user_agent', 'profile', 'last_seen', 'task')
+
+    def __init__(self, url: str, user_agent: str, profile: Any):
+        self.url = url
+        self.user_agent = user_agent
+        self.profile = profile
+        self.last_seen = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+
+class Prefetcher:
+    """
+    Для каждого живого плейлиста, который кто-то смотрит, фоновая задача
+    перечитывает его раз в target duration и загружает последние сегменты
+    в кэш до того, как их запросит плеер. Задача завершается сама,
+    если плейлист не запрашивали дольше idle_timeout.
+
+    fetch_playlist(url, user_agent, profile) возвращает текст плейлиста и адрес
+    после редиректов, от которого разрешаются ссылки (None - не HLS),
+    fetch_segment(url, user_agent, profile) загружает сегмент в кэш и возвращает его ключ,
+    is_cached(url, user_agent, profile) проверяет кэш без учета в статистике.
+    profile - профиль заголовков канала, с которым зритель запросил плейлист.
+    """
+
+    def __init__(self,
+                 fetch_playlist: Callable[[str, str, Any], Awaitable[Optional[Tuple[str, str]]]],
+                 fetch_segment: Callable[[str, str, Any], Awaitable[Optional[str]]],
+                 is_cached: Callable[[str, str, Any], bool],
+                 depth: int = PREFETCH_SEGMENTS,
+                 idle_timeout: float = PREFETCH_IDLE_TIMEOUT,
+                 per_host_limit: int = PREFETCH_PER_HOST_LIMIT,
+                 max_playlists: int = PREFETCH_MAX_PLAYLISTS,
+                 enabled: bool = PREFETCH_ENABLED):
+        self.fetch_playlist = fetch_playlist
+        self.fetch_segment = fetch_segment
+        self.is_cached = is_cached
+        self.depth = depth
+        self.idle_timeout = idle_timeout
+        self.per_host_limit = per_host_limit
+        self.max_playlists = max_playlists
+        self.enabled = enabled and depth > 0
+        self._watches: Dict[str, _Watch] = {}
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._in_flight: set = set()
+        # Ключи загруженных заранее сегментов: True, пока их не запросил зритель
+        self._prefetched: "OrderedDict[str, bool]" = OrderedDict()
+        self.prefetched = 0
+        self.failed = 0
+        self.used = 0
+        self.segment_requests = 0
+
+    def touch(self, playlist_url: str, user_agent: str, profile: Any = None):
+        """Зритель запросил медиа-плейлист: продлеваем или запускаем загрузку"""
+        if not self.enabled:
+            return
+        watch = self._watches.get(playlist_url)
+        if watch is not None:
+            watch.last_seen = time.monotonic()
+            watch.user_agent = user_agent
+            watch.profile = profile
+            return
+        if len(self._watches) >= self.max_playlists:
+            return
+        watch = self._watches[playlist_url] = _Watch(playlist_url, user_agent, profile)
+        watch.task = asyncio.ensure_future(self._run(watch))
+
+    def record_request(self, cache_key: str):
+        """Зритель запросил сегмент; считаем, был ли он загружен заранее"""
+        self.segment_requests += 1
+        if self._prefetched.get(cache_key):
+            self._prefetched[cache_key] = False
+            self.used += 1
+
+    async def _run(self, watch: _Watch):
+        logger.info("Упреждающая загрузка запущена: %s", watch.url)
+        try:
+            while time.monotonic() - watch.last_seen < self.idle_timeout:
+                fetched = await self.fetch_playlist(watch.url, watch.user_agent, watch.profile)
+                if fetched is None:
+                    break
+                text, base_url = fetched
+                # Мастер-плейлисты и VOD не обновляются - следить нечего
+                if '#EXT-X-STREAM-INF' in text or '#EXT-X-ENDLIST' in text:
+                    break
+                segments = playlist_segments(text, base_url)[-self.depth:]
+                await asyncio.gather(*(self._prefetch(url, watch) for url in segments))
+                await asyncio.sleep(poll_interval(text))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Упреждающая загрузка остановлена: %s: %s", watch.url, e,
+                           extra={"host": urlparse(watch.url).netloc})
+        finally:
+            if self._watches.get(watch.url) is watch:
+                del self._watches[watch.url]
+        logger.info("Упреждающая загрузка завершена: %s", watch.url)
+
+    @asynccontextmanager
+    async def _host_slot(self, url: str):
+        host = urlparse(url).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        async with slot:
+            yield
+
+    async def _prefetch(self, url: str, watch: _Watch):
+        if url in self._in_flight or self.is_cached(url, watch.user_agent, watch.profile):
+            return
+        self._in_flight.add(url)
+        try:
+            async with self._host_slot(url):
+                key = await self.fetch_segment(url, watch.user_agent, watch.profile)
+            if key is None:
+                return
+            self.prefetched += 1
+            self._prefetched[key] = True
+            while len(self._prefetched) > TRACKED_KEYS:
+                self._prefetched.popitem(last=False)
+        except Exception as e:
+            self.failed += 1
+            logger.debug("Не удалось загрузить сегмент заранее %s: %s", url, e, extra={"host": urlparse(url).netloc})
+        finally:
+            self._in_flight.discard(url)
+
+    async def close(self):
+        tasks = [watch.task for watch in self._watches.values() if watch.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._watches.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "active_playlists": len(self._watches),
+            "in_flight": len(self._in_flight),
+            "prefetched": self.prefetched,
+            "failed": self.failed,
+            "used": self.used,
+            # Доля загруженных заранее сегментов, которые потом запросил зритель
+            "hit_ratio": round(self.used / self.prefetched, 4) if self.prefetched else 0.0,
+            # Доля запросов сегментов, обслуженных упреждающей загрузкой
+            "served_ratio": round(self.used / self.segment_requests, 4) if self.segment_requests else 0.0,
+        }
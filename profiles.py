@@ -0,0 +1,75 @@
+"""Профили заголовков запросов к источникам, заданные для каналов в плейлисте"""
+import hashlib
+from typing import Dict, Optional
+
+# Параметр /proxy, в котором передается id профиля
+PROFILE_PARAM = "p"
+
+# Атрибуты #EXTINF и опции #EXTVLCOPT, которые становятся заголовками
+HEADER_OPTIONS = {
+    'http-user-agent': 'User-Agent',
+    'user-agent': 'User-Agent',
+    'http-referrer': 'Referer',
+    'http-referer': 'Referer',
+    'referrer': 'Referer',
+    'http-origin': 'Origin',
+    'origin': 'Origin',
+}
+
+
+class HeaderProfile:
+    """
+    Набор заголовков для источника. id вычисляется по содержимому,
+    поэтому у одинаковых профилей разных каналов и версий плейлиста он общий.
+    """
+    __slots__ = ('id', 'headers')
+
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = dict(sorted(headers.items()))
+        digest = '\n'.join(f"{name}:{value}" for name, value in self.headers.items())
+        self.id = hashlib.sha1(digest.encode('utf-8')).hexdigest()[:10]
+
+    @property
+    def user_agent(self) -> Optional[str]:
+        return self.headers.get('User-Agent')
+
+    def to_dict(self) -> Dict:
+        return {"id": self.id, "headers": self.headers}
+
+
+def profile_headers(attrs: Dict[str, str], vlc_opts: Dict[str, str]) -> Dict[str, str]:
+    """Заголовки канала: сначала атрибуты #EXTINF, #EXTVLCOPT их переопределяют"""
+    headers: Dict[str, str] = {}
+    for source in (attrs, vlc_opts):
+        for option, header in HEADER_OPTIONS.items():
+            value = source.get(option)
+            if value:
+                headers[header] = value
+    return headers
+
+
+def profile_suffix(profile: Optional[HeaderProfile]) -> str:
+    """Хвост ссылки /proxy, с которым профиль переходит к вложенным ресурсам"""
+    return f"&{PROFILE_PARAM}={profile.id}" if profile is not None else ""
+
+
+class ProfileStats:
+    """Коды ответов источников по профилям заголовков"""
+
+    def __init__(self):
+        self.profiles: Dict[str, Dict] = {}
+
+    def record(self, profile: Optional[HeaderProfile], status):
+        profile_id = profile.id if profile is not None else "default"
+        entry = self.profiles.get(profile_id)
+        if entry is None:
+            entry = self.profiles[profile_id] = {
+                "user_agent": profile.user_agent if profile is not None else None,
+                "statuses": {},
+            }
+        statuses = entry["statuses"]
+        key = str(status)
+        statuses[key] = statuses.get(key, 0) + 1
+
+    def stats(self) -> Dict:
+        return self.profiles
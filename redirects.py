@@ -0,0 +1,88 @@
+"""Кэш разрешенных редиректов: адрес источника -> конечный адрес после цепочки 3xx"""
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from cache import canonical_cache_key
+from config import env_float, env_int
+
+# Сколько помнить конечный адрес (секунд) и сколько адресов хранить
+REDIRECT_CACHE_TTL = env_float("REDIRECT_CACHE_TTL", 300.0)
+REDIRECT_CACHE_MAX_ENTRIES = env_int("REDIRECT_CACHE_MAX_ENTRIES", 4096)
+
+
+class _Target:
+    __slots__ = ('url', 'hops', 'expires')
+
+    def __init__(self, url: str, hops: int, expires: float):
+        self.url = url
+        self.hops = hops
+        self.expires = expires
+
+
+class RedirectCache:
+    """
+    Запоминает, куда в итоге ведет цепочка редиректов. Повторный запрос
+    идет сразу на конечный адрес; если тот ответил 4xx/5xx, запись
+    удаляется и цепочка проходится заново.
+    """
+
+    def __init__(self, ttl: float = REDIRECT_CACHE_TTL, max_entries: int = REDIRECT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._targets: "OrderedDict[str, _Target]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.hops_saved = 0
+        self.hops_walked = 0
+        # Сколько запросов прошли цепочку из N переходов
+        self.hop_counts: Dict[int, int] = {}
+
+    def get(self, url: str) -> Optional[str]:
+        if self.ttl <= 0:
+            return None
+        key = canonical_cache_key(url)
+        target = self._targets.get(key)
+        if target is not None:
+            if target.expires > time.time():
+                self._targets.move_to_end(key)
+                self.hits += 1
+                self.hops_saved += target.hops
+                return target.url
+            del self._targets[key]
+        self.misses += 1
+        return None
+
+    def put(self, url: str, final_url: str, hops: int):
+        if self.ttl <= 0:
+            return
+        key = canonical_cache_key(url)
+        self._targets[key] = _Target(final_url, hops, time.time() + self.ttl)
+        self._targets.move_to_end(key)
+        while len(self._targets) > self.max_entries:
+            self._targets.popitem(last=False)
+
+    def invalidate(self, url: str):
+        if self._targets.pop(canonical_cache_key(url), None) is not None:
+            self.invalidations += 1
+
+    def record_hops(self, hops: int):
+        self.hops_walked += hops
+        self.hop_counts[hops] = self.hop_counts.get(hops, 0) + 1
+
+    def clear(self) -> int:
+        count = len(self._targets)
+        self._targets.clear()
+        return count
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._targets),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hops_walked": self.hops_walked,
+            "hops_saved": self.hops_saved,
+            "hop_counts": {str(hops): count for hops, count in sorted(self.hop_counts.items())},
+        }
@@ -0,0 +1,397 @@
+"""Ретрансляция канала: одна сессия к источнику на канал для всех зрителей"""
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+from config import env_bool, env_float, env_int
+from hls_rewriter import rewrite_uri_attribute
+from profiles import HeaderProfile, profile_suffix
+
+logger = logging.getLogger("iptv.relay")
+
+# /api/stream/{id} по умолчанию ведет в ретранслятор, а не в /proxy
+RELAY_ENABLED = env_bool("RELAY_ENABLED", False)
+# Сколько сегментов держит кольцевой буфер канала
+RELAY_WINDOW = env_int("RELAY_WINDOW", 6)
+# С какого числа последних сегментов начинается новая сессия
+RELAY_START_SEGMENTS = env_int("RELAY_START_SEGMENTS", 3)
+RELAY_IDLE_TIMEOUT = env_float("RELAY_IDLE_TIMEOUT", 30.0)
+RELAY_START_TIMEOUT = env_float("RELAY_START_TIMEOUT", 15.0)
+RELAY_MAX_CHANNELS = env_int("RELAY_MAX_CHANNELS", 64)
+# Сколько секунд не пытаться снова ретранслировать источник, который не удалось ретранслировать
+RELAY_UNSUPPORTED_TTL = env_float("RELAY_UNSUPPORTED_TTL", 300.0)
+# Сколько ошибок подряд при чтении плейлиста завершают сессию
+RELAY_MAX_FAILURES = 3
+
+BANDWIDTH_RE = re.compile(r'BANDWIDTH=(\d+)')
+
+# Теги LL-HLS и уровня плейлиста, которые не переносятся в плейлист ретранслятора
+SKIPPED_TAGS = (
+    '#EXTM3U',
+    '#EXT-X-PART',
+    '#EXT-X-PRELOAD-HINT',
+    '#EXT-X-RENDITION-REPORT',
+    '#EXT-X-SERVER-CONTROL',
+    '#EXT-X-SKIP',
+    '#EXT-X-PLAYLIST-TYPE',
+    '#EXT-X-ALLOW-CACHE',
+    '#EXT-X-START',
+    '#EXT-X-DISCONTINUITY-SEQUENCE',
+)
+
+# fetch(url, profile) -> (статус, тело, content-type)
+Fetch = Callable[[str, Optional[HeaderProfile]], Awaitable[Tuple[int, bytes, str]]]
+
+
+class RelayUnsupported(Exception):
+    """Источник канала нельзя ретранслировать (не живой HLS)"""
+
+
+class RelaySegment:
+    __slots__ = ('seq', 'tags', 'key_line', 'map_line', 'body', 'content_type', 'discontinuity')
+
+    def __init__(self, seq: int, tags: List[str], key_line: Optional[str], map_line: Optional[str],
+                 body: bytes, content_type: str, discontinuity: bool):
+        self.seq = seq
+        self.tags = tags
+        self.key_line = key_line
+        self.map_line = map_line
+        self.body = body
+        self.content_type = content_type
+        self.discontinuity = discontinuity
+
+
+def select_variant(text: str, base_url: str) -> str:
+    """Из мастер-плейлиста выбирает вариант с наибольшим битрейтом"""
+    best_url, best_bandwidth = None, -1
+    bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            match = BANDWIDTH_RE.search(line)
+            bandwidth = int(match.group(1)) if match else 0
+        elif line and not line.startswith('#') and bandwidth is not None:
+            if bandwidth > best_bandwidth:
+                best_url, best_bandwidth = urljoin(base_url, line), bandwidth
+            bandwidth = None
+    if best_url is None:
+        raise RelayUnsupported("В мастер-плейлисте нет вариантов")
+    return best_url
+
+
+class ChannelRelay:
+    """
+    Сессия ретрансляции одного канала. Фоновая задача читает медиа-плейлист
+    источника и один раз скачивает каждый новый сегмент в кольцевой буфер;
+    зрители получают собственный плейлист ретранслятора и сегменты из буфера.
+    """
+
+    def __init__(self, channel_id: str, url: str, profile: Optional[HeaderProfile], fetch: Fetch,
+                 window: int = RELAY_WINDOW, start_segments: int = RELAY_START_SEGMENTS):
+        self.channel_id = channel_id
+        self.url = url
+        self.profile = profile
+        # Ключи и init-сегменты зрители получают через /proxy с тем же профилем
+        self.suffix = profile_suffix(profile)
+        self.fetch = fetch
+        self.window = window
+        self.start_segments = start_segments
+        self.media_url = url
+        self.ring: Deque[RelaySegment] = deque()
+        self.next_seq = 0
+        self.discontinuity_seq = 0
+        self.last_upstream_seq: Optional[int] = None
+        self.target_duration = 0
+        self.version: Optional[str] = None
+        self.independent_segments = False
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.error: Optional[str] = None
+        self.last_seen = time.monotonic()
+        self.viewers: Dict[str, float] = {}
+        self.upstream_segments = 0
+        self.upstream_bytes = 0
+        self.served_segments = 0
+        self.served_bytes = 0
+        self._rendered: Optional[bytes] = None
+        # Сегменты прежней сессии канала, которые зрители еще могут запросить
+        self.previous: Deque[RelaySegment] = deque()
+        self.task: Optional[asyncio.Task] = None
+
+    def continue_from(self, previous: "ChannelRelay"):
+        """
+        Продолжает нумерацию прежней сессии канала (например, после смены
+        зеркала): плейлист зрителей не откатывается назад, первый сегмент
+        новой сессии идет после #EXT-X-DISCONTINUITY
+        """
+        self.next_seq = previous.next_seq
+        self.discontinuity_seq = previous.discontinuity_seq + sum(
+            1 for segment in previous.ring if segment.discontinuity)
+        self.previous = previous.ring
+        self.viewers = previous.viewers
+
+    def touch(self, viewer: str):
+        now = time.monotonic()
+        self.last_seen = now
+        self.viewers[viewer] = now
+
+    def active_viewers(self) -> int:
+        # Зритель считается активным, пока обновляет плейлист
+        horizon = time.monotonic() - max(3 * self.target_duration, 10)
+        for viewer in [v for v, seen in self.viewers.items() if seen < horizon]:
+            del self.viewers[viewer]
+        return len(self.viewers)
+
+    async def run(self, idle_timeout: float):
+        logger.info("Ретрансляция канала %s запущена: %s", self.channel_id, self.url)
+        try:
+            await self._resolve()
+            failures = 0
+            while time.monotonic() - self.last_seen < idle_timeout:
+                try:
+                    text = await self._fetch_playlist(self.media_url)
+                    await self._ingest(text)
+                    failures = 0
+                except RelayUnsupported:
+                    raise
+                except Exception as e:
+                    failures += 1
+                    logger.warning("Ретрансляция канала %s: ошибка обновления (%s/%s): %s",
+                                   self.channel_id, failures, RELAY_MAX_FAILURES, e,
+                                   extra={"host": urlparse(self.media_url).netloc})
+                    if failures >= RELAY_MAX_FAILURES:
+                        raise
+                if self.ring:
+                    self.ready.set()
+                # Плейлист проверяется вдвое чаще target duration, чтобы не отставать от источника
+                await asyncio.sleep(max(0.5, (self.target_duration or 2) / 2))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = str(e)
+            logger.warning("Ретрансляция канала %s остановлена: %s", self.channel_id, e,
+                           extra={"host": urlparse(self.url).netloc})
+        finally:
+            self.closed = True
+            self.ready.set()
+        logger.info("Ретрансляция канала %s завершена", self.channel_id)
+
+    async def _fetch_playlist(self, url: str) -> str:
+        status_code, body, content_type = await self.fetch(url, self.profile)
+        if status_code != 200:
+            raise ConnectionError(f"Источник ответил {status_code}")
+        text = body.decode('utf-8', errors='replace')
+        if '#EXTM3U' not in text[:1024]:
+            raise RelayUnsupported("Источник не является HLS-плейлистом")
+        return text
+
+    async def _resolve(self):
+        """Мастер-плейлист заменяется одним вариантом: канал - одна сессия к источнику"""
+        text = await self._fetch_playlist(self.url)
+        if '#EXT-X-STREAM-INF' in text:
+            if re.search(r'#EXT-X-MEDIA:[^\n]*TYPE=AUDIO[^\n]*URI=', text):
+                raise RelayUnsupported("Отдельные аудиодорожки не ретранслируются")
+            self.media_url = select_variant(text, self.url)
+        if '#EXT-X-ENDLIST' in text:
+            raise RelayUnsupported("VOD-плейлист не ретранслируется")
+
+    async def _ingest(self, text: str):
+        """Добавляет в буфер сегменты, появившиеся с прошлого чтения плейлиста"""
+        media_sequence = 0
+        seq = None
+        tags: List[str] = []
+        key_line = map_line = None
+        items = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXT-X-TARGETDURATION:'):
+                self.target_duration = int(float(line[22:].strip() or 0))
+            elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                media_sequence = int(line[22:].strip() or 0)
+            elif line.startswith('#EXT-X-VERSION:'):
+                self.version = line[15:].strip()
+            elif line.startswith('#EXT-X-INDEPENDENT-SEGMENTS'):
+                self.independent_segments = True
+            elif line.startswith('#EXT-X-ENDLIST'):
+                raise RelayUnsupported("Трансляция завершена")
+            elif line.startswith('#EXT-X-KEY:'):
+                key_line = rewrite_uri_attribute(line, self.media_url, self.suffix)
+            elif line.startswith('#EXT-X-MAP:'):
+                map_line = rewrite_uri_attribute(line, self.media_url, self.suffix)
+            elif line.startswith(SKIPPED_TAGS):
+                continue
+            elif line.startswith('#'):
+                tags.append(line)
+            else:
+                seq = media_sequence + len(items)
+                items.append((seq, tags, key_line, map_line, urljoin(self.media_url, line)))
+                tags = []
+
+        last = self.last_upstream_seq
+        if last is None or not items or items[-1][0] < last:
+            # Новая сессия или источник перезапустил нумерацию - начинаем с края окна
+            new_items = items[-self.start_segments:]
+            gap = last is not None or self.next_seq > 0
+        else:
+            new_items = [item for item in items if item[0] > last]
+            gap = bool(new_items) and new_items[0][0] > last + 1
+
+        for upstream_seq, seg_tags, seg_key, seg_map, uri in new_items:
+            status_code, body, content_type = await self.fetch(uri, self.profile)
+            self.last_upstream_seq = upstream_seq
+            if status_code != 200:
+                logger.warning("Ретрансляция канала %s: сегмент %s -> %s", self.channel_id, uri, status_code,
+                               extra={"host": urlparse(uri).netloc})
+                gap = True
+                continue
+            discontinuity = gap or '#EXT-X-DISCONTINUITY' in seg_tags
+            if discontinuity and '#EXT-X-DISCONTINUITY' not in seg_tags:
+                seg_tags = ['#EXT-X-DISCONTINUITY'] + seg_tags
+            gap = False
+            self._append(RelaySegment(self.next_seq, seg_tags, seg_key, seg_map, body, content_type, discontinuity))
+            self.upstream_segments += 1
+            self.upstream_bytes += len(body)
+
+    def _append(self, segment: RelaySegment):
+        self.ring.append(segment)
+        self.next_seq += 1
+        while len(self.ring) > self.window:
+            dropped = self.ring.popleft()
+            if dropped.discontinuity:
+                self.discontinuity_seq += 1
+        if len(self.ring) >= self.window:
+            self.previous = deque()
+        self._rendered = None
+
+    def playlist(self, segment_url: Callable[[int], str]) -> bytes:
+        """Плейлист ретранслятора; собирается заново только при изменении буфера"""
+        if self._rendered is not None:
+            return self._rendered
+        ring = list(self.ring)
+        lines = ['#EXTM3U', f'#EXT-X-VERSION:{self.version or 3}',
+                 f'#EXT-X-TARGETDURATION:{self.target_duration or 2}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{ring[0].seq if ring else self.next_seq}',
+                 f'#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_seq}']
+        if self.independent_segments:
+            lines.append('#EXT-X-INDEPENDENT-SEGMENTS')
+        key_line = map_line = None
+        for segment in ring:
+            # Ключ и init-сегмент повторяются, когда меняются или выпадают из окна
+            if segment.key_line != key_line and segment.key_line is not None:
+                lines.append(segment.key_line)
+            if segment.map_line != map_line and segment.map_line is not None:
+                lines.append(segment.map_line)
+            key_line, map_line = segment.key_line, segment.map_line
+            lines.extend(segment.tags)
+            lines.append(segment_url(segment.seq))
+        self._rendered = ('\n'.join(lines) + '\n').encode('utf-8')
+        return self._rendered
+
+    def segment(self, seq: int) -> Optional[RelaySegment]:
+        for ring in (self.ring, self.previous):
+            if not ring:
+                continue
+            index = seq - ring[0].seq
+            if 0 <= index < len(ring):
+                segment = ring[index]
+                self.served_segments += 1
+                self.served_bytes += len(segment.body)
+                return segment
+        return None
+
+
+class RelayHub:
+    """Сессии ретрансляции по id канала"""
+
+    def __init__(self, fetch: Fetch, idle_timeout: float = RELAY_IDLE_TIMEOUT,
+                 max_channels: int = RELAY_MAX_CHANNELS, unsupported_ttl: float = RELAY_UNSUPPORTED_TTL):
+        self.fetch = fetch
+        self.idle_timeout = idle_timeout
+        self.max_channels = max_channels
+        self.unsupported_ttl = unsupported_ttl
+        self._relays: Dict[str, ChannelRelay] = {}
+        # адрес источника -> (до какого времени, причина)
+        self._unsupported: Dict[str, Tuple[float, str]] = {}
+        self.skipped = 0
+
+    def unsupported(self, url: str) -> Optional[str]:
+        """Причина, по которой источник недавно не удалось ретранслировать"""
+        known = self._unsupported.get(url)
+        if known is None:
+            return None
+        if known[0] <= time.monotonic():
+            del self._unsupported[url]
+            return None
+        self.skipped += 1
+        return known[1]
+
+    def mark_unsupported(self, url: str, reason: str):
+        now = time.monotonic()
+        for expired in [key for key, (until, _) in self._unsupported.items() if until <= now]:
+            del self._unsupported[expired]
+        if self.unsupported_ttl > 0:
+            self._unsupported[url] = (now + self.unsupported_ttl, reason)
+
+    def get(self, channel_id: str) -> Optional[ChannelRelay]:
+        relay = self._relays.get(channel_id)
+        return relay if relay is not None and not relay.closed else None
+
+    def session(self, channel_id: str, url: str, profile: Optional[HeaderProfile]) -> ChannelRelay:
+        """
+        Возвращает сессию канала, при необходимости запуская новую. Новая
+        сессия того же канала продолжает нумерацию сегментов прежней
+        """
+        previous = self._relays.get(channel_id)
+        if previous is not None and not previous.closed and previous.url == url:
+            return previous
+        if previous is not None:
+            previous.task.cancel()
+        elif len(self._relays) >= self.max_channels:
+            self._purge()
+            if len(self._relays) >= self.max_channels:
+                raise RelayUnsupported("Достигнут предел числа ретранслируемых каналов")
+        relay = self._relays[channel_id] = ChannelRelay(channel_id, url, profile, self.fetch)
+        if previous is not None:
+            relay.continue_from(previous)
+        relay.task = asyncio.ensure_future(relay.run(self.idle_timeout))
+        return relay
+
+    def _purge(self):
+        for channel_id in [cid for cid, relay in self._relays.items() if relay.closed]:
+            del self._relays[channel_id]
+
+    async def close(self):
+        tasks = [relay.task for relay in self._relays.values() if relay.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._relays.clear()
+
+    def viewers(self) -> Dict[str, int]:
+        """Активные зрители по каналам"""
+        return {channel_id: relay.active_viewers() for channel_id, relay in self._relays.items()
+                if not relay.closed}
+
+    def stats(self) -> Dict:
+        self._purge()
+        relays = list(self._relays.values())
+        upstream_bytes = sum(relay.upstream_bytes for relay in relays)
+        served_bytes = sum(relay.served_bytes for relay in relays)
+        return {
+            "channels": len(relays),
+            "viewers": sum(relay.active_viewers() for relay in relays),
+            "upstream_segments": sum(relay.upstream_segments for relay in relays),
+            "upstream_bytes": upstream_bytes,
+            "served_segments": sum(relay.served_segments for relay in relays),
+            "served_bytes": served_bytes,
+            # Во сколько раз трафик к зрителям больше трафика к источникам
+            "fanout": round(served_bytes / upstream_bytes, 2) if upstream_bytes else 0.0,
+            "unsupported": len(self._unsupported),
+            "unsupported_skips": self.skipped,
+        }
@@ -0,0 +1,176 @@
+"""Общий пул HTTP-соединений к внешним источникам (CDN, плейлисты)"""
+import asyncio
+import importlib.util
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import httpx  # type: ignore
+
+from config import env_bool, env_float, env_int, env_list, env_str
+
+
+# Общее число соединений в пуле и лимит одновременных запросов к одному хосту
+UPSTREAM_MAX_CONNECTIONS = env_int("UPSTREAM_MAX_CONNECTIONS", 512)
+UPSTREAM_MAX_KEEPALIVE = env_int("UPSTREAM_MAX_KEEPALIVE", 128)
+UPSTREAM_KEEPALIVE_EXPIRY = env_float("UPSTREAM_KEEPALIVE_EXPIRY", 60.0)
+UPSTREAM_PER_HOST_LIMIT = env_int("UPSTREAM_PER_HOST_LIMIT", 64)
+# Сколько секунд запрос ждет свободный слот хоста, прежде чем получить 503
+UPSTREAM_SLOT_TIMEOUT = env_float("UPSTREAM_SLOT_TIMEOUT", 10.0)
+
+# HTTP/2 включается только если установлен пакет h2 (pip install httpx[http2])
+UPSTREAM_HTTP2 = env_bool("UPSTREAM_HTTP2", True)
+
+# Таймауты: плейлисты маленькие и должны приходить быстро, сегменты тяжелее
+MANIFEST_CONNECT_TIMEOUT = env_float("MANIFEST_CONNECT_TIMEOUT", 5.0)
+MANIFEST_READ_TIMEOUT = env_float("MANIFEST_READ_TIMEOUT", 10.0)
+SEGMENT_CONNECT_TIMEOUT = env_float("SEGMENT_CONNECT_TIMEOUT", 5.0)
+SEGMENT_READ_TIMEOUT = env_float("SEGMENT_READ_TIMEOUT", 30.0)
+
+MANIFEST_EXTENSIONS = ('.m3u8', '.m3u', '.mpd')
+
+# User-Agent для запросов к источникам. Пока FORWARD_CLIENT_USER_AGENT выключен,
+# все зрители ходят к CDN с одним UA и делят между собой кэш
+DEFAULT_USER_AGENT = env_str(
+    "UPSTREAM_USER_AGENT",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+FORWARD_CLIENT_USER_AGENT = env_bool("FORWARD_CLIENT_USER_AGENT", False)
+
+# Origin и Referer по умолчанию; каналы с профилем в плейлисте задают свои (пусто - не отправлять)
+DEFAULT_ORIGIN = env_str("UPSTREAM_ORIGIN", "https://live-mirror-01.ott.tricolor.tv")
+DEFAULT_REFERER = env_str("UPSTREAM_REFERER", "https://live-mirror-01.ott.tricolor.tv/")
+
+# Хосты, которым нужен параметр против кэширования на стороне CDN (через запятую)
+CACHE_BUSTER_HOSTS = env_list("CACHE_BUSTER_HOSTS")
+CACHE_BUSTER_PARAM = "_nocache"
+
+
+class HostBusy(Exception):
+    """Все слоты хоста заняты дольше UPSTREAM_SLOT_TIMEOUT"""
+
+    def __init__(self, host: str):
+        super().__init__(f"Источник {host} перегружен запросами")
+        self.host = host
+
+
+def guess_content_kind(url: str) -> str:
+    """Определяет тип ресурса по URL: 'manifest' или 'segment'"""
+    path = urlparse(url).path.lower()
+    if path.endswith(MANIFEST_EXTENSIONS):
+        return "manifest"
+    return "segment"
+
+
+def needs_cache_buster(url: str) -> bool:
+    host = urlparse(url).hostname or ""
+    return any(host == item or host.endswith("." + item) for item in CACHE_BUSTER_HOSTS)
+
+
+def apply_cache_buster(url: str) -> str:
+    """Добавляет _nocache только для источников из CACHE_BUSTER_HOSTS"""
+    if not needs_cache_buster(url):
+        return url
+    separator = '&' if '?' in url else '?'
+    return f"{url}{separator}{CACHE_BUSTER_PARAM}={int(time.time())}"
+
+
+def upstream_user_agent(client_user_agent: Optional[str]) -> str:
+    if FORWARD_CLIENT_USER_AGENT and client_user_agent:
+        return client_user_agent
+    return DEFAULT_USER_AGENT
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+class UpstreamPool:
+    """
+    Один httpx.AsyncClient на всё время жизни приложения.
+    Держит keep-alive соединения к CDN и ограничивает число
+    одновременных запросов к каждому хосту.
+    """
+
+    def __init__(self,
+                 max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+                 max_keepalive: int = UPSTREAM_MAX_KEEPALIVE,
+                 keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+                 per_host_limit: int = UPSTREAM_PER_HOST_LIMIT,
+                 slot_timeout: float = UPSTREAM_SLOT_TIMEOUT,
+                 http2: bool = UPSTREAM_HTTP2):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.per_host_limit = per_host_limit
+        self.http2 = http2 and http2_available()
+        self.timeouts: Dict[str, httpx.Timeout] = {
+            "manifest": httpx.Timeout(MANIFEST_READ_TIMEOUT, connect=MANIFEST_CONNECT_TIMEOUT),
+            "segment": httpx.Timeout(SEGMENT_READ_TIMEOUT, connect=SEGMENT_CONNECT_TIMEOUT),
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self.slot_timeout = slot_timeout
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        # Запросы, занявшие слот хоста
+        self.in_flight = 0
+        # Отказы из-за того, что слот хоста не освободился за slot_timeout
+        self.saturated = 0
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self.timeouts["segment"],
+                http2=self.http2,
+                follow_redirects=False,
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._host_slots.clear()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("Пул соединений не запущен")
+        return self._client
+
+    def timeout_for(self, kind: str) -> httpx.Timeout:
+        return self.timeouts.get(kind, self.timeouts["segment"])
+
+    @asynccontextmanager
+    async def host_slot(self, url: str):
+        """
+        Ограничивает число одновременных запросов к хосту из URL.
+        Если слот не освободился за slot_timeout, бросает HostBusy
+        """
+        host = urlparse(url).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        try:
+            await asyncio.wait_for(slot.acquire(), self.slot_timeout)
+        except asyncio.TimeoutError:
+            self.saturated += 1
+            raise HostBusy(host)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            slot.release()
+
+    def stats(self) -> Dict:
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "per_host_limit": self.per_host_limit,
+            "hosts": len(self._host_slots),
+            "in_flight": self.in_flight,
+            "saturated": self.saturated,
+        }
@@ -0,0 +1,277 @@
+"""
+Режим нескольких воркеров (uvicorn/gunicorn --workers N) на одной машине.
+
+Воркеры делят общий каталог SHARED_DIR (по умолчанию на tmpfs, /dev/shm):
+в нем лежат кэш ответов (cache.SharedStore), разобранный каталог каналов
+и результаты проверки каналов, а также файл control.json со счетчиками
+событий. Ведущий воркер выбирается блокировкой файла (flock): он один
+обновляет плейлист и телепрограмму, проверяет каналы и чистит общий кэш. Если ведущий
+завершился, блокировка освобождается и ее забирает другой воркер.
+
+Остальные воркеры раз в WORKER_SYNC_INTERVAL секунд проверяют control.json
+и подхватывают новый каталог; очистка кэша и обновление плейлиста,
+запрошенные у любого воркера, доходят до всех.
+"""
+import asyncio
+import json
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from config import env_bool, env_float, env_str
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировок flock нет, режим недоступен
+    fcntl = None
+
+logger = logging.getLogger("iptv.workers")
+
+WORKERS_SHARED = env_bool("WORKERS_SHARED", False)
+SHARED_DIR = env_str("SHARED_DIR", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "iptv_fastapi"))
+# Как часто воркер проверяет события и пытается стать ведущим
+WORKER_SYNC_INTERVAL = env_float("WORKER_SYNC_INTERVAL", 1.0)
+# Как часто ведущий удаляет просроченные записи общего кэша
+SHARED_SWEEP_INTERVAL = env_float("SHARED_SWEEP_INTERVAL", 10.0)
+
+# События в control.json
+CATALOG = "catalog"
+HEALTH = "health"
+CLEAR = "clear"
+REFRESH = "refresh"
+EPG = "epg"
+EVENTS = (CATALOG, HEALTH, CLEAR, REFRESH, EPG)
+
+# События, которые обрабатывает только ведущий или только ведомые
+LEADER_EVENTS = frozenset((REFRESH,))
+FOLLOWER_EVENTS = frozenset((CATALOG, HEALTH, EPG))
+
+Handler = Callable[[], Awaitable[Any]]
+
+
+class WorkerCoordinator:
+    """
+    handlers - обработчики событий по имени; обработчик REFRESH возвращает
+    текст ошибки обновления (None - успешно), он передается запросившему воркеру.
+    on_leader вызывается, когда воркер становится ведущим.
+    """
+
+    def __init__(self, directory: str = SHARED_DIR, enabled: bool = WORKERS_SHARED,
+                 sync_interval: float = WORKER_SYNC_INTERVAL,
+                 sweep_interval: float = SHARED_SWEEP_INTERVAL):
+        self.directory = directory
+        self.enabled = enabled and fcntl is not None
+        if enabled and fcntl is None:
+            logger.warning("WORKERS_SHARED не поддерживается на этой ОС, воркеры работают независимо")
+        if self.enabled:
+            problem = private_dir(directory)
+            if problem is not None:
+                logger.error("Общий каталог %s не используется: %s; воркеры работают независимо",
+                             directory, problem)
+                self.enabled = False
+        self.sync_interval = sync_interval
+        self.sweep_interval = sweep_interval
+        self.handlers: Dict[str, Handler] = {}
+        self.on_leader: Optional[Handler] = None
+        self.sweeper: Optional[Callable[[], Any]] = None
+        self.is_leader = not self.enabled
+        self.leader_changes = 0
+        self.events_handled = 0
+        self._lock_file = None
+        self._seen: Dict[str, int] = {}
+        self._control_mtime = 0
+        self._last_sweep = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    async def start(self):
+        if not self.enabled:
+            return
+        # События, случившиеся до запуска воркера, не обрабатываются
+        self._seen = {event: generation for event, generation in self._read_control().items() if event in EVENTS}
+        self._try_lead()
+        logger.info("Воркер %s запущен %s", os.getpid(), "ведущим" if self.is_leader else "ведомым")
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _try_lead(self) -> bool:
+        """Блокировка leader.lock держится, пока жив процесс ведущего"""
+        if self.is_leader:
+            return False
+        lock_file = open(self.path("leader.lock"), "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.is_leader = True
+        self.leader_changes += 1
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if self._try_lead():
+                    logger.warning("Воркер %s стал ведущим", os.getpid())
+                    if self.on_leader is not None:
+                        await self.on_leader()
+                await self.sync()
+                if self.is_leader and self.sweeper is not None \
+                        and time.monotonic() - self._last_sweep >= self.sweep_interval:
+                    self._last_sweep = time.monotonic()
+                    await asyncio.to_thread(self.sweeper)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Ошибка синхронизации воркеров: %s", e)
+
+    async def sync(self):
+        """Обрабатывает новые события из control.json"""
+        if not self.enabled:
+            return
+        try:
+            mtime = os.stat(self.path("control.json")).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        state = self._read_control()
+        for event, handler in self.handlers.items():
+            generation = state.get(event, 0)
+            if generation <= self._seen.get(event, 0):
+                continue
+            self._seen[event] = generation
+            if event in LEADER_EVENTS and not self.is_leader:
+                continue
+            if event in FOLLOWER_EVENTS and self.is_leader:
+                continue
+            try:
+                result = await handler()
+            except Exception as e:
+                logger.warning("Ошибка обработки события %s: %s", event, e)
+                result = str(e) or type(e).__name__
+            self.events_handled += 1
+            if event == REFRESH:
+                await asyncio.to_thread(self._update_control, {"refreshed": generation, "refresh_error": result})
+
+    async def publish(self, event: str) -> int:
+        """Сообщает остальным воркерам о событии; сам воркер его уже обработал"""
+        if not self.enabled:
+            return 0
+        state = await asyncio.to_thread(self._increment, event)
+        self._seen[event] = state[event]
+        return state[event]
+
+    async def request_refresh(self, timeout: float) -> Optional[str]:
+        """
+        Просит ведущего обновить плейлист и ждет результата.
+        Возвращает ошибку обновления; TimeoutError, если ведущий не ответил
+        """
+        state = await asyncio.to_thread(self._increment, REFRESH)
+        generation = state[REFRESH]
+        self._seen[REFRESH] = generation
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            state = self._read_control()
+            if state.get("refreshed", 0) >= generation:
+                await self.sync()
+                return state.get("refresh_error")
+        raise asyncio.TimeoutError()
+
+    # control.json: счетчики событий, меняются под блокировкой control.lock
+
+    def _read_control(self) -> Dict:
+        try:
+            with open(self.path("control.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _increment(self, event: str) -> Dict:
+        return self._update_control(None, event)
+
+    def _update_control(self, values: Optional[Dict], increment: Optional[str] = None) -> Dict:
+        with open(self.path("control.lock"), "a+") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            state = self._read_control()
+            if increment:
+                state[increment] = state.get(increment, 0) + 1
+            if values:
+                state.update(values)
+            state["updated_by"] = os.getpid()
+            write_atomic(self.path("control.json"), json.dumps(state).encode("utf-8"))
+        return state
+
+    # Разобранные объекты (каталог, результаты проверок) для ведомых воркеров
+
+    def save_object(self, name: str, value: Any):
+        write_atomic(self.path(name + ".pickle"), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def load_object(self, name: str) -> Optional[Any]:
+        try:
+            with open(self.path(name + ".pickle"), "rb") as f:
+                # pickle исполняет код при загрузке: только файлы этого пользователя
+                if os.fstat(f.fileno()).st_uid != os.getuid():
+                    logger.error("Файл %s принадлежит другому пользователю и не загружается", f.name)
+                    return None
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "pid": os.getpid(),
+            "leader": self.is_leader,
+            "leader_changes": self.leader_changes,
+            "events_handled": self.events_handled,
+            "generations": dict(self._seen),
+            "directory": self.directory if self.enabled else None,
+        }
+
+
+def private_dir(directory: str) -> Optional[str]:
+    """
+    Создает каталог, доступный только этому пользователю (0700): из него
+    загружаются pickle-файлы, а /dev/shm открыт на запись всем.
+    Возвращает причину, по которой каталог нельзя использовать, или None
+    """
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode):
+            return "это не каталог"
+        if info.st_uid != os.getuid():
+            return "каталог принадлежит другому пользователю"
+        if info.st_mode & 0o077:
+            os.chmod(directory, 0o700)
+    except OSError as e:
+        return str(e)
+    return None
+
+
+def write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)